@@ -16,6 +16,11 @@
 
 import argparse
 
+from varsome_api.adaptive import AdaptiveBatchController
+from varsome_api.cache import SQLiteCache
+from varsome_api.metrics import PrometheusHooks, prometheus_client
+from varsome_api.ratelimit import RateLimiter
+from varsome_api.retry import RetryPolicy
 from varsome_api.vcf import VCFAnnotator
 
 
@@ -37,7 +42,7 @@ def annotate_vcf():
     )
     parser.add_argument(
         "-o",
-        help="Path to output vcf file",
+        help="Path to output vcf file. Files ending with .gz are bgzipped and indexed",
         type=str,
         metavar="Output VCF File",
         required=False,
@@ -66,26 +71,215 @@ def annotate_vcf():
         required=False,
         metavar="VarSome API host url",
     )
+    parser.add_argument(
+        "-c",
+        help="Path to a local SQLite file used to cache annotations between runs",
+        type=str,
+        required=False,
+        metavar="Annotation cache file",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds after which cached annotations expire",
+        type=int,
+        required=False,
+        metavar="Annotation cache TTL",
+    )
+    parser.add_argument(
+        "--retries",
+        help="Retry failed requests (429, 502, 503, 504, timeouts) up to this many "
+        "times with exponential backoff. Failing batches are split in half",
+        type=int,
+        required=False,
+        default=0,
+        metavar="Number of retries",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        help="Maximum number of requests per second sent to the API",
+        type=float,
+        required=False,
+        metavar="Requests per second",
+    )
+    parser.add_argument(
+        "--variants-per-second",
+        help="Maximum number of variants per second sent to the API",
+        type=float,
+        required=False,
+        metavar="Variants per second",
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Seconds to wait for the API to accept a connection and to send data. "
+        "Requests that time out are retried with --retries",
+        type=float,
+        required=False,
+        metavar="Timeout",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve request metrics for Prometheus on this port while annotating. "
+        "Requires the prometheus_client package and cannot be combined with --processes",
+        type=int,
+        required=False,
+        metavar="Metrics port",
+    )
+    parser.add_argument(
+        "--request-compression",
+        help="Compress the body of batch requests. zstd requires the zstandard package",
+        type=str,
+        choices=("gzip", "zstd"),
+        required=False,
+    )
+    parser.add_argument(
+        "--rate-limit-file",
+        help="Share the request limits with other processes using this file",
+        type=str,
+        required=False,
+        metavar="Rate limit state file",
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="Tune batch size and number of concurrent requests automatically "
+        "based on the API response times and throttling. -t becomes the "
+        "maximum number of concurrent requests",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--processes",
+        help="Split the vcf file and annotate it using this many processes. "
+        "Compressed files need to be bgzipped and tabix indexed",
+        type=int,
+        required=False,
+        default=1,
+        metavar="Number of processes",
+    )
+    parser.add_argument(
+        "--format",
+        help="Output format. parquet and arrow write the full annotations of every "
+        "variant to a columnar file and require pyarrow",
+        type=str,
+        choices=("vcf", "parquet", "arrow"),
+        required=False,
+        default="vcf",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Journal progress next to the output file so that an interrupted run "
+        "resumes where it stopped when started again with the same arguments",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--vcf-backend",
+        help="How records are read. raw only parses the columns needed to request a "
+        "variant and copies the rest of every line to the output, which is much faster "
+        "for vcf files with many samples. cyvcf2 reads vcf and bcf files with htslib, "
+        "which rewrites every record, and requires the cyvcf2 package. pyvcf parses every column",
+        type=str,
+        choices=("raw", "cyvcf2", "pyvcf"),
+        required=False,
+        default="raw",
+    )
+    parser.add_argument(
+        "--regions",
+        help="Only annotate the records starting in these regions e.g. chr17:7.5M-7.7M. "
+        "The input needs to be bgzipped and tabix indexed",
+        type=str,
+        nargs="+",
+        required=False,
+        metavar="Region",
+    )
+    parser.add_argument(
+        "--index",
+        help="Index written for bgzipped output, i.e. an output file ending with .gz",
+        type=str,
+        choices=("tbi", "csi", "none"),
+        required=False,
+        default="tbi",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        help="Threads compressing bgzipped output. Defaults to the number of cpus",
+        type=int,
+        required=False,
+        metavar="Compression threads",
+    )
     args = parser.parse_args()
+    if args.checkpoint and args.processes > 1:
+        parser.error("--checkpoint cannot be combined with --processes")
+    if args.format != "vcf" and (args.checkpoint or args.processes > 1):
+        parser.error("--checkpoint and --processes require vcf output")
     api_key = args.k
     vcf_file = args.i
     output_vcf_file = args.o
     ref_genome = args.g
     num_threads = args.t
     api_url = args.u
+    adaptive = None
+    if args.adaptive:
+        adaptive = AdaptiveBatchController(max_concurrency=max(num_threads, 1))
+    rate_limiter = None
+    if args.requests_per_second or args.variants_per_second:
+        rate_limiter = RateLimiter(
+            args.requests_per_second,
+            args.variants_per_second,
+            state_file=args.rate_limit_file,
+        )
+    retry = None
+    if args.retries > 0:
+        retry = RetryPolicy(max_attempts=args.retries + 1, split_batches=True)
+    cache = None
+    if args.c:
+        cache = SQLiteCache(args.c, ttl=args.cache_ttl)
     request_parameters = None
     if args.p:
         request_parameters = {
             param[0]: param[1] for param in [param.split("=") for param in args.p]
         }
+    hooks = None
+    if args.metrics_port:
+        if args.processes > 1:
+            parser.error("--metrics-port cannot be combined with --processes")
+        hooks = [PrometheusHooks()]
+        prometheus_client.start_http_server(args.metrics_port)
     vcf_annotator = VCFAnnotator(
         api_key=api_key,
         api_url=api_url,
         ref_genome=ref_genome,
         get_parameters=request_parameters,
         max_threads=num_threads,
+        cache=cache,
+        adaptive=adaptive,
+        retry=retry,
+        rate_limiter=rate_limiter,
+        lazy_models=True,
+        request_compression=args.request_compression,
+        timeout=args.timeout,
+        hooks=hooks,
+        vcf_backend=args.vcf_backend,
     )
-    vcf_annotator.annotate(vcf_file, output_vcf_file)
+    index = args.index if args.index != "none" else None
+    if args.processes > 1:
+        vcf_annotator.annotate_parallel(
+            vcf_file,
+            output_vcf_file,
+            processes=args.processes,
+            regions=args.regions,
+            index=index,
+            compression_threads=args.compression_threads,
+        )
+    else:
+        vcf_annotator.annotate(
+            vcf_file,
+            output_vcf_file,
+            checkpoint=args.checkpoint,
+            output_format=args.format,
+            regions=args.regions,
+            index=index,
+            compression_threads=args.compression_threads,
+        )
 
 
 if __name__ == "__main__":
@@ -18,8 +18,31 @@ import argparse
 import json
 import os
 import sys
+from itertools import chain
 
+from varsome_api.cache import SQLiteCache
+from varsome_api.ratelimit import RateLimiter
+from varsome_api.retry import RetryPolicy
 from varsome_api.client import VarSomeAPIClient
+from varsome_api.output import ArrowSink, JSONSink, NDJSONSink
+
+# requests without an api key are limited more strictly
+KEYLESS_REQUESTS_PER_SECOND = 2.0
+
+
+def open_sink(output_file, output_format, compression=None, row_group_size=10000):
+    if output_format == "json":
+        return JSONSink(output_file, compression)
+    if output_format == "ndjson":
+        return NDJSONSink(output_file, compression)
+    return ArrowSink(output_file, output_format, row_group_size=row_group_size)
+
+
+def read_variants(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield line
 
 
 def annotate_variant():
@@ -56,7 +79,7 @@ def annotate_variant():
     )
     parser.add_argument(
         "-i",
-        help="Path to text file with variants. "
+        help="Path to text file with variants or - to read them from standard input. "
         "It should include one variant per line. Don't use it "
         "together with the -q option",
         type=str,
@@ -70,6 +93,14 @@ def annotate_variant():
         metavar="Output File with json entries",
         required=False,
     )
+    parser.add_argument(
+        "-t",
+        help="Number of concurrent requests when annotating variants from a file",
+        type=int,
+        default=3,
+        required=False,
+        metavar="Number of threads",
+    )
     parser.add_argument(
         "-u",
         help="Use specific VarSome API host url "
@@ -78,6 +109,85 @@ def annotate_variant():
         required=False,
         metavar="VarSome API host url",
     )
+    parser.add_argument(
+        "-c",
+        help="Path to a local SQLite file used to cache annotations between runs",
+        type=str,
+        required=False,
+        metavar="Annotation cache file",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds after which cached annotations expire",
+        type=int,
+        required=False,
+        metavar="Annotation cache TTL",
+    )
+    parser.add_argument(
+        "--retries",
+        help="Retry failed requests (429, 502, 503, 504, timeouts) up to this many "
+        "times with exponential backoff. Failing batches are split in half",
+        type=int,
+        required=False,
+        default=0,
+        metavar="Number of retries",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        help="Maximum number of requests per second sent to the API. Variants read from "
+        "a file without an API key are limited to %s requests per second by default"
+        % KEYLESS_REQUESTS_PER_SECOND,
+        type=float,
+        required=False,
+        metavar="Requests per second",
+    )
+    parser.add_argument(
+        "--variants-per-second",
+        help="Maximum number of variants per second sent to the API",
+        type=float,
+        required=False,
+        metavar="Variants per second",
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Seconds to wait for the API to accept a connection and to send data. "
+        "Requests that time out are retried with --retries",
+        type=float,
+        required=False,
+        metavar="Timeout",
+    )
+    parser.add_argument(
+        "--request-compression",
+        help="Compress the body of batch requests. zstd requires the zstandard package",
+        type=str,
+        choices=("gzip", "zstd"),
+        required=False,
+    )
+    parser.add_argument(
+        "--rate-limit-file",
+        help="Share the request limits with other processes using this file",
+        type=str,
+        required=False,
+        metavar="Rate limit state file",
+    )
+    parser.add_argument(
+        "--format",
+        help="Output format. ndjson writes one compact json line per variant as "
+        "batches complete. parquet and arrow write a columnar file, require pyarrow "
+        "and an output file",
+        type=str,
+        choices=("json", "ndjson", "parquet", "arrow"),
+        required=False,
+        default="json",
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compress json or ndjson output. Inferred from the output file extension "
+        "(.gz or .zst) if not given",
+        type=str,
+        choices=("gzip", "zstd"),
+        required=False,
+    )
     args = parser.parse_args()
     api_key = args.k
     query = args.q
@@ -85,6 +195,23 @@ def annotate_variant():
     input_file = args.i
     output_file = args.o
     api_url = args.u
+    rate_limiter = None
+    if args.requests_per_second or args.variants_per_second:
+        rate_limiter = RateLimiter(
+            args.requests_per_second,
+            args.variants_per_second,
+            state_file=args.rate_limit_file,
+        )
+    elif api_key is None and input_file:
+        rate_limiter = RateLimiter(
+            KEYLESS_REQUESTS_PER_SECOND, state_file=args.rate_limit_file
+        )
+    retry = None
+    if args.retries > 0:
+        retry = RetryPolicy(max_attempts=args.retries + 1, split_batches=True)
+    cache = None
+    if args.c:
+        cache = SQLiteCache(args.c, ttl=args.cache_ttl)
     if query and input_file:
         sys.stderr.write(
             "Don't specify -i and -q options together. Use only one of them\n"
@@ -93,23 +220,37 @@ def annotate_variant():
     if not query and not input_file:
         sys.stderr.write("Please either specify -i or -q options\n")
         sys.exit(1)
-    if input_file and not os.path.exists(input_file):
+    if input_file and input_file != "-" and not os.path.exists(input_file):
         sys.stderr.write("File %s does not exist\n" % input_file)
         sys.exit(1)
     if output_file and os.path.exists(output_file):
         sys.stderr.write("File %s already exists\n" % output_file)
         sys.exit(1)
+    if args.format in ("parquet", "arrow") and not output_file:
+        sys.stderr.write(
+            "Please specify an output file with -o for %s output\n" % args.format
+        )
+        sys.exit(1)
     request_parameters = None
     if args.p:
         request_parameters = {
             param[0]: param[1] for param in [param.split("=") for param in args.p]
         }
-    api = VarSomeAPIClient(api_key, api_url=api_url)
+    api = VarSomeAPIClient(
+        api_key,
+        api_url=api_url,
+        cache=cache,
+        retry=retry,
+        rate_limiter=rate_limiter,
+        request_compression=args.request_compression,
+        timeout=args.timeout,
+    )
     if query:
         if len(query) == 1:
             result = api.lookup(
                 query[0], params=request_parameters, ref_genome=ref_genome
             )
+            pairs = [(query[0], result)]
         else:
             if api_key is None:
                 sys.exit("You need to pass an api key to perform batch requests")
@@ -117,7 +258,11 @@ def annotate_variant():
                 query, params=request_parameters, ref_genome=ref_genome
             )
             result = list(result)
-        if output_file:
+            pairs = zip(query, result)
+        if args.format != "json":
+            with open_sink(output_file, args.format, args.compression) as sink:
+                sink.write_many(pairs)
+        elif output_file:
             with open(output_file, "w") as fp:
                 json.dump(result, fp, indent=4, sort_keys=True)
         else:
@@ -126,64 +271,52 @@ def annotate_variant():
             )
             sys.stdout.write("\n")
         sys.exit(0)
-    with open(input_file) as f:
-        variants = f.read().splitlines()
-    if variants:
-        if len(variants) > 1000:
-            sys.stdout.write(
-                "Too many variants.. Consider using annotate_vcf instead\n"
-            )
-            sys.stdout.flush()
-        try:
-            if api_key is None:
-                sys.stdout.write(
-                    "Without an API key, variants will be annotated one a time, "
-                    "causing a 429 too many requests error after some time\n"
-                )
-                sys.stdout.flush()
-                results = []
-                for variant in variants:
-                    result = api.lookup(
-                        variant, params=request_parameters, ref_genome=ref_genome
-                    )
-                    if not result:
-                        result = {
-                            "error": "Could not fetch annotations for %s" % variant
-                        }
-                    results.append(result)
-                if output_file:
-                    with open(output_file, "w") as fp:
-                        json.dump(results, fp, indent=4, sort_keys=True)
-                else:
-                    sys.stdout.write(
-                        json.dumps(results, indent=4, sort_keys=True)
-                        if results
-                        else "No result"
-                    )
-                    sys.stdout.write("\n")
-            else:
-                result = api.batch_lookup(
-                    variants, params=request_parameters, ref_genome=ref_genome
-                )
-                result = list(result)
-                if output_file:
-                    with open(output_file, "w") as fp:
-                        json.dump(result, fp, indent=4, sort_keys=True)
-                else:
-                    sys.stdout.write(
-                        json.dumps(result, indent=4, sort_keys=True)
-                        if result
-                        else "No result"
-                    )
-                    sys.stdout.write("\n")
-        except Exception as e:
-            # several things might occur. This is too broad,
-            sys.stderr.write(str(e))
-            sys.stderr.write("\n")
-            sys.exit(1)
+
+    if input_file == "-":
+        f = sys.stdin
     else:
+        f = open(input_file)
+    # variants are read lazily and results written as batches complete,
+    # so memory does not depend on the number of variants
+    variants = read_variants(f)
+    first_variant = next(variants, None)
+    if first_variant is None:
         sys.stderr.write("No variants found in file %s\n" % input_file)
         sys.exit(1)
+    variants = chain([first_variant], variants)
+    if api_key is None:
+        sys.stderr.write(
+            "No API key given, variants will be annotated one at a time using "
+            "%s concurrent requests\n" % args.t
+        )
+        results = api.iter_lookup(
+            variants,
+            params=request_parameters,
+            ref_genome=ref_genome,
+            max_threads=args.t,
+        )
+    else:
+        results = api.iter_batch_lookup(
+            variants,
+            params=request_parameters,
+            ref_genome=ref_genome,
+            max_threads=args.t,
+        )
+    try:
+        with open_sink(
+            output_file,
+            args.format,
+            args.compression,
+            row_group_size=api.max_variants_per_batch,
+        ) as sink:
+            sink.write_many(results)
+    except Exception as e:
+        # several things might occur. This is too broad,
+        sys.stderr.write(str(e))
+        sys.stderr.write("\n")
+        sys.exit(1)
+    finally:
+        f.close()
 
 
 if __name__ == "__main__":
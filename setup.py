@@ -44,5 +44,15 @@ setup(
         "Topic :: Scientific/Engineering :: Bio-Informatics",
     ],
     install_requires=installation_requirements,
+    extras_require={
+        "async": ["aiohttp>=3.7"],
+        "tabix": ["pysam"],
+        "columns": ["numpy", "pyarrow"],
+        "zstd": ["zstandard"],
+        "json": ["orjson"],
+        "prometheus": ["prometheus_client"],
+        "opentelemetry": ["opentelemetry-api"],
+        "cyvcf2": ["cyvcf2"],
+    },
     python_requires=">=3.3",
 )
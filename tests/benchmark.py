@@ -0,0 +1,322 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Hermetic throughput benchmark of batch_lookup and VCFAnnotator.annotate against
+# varsome_api.mock_server. Run it from the repository root with python -m tests.benchmark
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from varsome_api.client import VarSomeAPIClient
+from varsome_api.metrics import RequestHooks
+from varsome_api.mock_server import MockVarSomeServer
+from varsome_api.retry import RetryPolicy
+from varsome_api.vcf import VCFAnnotator
+
+CHROMOSOMES = [str(chromosome) for chromosome in range(1, 23)] + ["X"]
+
+
+def make_variants(count):
+    """
+    :param count: number of variants
+    :return: list of distinct chrom-pos-ref-alt variants
+    """
+    return [
+        "chr%s-%s-A-G" % (CHROMOSOMES[i % len(CHROMOSOMES)], 10000 + i)
+        for i in range(count)
+    ]
+
+
+def write_vcf(path, count):
+    """
+    :param path: vcf file to write
+    :param count: number of records
+    """
+    with open(path, "w") as f:
+        f.write("##fileformat=VCFv4.1\n")
+        for chromosome in CHROMOSOMES:
+            f.write("##contig=<ID=%s>\n" % chromosome)
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        # records sorted by chromosome then position, like any real vcf
+        records = sorted(
+            ((i % len(CHROMOSOMES), 10000 + i) for i in range(count)),
+        )
+        for chromosome, pos in records:
+            f.write("%s\t%s\t.\tA\tG\t.\tPASS\t.\n" % (CHROMOSOMES[chromosome], pos))
+
+
+def percentile(values, q):
+    """
+    :param values: sorted list of numbers
+    :param q: percentile between 0 and 100
+    :return: nearest rank percentile or None for no values
+    """
+    if not values:
+        return None
+    rank = int(round(q / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of the current process in bytes, None if unknown
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class BatchLatencies(RequestHooks):
+    """
+    Keeps the latency of every successful batch request
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+
+    def request_finished(
+        self,
+        endpoint,
+        method,
+        variants,
+        attempt,
+        elapsed,
+        status,
+        bytes_sent=None,
+        bytes_received=None,
+    ):
+        if method == "POST" and status != "" and status < 400:
+            with self._lock:
+                self.latencies.append(elapsed)
+
+
+def run_case(
+    scenario,
+    api_url,
+    batch_size,
+    threads,
+    variants,
+    vcf_file=None,
+    vcf_backend="pyvcf",
+):
+    """
+    Run a single benchmark case. Called in a fresh process so that peak rss is per case
+    :param scenario: batch_lookup or annotate
+    :param api_url: mock server url
+    :param batch_size: variants per batch request
+    :param threads: concurrent batch requests
+    :param variants: number of variants
+    :param vcf_file: input vcf file for annotate
+    :param vcf_backend: VCFAnnotator vcf backend for annotate
+    :return: dictionary of measurements
+    """
+    logger = logging.getLogger("varsome_api.benchmark")
+    latencies = BatchLatencies()
+    options = dict(
+        api_key="benchmark",
+        logger=logger,
+        api_url=api_url,
+        max_variants_per_batch=batch_size,
+        retry=RetryPolicy(max_attempts=5, backoff_factor=0.1),
+        hooks=[latencies],
+    )
+    start = time.monotonic()
+    if scenario == "batch_lookup":
+        api = VarSomeAPIClient(**options)
+        results = api.batch_lookup(make_variants(variants), max_threads=threads)
+        annotated = sum(1 for result in results if "variant_id" in result)
+    else:
+        annotator = VCFAnnotator(
+            max_threads=threads, vcf_backend=vcf_backend, **options
+        )
+        output_file = "%s.%s.%s.annotated.vcf" % (vcf_file, batch_size, threads)
+        annotator.annotate(vcf_file, output_file)
+        os.remove(output_file)
+        annotated = annotator.total_variants - annotator.variants_with_errors
+    elapsed = time.monotonic() - start
+    batch_latencies = sorted(latencies.latencies)
+    return {
+        "scenario": scenario,
+        "batch_size": batch_size,
+        "threads": threads,
+        "variants": variants,
+        "annotated": annotated,
+        "seconds": elapsed,
+        "variants_per_second": variants / elapsed if elapsed else None,
+        "batch_requests": len(batch_latencies),
+        "p50_batch_latency": percentile(batch_latencies, 50),
+        "p99_batch_latency": percentile(batch_latencies, 99),
+        "peak_rss": peak_rss(),
+    }
+
+
+def run_benchmark(
+    scenarios=("batch_lookup", "annotate"),
+    batch_sizes=(200, 1000),
+    threads=(1, 4),
+    variants=10000,
+    vcf_backend="pyvcf",
+    **server_options,
+):
+    """
+    Run every combination of scenario, batch size and thread count against a mock server
+    :param scenarios: batch_lookup and/or annotate
+    :param batch_sizes: variants per batch request
+    :param threads: concurrent batch requests
+    :param variants: number of variants per case
+    :param vcf_backend: VCFAnnotator vcf backend for annotate
+    :param server_options: MockVarSomeServer arguments e.g. latency or payload_size
+    :return: list of measurement dictionaries, one per case
+    """
+    results = []
+    # spawned workers don't inherit the memory of this process, so peak rss is per case
+    context = multiprocessing.get_context("spawn")
+    with MockVarSomeServer(**server_options) as server:
+        with tempfile.TemporaryDirectory() as tmp:
+            vcf_file = os.path.join(tmp, "benchmark.vcf")
+            if "annotate" in scenarios:
+                write_vcf(vcf_file, variants)
+            for scenario in scenarios:
+                for batch_size in batch_sizes:
+                    for thread_count in threads:
+                        with concurrent.futures.ProcessPoolExecutor(
+                            1, mp_context=context
+                        ) as executor:
+                            case = executor.submit(
+                                run_case,
+                                scenario,
+                                server.url,
+                                batch_size,
+                                thread_count,
+                                variants,
+                                vcf_file,
+                                vcf_backend,
+                            )
+                            results.append(case.result())
+    return results
+
+
+def _format(value, pattern, scale=1):
+    return "-" if value is None else pattern % (value * scale)
+
+
+def print_results(results, stream=sys.stdout):
+    columns = (
+        "scenario",
+        "batch",
+        "threads",
+        "variants/s",
+        "p50 ms",
+        "p99 ms",
+        "peak rss MB",
+    )
+    stream.write("%-13s %6s %8s %11s %8s %8s %12s\n" % columns)
+    for result in results:
+        stream.write(
+            "%-13s %6s %8s %11s %8s %8s %12s\n"
+            % (
+                result["scenario"],
+                result["batch_size"],
+                result["threads"],
+                _format(result["variants_per_second"], "%.0f"),
+                _format(result["p50_batch_latency"], "%.1f", 1000),
+                _format(result["p99_batch_latency"], "%.1f", 1000),
+                _format(result["peak_rss"], "%.1f", 1 / 1024.0**2),
+            )
+        )
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark batch_lookup and VCFAnnotator.annotate against a mock VarSome API"
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=["batch_lookup", "annotate"],
+        help="Comma separated batch_lookup and/or annotate",
+    )
+    parser.add_argument("--batch-sizes", type=_int_list, default=[200, 1000])
+    parser.add_argument("--threads", type=_int_list, default=[1, 4])
+    parser.add_argument("--variants", type=int, default=10000)
+    parser.add_argument(
+        "--vcf-backend", choices=("pyvcf", "raw", "cyvcf2"), default="pyvcf"
+    )
+    parser.add_argument(
+        "--latency", help="Mock seconds per request", type=float, default=0.05
+    )
+    parser.add_argument(
+        "--latency-per-variant",
+        help="Mock additional seconds per variant of a batch request",
+        type=float,
+        default=0.0001,
+    )
+    parser.add_argument(
+        "--payload-size",
+        help="Approximate size in bytes of every annotation",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--fixtures", help="Json file with recorded responses to replay", type=str
+    )
+    parser.add_argument(
+        "--json", help="Also write the results to this json file", type=str
+    )
+    args = parser.parse_args()
+    results = run_benchmark(
+        scenarios=args.scenarios,
+        batch_sizes=args.batch_sizes,
+        threads=args.threads,
+        variants=args.variants,
+        vcf_backend=args.vcf_backend,
+        latency=args.latency,
+        latency_per_variant=args.latency_per_variant,
+        payload_size=args.payload_size,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=0,
+        fixtures=args.fixtures,
+        seed=0,
+    )
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
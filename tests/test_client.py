@@ -13,10 +13,19 @@
 # limitations under the License.
 
 
+import asyncio
+import gzip
+import io
+import json
 import os
+import pickle
+import socket
+import threading
+import time
 
 import unittest
 from tempfile import NamedTemporaryFile
+from unittest import mock
 
 try:
     unittest.TestCase.subTest
@@ -24,10 +33,37 @@ except AttributeError:
     import unittest2 as unittest
 
 
+import vcf
 from vcf.parser import _Info, _encode_type
-from varsome_api.client import VarSomeAPIClient, VarSomeAPIException
-from varsome_api.models.variant import AnnotatedVariant
-from varsome_api.vcf import VCFAnnotator as BaseVCFAnnotator, vcf_reader
+from varsome_api import async_client
+from varsome_api.adaptive import AdaptiveBatchController
+from varsome_api.cache import MemoryCache, SQLiteCache, normalize_variant
+from varsome_api.ratelimit import RateLimiter
+from varsome_api.retry import RetryPolicy, parse_retry_after
+from varsome_api.client import (
+    VarSomeAPIClient,
+    VarSomeAPIConnectionError,
+    VarSomeAPIException,
+    chunked_variants,
+)
+from varsome_api import bgzf, decoder, metrics, output, raw_vcf
+from varsome_api.mock_server import SCHEMA, MockVarSomeServer
+from varsome_api.models import lazy, table
+from varsome_api.models.compact import CompactVariant, compact_model
+from varsome_api.models.variant import AnnotatedVariant, LazyAnnotatedVariant
+from varsome_api.vcf import (
+    AnnotationCheckpoint,
+    VCFAnnotator as BaseVCFAnnotator,
+    merge_regions,
+    open_vcf_after,
+    open_vcf_regions,
+    open_vcf_shard,
+    parse_region,
+    prefetch,
+    pysam,
+    vcf_reader,
+    vcf_shards,
+)
 
 API_KEY = os.getenv("VARSOME_API_KEY", None)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -84,6 +120,69 @@ class TestApiClient(unittest.TestCase):
         self.assertEqual(len(results), len(self.variants_to_lookup))
         self.client.session.close()
 
+    def test_iter_batch_lookup_hg19(self):
+        """Check we can stream batch results from a generator in input order"""
+        self.client.max_variants_per_batch = 2
+        results = list(
+            self.client.iter_batch_lookup(
+                (variant for variant in self.variants_to_lookup),
+                ref_genome="hg19",
+                raise_exceptions=True,
+                max_pending_chunks=2,
+            )
+        )
+        self.assertEqual([variant for variant, _ in results], self.variants_to_lookup)
+        self.client.session.close()
+
+
+@unittest.skipIf(async_client.aiohttp is None, "aiohttp is not installed")
+class TestAsyncApiClient(unittest.TestCase):
+    def __init__(self, methodName="runTest"):
+        super().__init__(methodName)
+        with open(VARIANTS_CSV_FILE) as f:
+            self.variants_to_lookup = f.read().splitlines()
+        if API_KEY is None:
+            self.variants_to_lookup = self.variants_to_lookup[:5]
+        else:
+            self.variants_to_lookup = self.variants_to_lookup[:50]
+
+    def test_schema(self):
+        """Check we receive the response schema back"""
+
+        async def schema():
+            async with async_client.AsyncVarSomeAPIClient(API_KEY) as client:
+                return await client.schema()
+
+        self.assertIsNotNone(asyncio.run(schema()))
+
+    def test_404(self):
+        """Check we can raise VarSomeAPIException"""
+
+        async def lookup():
+            async with async_client.AsyncVarSomeAPIClient(API_KEY) as client:
+                return await client.lookup("chrM:410:A:T", ref_genome="hg64")
+
+        with self.assertRaises(VarSomeAPIException) as ve:
+            asyncio.run(lookup())
+        self.assertEqual(ve.exception.status, 404)
+
+    def test_batch_lookup_hg19(self):
+        """Check we can do batch requests"""
+
+        async def batch_lookup():
+            async with async_client.AsyncVarSomeAPIClient(
+                API_KEY, max_variants_per_batch=10
+            ) as client:
+                return await client.batch_lookup(
+                    self.variants_to_lookup,
+                    ref_genome="hg19",
+                    params={"add-all-data": 1, "expand-pubmed-articles": 0},
+                    raise_exceptions=True,
+                )
+
+        results = asyncio.run(batch_lookup())
+        self.assertEqual(len(results), len(self.variants_to_lookup))
+
 
 class TestApiResponse(unittest.TestCase):
     def __init__(self, methodName="runTest"):
@@ -128,6 +227,1109 @@ class TestApiResponse(unittest.TestCase):
                 self.assertEqual(result["pos"], annotated_variant.pos)
 
 
+class TestSQLiteCache(unittest.TestCase):
+    def setUp(self):
+        cache_file = NamedTemporaryFile(delete=False, suffix=".sqlite")
+        cache_file.close()
+        self.cache_path = cache_file.name
+        self.cache = SQLiteCache(self.cache_path, max_entries=3)
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.cache_path)
+
+    def test_normalize_variant(self):
+        """Check equivalent variant representations share a normalized form"""
+        for i, variant in enumerate(
+            ["chr7:140453136:A:T", "7-140453136-a-t", " chr7-140453136-A-T"]
+        ):
+            with self.subTest(i=i):
+                self.assertEqual(normalize_variant(variant), "chr7:140453136:A:T")
+        self.assertEqual(normalize_variant("gene/EGFR"), "gene/EGFR")
+
+    def test_key_includes_ref_genome_and_params(self):
+        """Check cache keys depend on reference genome and sorted params"""
+        key = self.cache.make_key("chr7:140453136:A:T", "hg19", {"a": 1, "b": 2})
+        self.assertEqual(
+            key, self.cache.make_key("7-140453136-A-T", "hg19", {"b": 2, "a": "1"})
+        )
+        self.assertNotEqual(key, self.cache.make_key("chr7:140453136:A:T", "hg38"))
+
+    def test_key_includes_endpoint(self):
+        """Check single lookups and batch entries don't share cached results"""
+        self.cache.set(
+            self.cache.make_key("rs113488022", "hg19"), [{"variant_id": "1"}]
+        )
+        keys, hits, misses = self.cache.split_batch(["rs113488022"], "hg19")
+        self.assertEqual((hits, misses), ({}, ["rs113488022"]))
+
+    def test_split_and_merge_batch(self):
+        """Check only misses are returned for requesting and hits are merged in order"""
+        self.cache.set(
+            self.cache.make_key("chr1:1:A:T", "hg19", endpoint="batch"),
+            {"variant_id": "1"},
+        )
+        keys, hits, misses = self.cache.split_batch(
+            ["chr1:2:A:T", "chr1:1:A:T", "chr1:3:A:T"], "hg19"
+        )
+        self.assertEqual(misses, ["chr1:2:A:T", "chr1:3:A:T"])
+        merged = self.cache.merge_batch(
+            keys, hits, [{"variant_id": "2"}, {"error": "failed"}]
+        )
+        self.assertEqual(
+            merged, [{"variant_id": "2"}, {"variant_id": "1"}, {"error": "failed"}]
+        )
+        self.assertEqual(len(self.cache), 2)
+
+    def test_eviction(self):
+        """Check the cache does not grow beyond max_entries and honours ttl"""
+        self.cache.set_many({str(i): {"variant_id": str(i)} for i in range(5)})
+        self.assertEqual(len(self.cache), 3)
+        self.cache.ttl = -1
+        self.assertEqual(self.cache.get_many([str(i) for i in range(5)]), {})
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_lru_eviction_and_stats(self):
+        """Check least recently used entries are evicted and counters are kept"""
+        cache = MemoryCache(max_entries=2)
+        cache.set("a", {"variant_id": "a"})
+        cache.set("b", {"variant_id": "b"})
+        self.assertEqual(cache.get("a"), {"variant_id": "a"})
+        cache.set("c", {"variant_id": "c"})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats, {"hits": 1, "misses": 1, "evictions": 1})
+
+    def test_ttl(self):
+        """Check expired entries are not returned"""
+        cache = MemoryCache(ttl=-1)
+        cache.set("a", {"variant_id": "a"})
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
+class TestAdaptiveBatchController(unittest.TestCase):
+    def test_additive_increase(self):
+        """Check fast successful batches grow batch size and concurrency"""
+        controller = AdaptiveBatchController(
+            batch_size=100, batch_size_step=10, concurrency=1, max_concurrency=4
+        )
+        for _ in range(10):
+            controller.record(controller.batch_size, 0.5, 200, 1000)
+        self.assertEqual(controller.batch_size, 200)
+        self.assertTrue(1 < controller.concurrency <= 4)
+
+    def test_multiplicative_decrease(self):
+        """Check throttling halves batch size and concurrency once per window"""
+        controller = AdaptiveBatchController(batch_size=400, concurrency=8)
+        controller.record(400, 1.0, 429)
+        controller.record(400, 1.0, 503)
+        self.assertEqual(controller.batch_size, 200)
+        self.assertEqual(controller.concurrency, 4)
+        self.assertEqual(controller.stats["throttled"], 2)
+
+    def test_only_congestion_decreases(self):
+        """Check timeouts decrease batch size and concurrency and other failures do not"""
+        controller = AdaptiveBatchController(batch_size=400, concurrency=8)
+        controller.record(400, 1.0, "")
+        controller.record(400, 1.0, 400)
+        self.assertEqual((controller.batch_size, controller.concurrency), (400, 8))
+        self.assertEqual(controller.stats["errors"], 2)
+        controller.record(400, 1.0, "", transient=True)
+        self.assertEqual((controller.batch_size, controller.concurrency), (200, 4))
+        self.assertEqual(controller.stats["throttled"], 1)
+
+    def test_response_size_limit(self):
+        """Check the batch size is capped by the expected response size"""
+        controller = AdaptiveBatchController(batch_size=1000, max_response_bytes=100000)
+        controller.record(1000, 1.0, 200, 1000 * 1000)
+        self.assertEqual(controller.batch_size, 100)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_should_retry(self):
+        """Check only transient errors are retried and attempts are bounded"""
+        policy = RetryPolicy(max_attempts=3)
+        self.assertTrue(policy.should_retry(VarSomeAPIException(503), 1))
+        self.assertTrue(policy.should_retry(VarSomeAPIConnectionError(""), 2))
+        self.assertFalse(policy.should_retry(VarSomeAPIException(503), 3))
+        self.assertFalse(policy.should_retry(VarSomeAPIException(404), 1))
+        self.assertFalse(
+            policy.should_retry(VarSomeAPIException("", "Unknown error"), 1)
+        )
+        self.assertEqual(policy.stats, {"retries": 2, "splits": 0, "failures": 3})
+
+    def test_delay(self):
+        """Check exponential backoff, jitter bounds and Retry-After"""
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5, jitter=0.5)
+        for attempt, upper in ((1, 1), (2, 2), (3, 4), (10, 5)):
+            with self.subTest(attempt=attempt):
+                delay = policy.get_delay(attempt)
+                self.assertTrue(upper / 2.0 <= delay <= upper)
+        self.assertEqual(policy.get_delay(1, retry_after=30), 30)
+
+    def test_split(self):
+        """Check failed batches are only split when enabled and large enough"""
+        error = VarSomeAPIException(504)
+        self.assertFalse(RetryPolicy().should_split(error, ["a", "b"]))
+        policy = RetryPolicy(split_batches=True, min_split_size=2)
+        self.assertTrue(policy.should_split(error, ["a", "b", "c"]))
+        self.assertFalse(policy.should_split(error, ["a", "b"]))
+        self.assertFalse(policy.should_split(VarSomeAPIException(400), ["a", "b", "c"]))
+        self.assertFalse(
+            policy.should_split(
+                VarSomeAPIException("", "Unknown error"), ["a", "b", "c"]
+            )
+        )
+
+    def test_parse_retry_after(self):
+        """Check Retry-After header parsing"""
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_requests_per_second(self):
+        """Check requests beyond the burst have to wait"""
+        limiter = RateLimiter(requests_per_second=10)
+        waits = [limiter.reserve() for _ in range(12)]
+        self.assertEqual(waits[:10], [0.0] * 10)
+        self.assertAlmostEqual(waits[10], 0.1, delta=0.02)
+        self.assertAlmostEqual(waits[11], 0.2, delta=0.02)
+
+    def test_variants_per_second(self):
+        """Check batches larger than the burst are allowed but delay later requests"""
+        limiter = RateLimiter(variants_per_second=100)
+        self.assertAlmostEqual(limiter.reserve(300), 2.0, delta=0.02)
+        self.assertAlmostEqual(limiter.reserve(100), 3.0, delta=0.02)
+
+    @unittest.skipIf(os.name != "posix", "requires fcntl")
+    def test_shared_state_file(self):
+        """Check limiters sharing a state file share the same bucket"""
+        state_file = NamedTemporaryFile(delete=False)
+        state_file.close()
+        os.remove(state_file.name)
+        try:
+            first = RateLimiter(requests_per_second=2, state_file=state_file.name)
+            second = RateLimiter(requests_per_second=2, state_file=state_file.name)
+            self.assertEqual(first.reserve(), 0.0)
+            self.assertEqual(second.reserve(), 0.0)
+            self.assertGreater(first.reserve(), 0.0)
+        finally:
+            os.remove(state_file.name)
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_prefetch_keeps_order(self):
+        """Check items are consumed in order from the background thread"""
+        self.assertEqual(list(prefetch(iter(range(100)), 3)), list(range(100)))
+
+    def test_prefetch_raises(self):
+        """Check exceptions raised while reading reach the caller"""
+
+        def failing():
+            yield 1
+            raise ValueError("bad record")
+
+        with self.assertRaises(ValueError):
+            list(prefetch(failing(), 3))
+
+
+class TestVcfShards(unittest.TestCase):
+    def test_byte_shards_cover_all_records(self):
+        """Check byte range shards split on line boundaries and keep every record once"""
+        with vcf_reader(filename=VARIANTS_VCF_FILE) as reader:
+            expected = [(record.CHROM, record.POS) for record in reader]
+        shards = vcf_shards(VARIANTS_VCF_FILE, 4)
+        self.assertEqual(len(shards), 4)
+        records = []
+        for i, shard in enumerate(shards):
+            with self.subTest(i=i):
+                with vcf_reader(
+                    fsock=open_vcf_shard(VARIANTS_VCF_FILE, shard)
+                ) as reader:
+                    self.assertTrue(reader.samples)
+                    records.extend((record.CHROM, record.POS) for record in reader)
+        self.assertEqual(records, expected)
+
+
+class TestRegions(unittest.TestCase):
+    def test_parse_region(self):
+        for region, expected in (
+            ("chr17:7.5M-7.7M", ("chr17", 7500000, 7700000)),
+            ("chr17:7,500,000-7,700,000", ("chr17", 7500000, 7700000)),
+            ("17:100", ("17", 100, 100)),
+            ("17:100-", ("17", 100, None)),
+            ("chrX", ("chrX", 1, None)),
+        ):
+            with self.subTest(region=region):
+                self.assertEqual(parse_region(region), expected)
+        with self.assertRaises(ValueError):
+            parse_region("chr17:200-100")
+
+    def test_merge_regions(self):
+        """Check regions are sorted in file order, merged and matched with or without chr"""
+        self.assertEqual(
+            merge_regions(
+                ["1", "2", "17"],
+                ["chr17:5-10", "1:100-200", "1:150-300", "1:301-400", "2:5-", "2:9-20"],
+            ),
+            [("1", 100, 400), ("2", 5, None), ("17", 5, 10)],
+        )
+        self.assertEqual(merge_regions(["1"], ["chrY:1-10"]), [])
+
+    @unittest.skipIf(pysam is None, "pysam is not installed")
+    def test_open_vcf_regions(self):
+        """Check only records starting in the regions are read, once and in file order"""
+        with vcf_reader(filename=VARIANTS_VCF_FILE) as reader:
+            records = [(record.CHROM, record.POS) for record in reader]
+        input_vcf_file = NamedTemporaryFile(suffix=".vcf.gz", delete=False)
+        input_vcf_file.close()
+        pysam.tabix_compress(VARIANTS_VCF_FILE, input_vcf_file.name, force=True)
+        pysam.tabix_index(input_vcf_file.name, preset="vcf", force=True)
+        contig, first = records[0]
+        last = records[len(records) // 2][1]
+        regions = ["%s:%s-%s" % (contig, first + 1, last), "%s:%s" % (contig, first)]
+        with vcf_reader(fsock=open_vcf_regions(input_vcf_file.name, regions)) as reader:
+            self.assertEqual(
+                [(record.CHROM, record.POS) for record in reader],
+                [
+                    (chrom, pos)
+                    for chrom, pos in records
+                    if chrom == contig and first <= pos <= last
+                ],
+            )
+        os.remove(input_vcf_file.name)
+        os.remove(input_vcf_file.name + ".tbi")
+
+    @unittest.skipIf(pysam is None, "pysam is not installed")
+    def test_annotate_regions(self):
+        """Check regions of an indexed input are annotated to bgzipped and indexed output"""
+        input_vcf_file = NamedTemporaryFile(suffix=".vcf.gz", delete=False)
+        input_vcf_file.close()
+        pysam.tabix_compress(VARIANTS_VCF_FILE, input_vcf_file.name, force=True)
+        pysam.tabix_index(input_vcf_file.name, preset="vcf", force=True)
+        output_vcf_file = input_vcf_file.name + ".annotated.vcf.gz"
+        with MockVarSomeServer() as server:
+            annotator = BaseVCFAnnotator("key", api_url=server.url, vcf_backend="raw")
+            annotator.annotate(
+                input_vcf_file.name,
+                output_vcf_file,
+                regions=["22:42522392-42523003"],
+                index="csi",
+            )
+        with pysam.TabixFile(
+            output_vcf_file, index=output_vcf_file + ".csi"
+        ) as tabix_file:
+            positions = [int(line.split("\t")[1]) for line in tabix_file.fetch("chr22")]
+        for path in (input_vcf_file.name, output_vcf_file):
+            for suffix in ("", ".tbi", ".csi"):
+                if os.path.isfile(path + suffix):
+                    os.remove(path + suffix)
+        self.assertEqual(annotator.total_variants, 4)
+        self.assertEqual(positions, [42522392, 42522613, 42522755, 42523003])
+
+
+class TestBGZFWriter(unittest.TestCase):
+    def test_blocks(self):
+        """Check the output is gzip readable, ends with the eof block and flush ends a block"""
+        output_file = NamedTemporaryFile(suffix=".gz", delete=False)
+        lines = ["line %s\n" % i for i in range(30000)]
+        with bgzf.BGZFWriter(output_file, threads=2) as writer:
+            for line in lines[:10]:
+                writer.write(line)
+            writer.flush()
+            size = os.path.getsize(output_file.name)
+            for line in lines[10:]:
+                writer.write(line)
+        with gzip.open(output_file.name, "rt") as f:
+            self.assertEqual(f.read(), "".join(lines))
+        with open(output_file.name, "rb") as f:
+            data = f.read()
+        os.remove(output_file.name)
+        self.assertTrue(data.endswith(bgzf.EOF_BLOCK))
+        self.assertEqual(gzip.decompress(data[:size]), "".join(lines[:10]).encode())
+        self.assertEqual(bgzf.compress_block(b""), bgzf.EOF_BLOCK)
+
+
+class TestAnnotationCheckpoint(unittest.TestCase):
+    def test_resume_from_last_complete_checkpoint(self):
+        """Check the last complete checkpoint is loaded and a truncated line is ignored"""
+        journal_file = NamedTemporaryFile(delete=False)
+        journal_file.close()
+        arguments = {"input_vcf_file": VARIANTS_VCF_FILE, "get_parameters": None}
+        journal = AnnotationCheckpoint(journal_file.name, arguments)
+        journal.start()
+        journal.write(records=5, output_size=100)
+        journal.write(records=10, output_size=200)
+        journal.close()
+        with open(journal_file.name, "a") as f:
+            f.write('{"records": 15, "outp')
+        self.assertEqual(
+            AnnotationCheckpoint(journal_file.name, arguments).load(),
+            {"records": 10, "output_size": 200},
+        )
+        with self.assertRaises(RuntimeError):
+            AnnotationCheckpoint(
+                journal_file.name, dict(arguments, get_parameters={"add-all-data": 1})
+            ).load()
+        journal.remove()
+        self.assertIsNone(AnnotationCheckpoint(journal_file.name, arguments).load())
+
+    def test_open_vcf_after(self):
+        """Check records already annotated are skipped and the header is kept"""
+        with vcf_reader(filename=VARIANTS_VCF_FILE) as reader:
+            expected = [(record.CHROM, record.POS) for record in reader][10:]
+        with vcf_reader(fsock=open_vcf_after(VARIANTS_VCF_FILE, 10)) as reader:
+            self.assertTrue(reader.samples)
+            self.assertEqual(
+                [(record.CHROM, record.POS) for record in reader], expected
+            )
+
+
+class TestLazyAnnotatedVariant(unittest.TestCase):
+    result = {
+        "chromosome": "chr7",
+        "pos": 140453136,
+        "ref": "A",
+        "alt": "T",
+        "variant_id": "10190071404531360001",
+        "refseq_transcripts": [
+            {"version": "1", "items": [{"name": "NM_004333", "gene_symbol": "BRAF"}]}
+        ],
+        "gnomad_genomes": [{"version": "2", "af": 0.0001, "an": 31000}],
+        "ncbi_dbsnp": [{"version": "150", "rsid": [113488022]}],
+        "acmg_annotation": {"verdict": {"ACMG_rules": {"verdict": "Pathogenic"}}},
+    }
+
+    def test_same_properties_as_annotated_variant(self):
+        """Check lazy models expose the same values as fully parsed ones"""
+        annotated_variant = AnnotatedVariant(**self.result)
+        lazy_variant = LazyAnnotatedVariant(**self.result)
+        for name in (
+            "genes",
+            "rs_ids",
+            "gnomad_genomes_af",
+            "gnomad_genomes_an",
+            "gnomad_exomes_af",
+            "acmg_verdict",
+            "pos",
+        ):
+            with self.subTest(name=name):
+                self.assertEqual(
+                    getattr(lazy_variant, name), getattr(annotated_variant, name)
+                )
+        self.assertEqual(lazy_variant.to_struct(), annotated_variant.to_struct())
+
+    def test_fields_parsed_on_access(self):
+        """Check only accessed fields are parsed and parsed values are cached"""
+        lazy_variant = LazyAnnotatedVariant(**self.result)
+        gnomad_genomes = LazyAnnotatedVariant.gnomad_genomes
+        refseq_transcripts = LazyAnnotatedVariant.refseq_transcripts
+        self.assertEqual(lazy_variant.gnomad_genomes_af, 0.0001)
+        self.assertIn(lazy_variant._cache_key, gnomad_genomes.memory)
+        self.assertNotIn(lazy_variant._cache_key, refseq_transcripts.memory)
+        self.assertIs(lazy_variant.gnomad_genomes, lazy_variant.gnomad_genomes)
+
+    def test_eager_fallback(self):
+        """Check lazy_model returns the model itself without the jsonmodels internals it needs"""
+        self.assertTrue(lazy._supports_lazy_fields())
+        with mock.patch.object(lazy, "_CacheKey", None):
+            self.assertFalse(lazy._supports_lazy_fields())
+        with mock.patch.object(lazy, "LAZY_FIELDS", False):
+            model = lazy.lazy_model(AnnotatedVariant)
+            self.assertIs(model, AnnotatedVariant)
+            self.assertEqual(model(**self.result).gnomad_genomes_af, 0.0001)
+
+
+class TestCompactVariant(unittest.TestCase):
+    def test_same_properties_as_annotated_variant(self):
+        """Check compact records project the same values as AnnotatedVariant"""
+        result = TestLazyAnnotatedVariant.result
+        annotated_variant = AnnotatedVariant(**result)
+        compact_variant = CompactVariant.from_result(result)
+        for name in CompactVariant.__slots__:
+            with self.subTest(name=name):
+                expected = getattr(annotated_variant, name)
+                if isinstance(expected, list):
+                    expected = tuple(sorted(expected))
+                self.assertEqual(getattr(compact_variant, name), expected)
+
+    def test_read_only(self):
+        """Check compact records cannot be modified and survive pickling"""
+        compact_variant = CompactVariant.from_result({"variant_id": "1", "pos": 10})
+        with self.assertRaises(AttributeError):
+            compact_variant.pos = 11
+        with self.assertRaises(AttributeError):
+            compact_variant.extra = 1
+        self.assertFalse(hasattr(compact_variant, "__dict__"))
+        self.assertEqual(pickle.loads(pickle.dumps(compact_variant)), compact_variant)
+
+    def test_custom_projection(self):
+        """Check custom projections generate records with the requested properties"""
+        record_class = compact_model(
+            "PositionRecord",
+            [
+                ("chromosome", lambda result: result["chromosome"]),
+                ("pos", lambda result: result["pos"]),
+            ],
+        )
+        record = record_class.from_result({"chromosome": "chr1", "pos": 10})
+        self.assertEqual(tuple(record), ("chr1", 10))
+        self.assertEqual(record.to_dict(), {"chromosome": "chr1", "pos": 10})
+
+
+class TestAnnotationTable(unittest.TestCase):
+    results = [
+        TestLazyAnnotatedVariant.result,
+        {"error": "Could not annotate variant"},
+        dict(
+            TestLazyAnnotatedVariant.result,
+            pos=140453137,
+            gnomad_genomes=None,
+            dbnsfp=[{"version": "4", "sift_score": [0.01, None]}],
+        ),
+    ]
+
+    def test_to_columns(self):
+        """Check results become one row per annotated variant with list columns as offsets"""
+        annotation_table = table.to_columns(self.results)
+        self.assertEqual(len(annotation_table), 2)
+        self.assertEqual(list(annotation_table["pos"]), [140453136, 140453137])
+        self.assertEqual(annotation_table["gnomad_genomes_af"][0], 0.0001)
+        self.assertNotEqual(
+            annotation_table["gnomad_genomes_af"][1],
+            annotation_table["gnomad_genomes_af"][1],
+        )
+        self.assertEqual(list(annotation_table["genes"].offsets), [0, 1, 2])
+        self.assertEqual(list(annotation_table["dbnsfp_sift_score"][0]), [])
+        self.assertEqual(len(annotation_table["dbnsfp_sift_score"][1]), 2)
+        filtered = annotation_table.filter([False, True])
+        self.assertEqual(filtered.row(0)["pos"], 140453137)
+
+    def test_missing_int(self):
+        """Check missing ints are None and not mistaken for 0"""
+        results = [dict(self.results[0], pos=0), dict(self.results[0], pos=None)]
+        annotation_table = table.to_columns(results, fields=["pos"])
+        self.assertEqual(list(annotation_table["pos"]), [0, None])
+        if table.numpy is not None:
+            self.assertEqual(
+                list(annotation_table.to_numpy()["pos"].mask), [False, True]
+            )
+        if table.pyarrow is not None:
+            self.assertEqual(
+                annotation_table.to_arrow().column("pos").to_pylist(), [0, None]
+            )
+
+    def test_filter(self):
+        """Check filtering selects the same rows with and without numpy"""
+        annotation_table = table.to_columns(self.results)
+        for numpy in (table.numpy, None):
+            with self.subTest(numpy=numpy is not None):
+                with mock.patch.object(table, "numpy", numpy):
+                    filtered = annotation_table.filter([False, True])
+                self.assertEqual(len(filtered), 1)
+                self.assertEqual(list(filtered["pos"]), [140453137])
+                self.assertEqual(list(filtered["genes"].offsets), [0, 1])
+                self.assertEqual(list(filtered["dbnsfp_sift_score"].offsets), [0, 2])
+                self.assertEqual(filtered["dbnsfp_sift_score"].values[0], 0.01)
+        with self.assertRaises(ValueError):
+            annotation_table.filter([True])
+
+    def test_custom_fields(self):
+        """Check only the requested columns are built"""
+        annotation_table = table.to_columns(
+            self.results,
+            fields=[
+                "variant_id",
+                ("clinvar_stars", "float", lambda result: None),
+            ],
+        )
+        self.assertEqual(annotation_table.names, ["variant_id", "clinvar_stars"])
+
+    @unittest.skipIf(table.numpy is None, "numpy is not installed")
+    def test_to_numpy(self):
+        """Check numeric columns convert to numpy arrays for vectorized filtering"""
+        columns = table.to_columns(self.results).to_numpy()
+        self.assertEqual(int(columns["pos"].sum()), 140453136 + 140453137)
+        self.assertEqual(int(table.numpy.isnan(columns["gnomad_genomes_af"]).sum()), 1)
+        values, offsets = columns["dbnsfp_sift_score"]
+        self.assertEqual(list(offsets), [0, 0, 2])
+
+
+class TestNDJSONSink(unittest.TestCase):
+    def test_gzip_lines(self):
+        """Check one compact json line is written per result"""
+        output_file = NamedTemporaryFile(suffix=".ndjson.gz", delete=False)
+        output_file.close()
+        with output.NDJSONSink(output_file.name) as sink:
+            sink.write_many(
+                [
+                    ("chr7:140453136:A:T", TestLazyAnnotatedVariant.result),
+                    ("chr7:1:A:T", {"error": "Could not annotate variant"}),
+                ]
+            )
+        with gzip.open(output_file.name, "rt") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1], '{"error":"Could not annotate variant"}')
+        self.assertEqual(json.loads(lines[0]), TestLazyAnnotatedVariant.result)
+        os.remove(output_file.name)
+
+
+class TestJSONSink(unittest.TestCase):
+    def test_same_as_json_dump(self):
+        """Check the streamed array is the same as dumping all results at once"""
+        results = [
+            TestLazyAnnotatedVariant.result,
+            {"error": "Could not annotate variant"},
+        ]
+        output_file = NamedTemporaryFile(suffix=".json", delete=False)
+        output_file.close()
+        with output.JSONSink(output_file.name) as sink:
+            sink.write_many(zip(["chr7:140453136:A:T", "chr7:1:A:T"], results))
+        with open(output_file.name) as f:
+            self.assertEqual(
+                f.read(), json.dumps(results, indent=4, sort_keys=True) + "\n"
+            )
+        os.remove(output_file.name)
+
+
+class TestJSONDecoder(unittest.TestCase):
+    def test_iter_json_array(self):
+        """Check array items are decoded the same whichever way the body is split"""
+        results = [
+            TestLazyAnnotatedVariant.result,
+            {"error": 'Could not annotate "chr7:1:A:T" ],{'},
+            [{"variant_id": "1"}, {"variant_id": "2"}],
+            None,
+        ]
+        body = json.dumps(results).encode()
+        for name, loads in decoder.DECODERS.items():
+            for size in (1, 7, len(body)):
+                chunks = (body[i : i + size] for i in range(0, len(body), size))
+                with self.subTest(decoder=name, chunk_size=size):
+                    self.assertEqual(
+                        list(decoder.iter_json_array(chunks, loads)), results
+                    )
+
+    def test_invalid_array(self):
+        for body in (b"", b'{"detail": "Not found"}', b'[{"variant_id": "1"}'):
+            with self.assertRaises(ValueError):
+                list(decoder.iter_json_array([body]))
+        with self.assertRaises(ValueError):
+            decoder.get_decoder("simplejson")
+
+
+class TestRequestCompression(unittest.TestCase):
+    def test_compressed_body(self):
+        """Check batch request bodies are compressed and counted"""
+        json_data = {"variants": ["chr7-140453136-A-T"] * 100}
+        api = VarSomeAPIClient(request_compression="gzip")
+        body, headers = api._encode_body(json_data)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(body)), json_data)
+        stats = api.transfer_stats.stats
+        self.assertEqual(stats["requests"], 1)
+        self.assertEqual(stats["bytes_sent"], len(body))
+        self.assertGreater(stats["body_bytes"], stats["bytes_sent"])
+        self.assertIn("gzip", api.session.headers["Accept-Encoding"])
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(ValueError):
+            VarSomeAPIClient(request_compression="br")
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_pool_grows_with_concurrency(self):
+        api = VarSomeAPIClient()
+        api._ensure_pool_size(32)
+        adapter = api.session.get_adapter(api._api_url)
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertEqual(api.connection_stats["pool_maxsize"], 32)
+        self.assertEqual(api.connection_stats["connections_opened"], 0)
+        # pickled clients, e.g. in annotate_parallel, keep the pool settings
+        self.assertEqual(
+            pickle.loads(pickle.dumps(api))
+            .session.get_adapter(api._api_url)
+            ._pool_maxsize,
+            32,
+        )
+
+    def test_explicit_pool_size(self):
+        api = VarSomeAPIClient(pool_maxsize=4, keep_alive=60, timeout=(5, 300))
+        api._ensure_pool_size(32)
+        adapter = api.session.get_adapter(api._api_url)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertIn(
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            adapter.poolmanager.connection_pool_kw["socket_options"],
+        )
+
+
+class TestRequestMetrics(unittest.TestCase):
+    def notify(self, hooks):
+        api = VarSomeAPIClient(hooks=hooks)
+        batch = {"variants": ["chr7-140453136-A-T", "rs113488022"]}
+        api._request_started("/lookup/batch/hg19", "POST", batch, 1)
+        api._request_finished("/lookup/batch/hg19", "POST", batch, 0.2, 200)
+        api._request_started("/lookup/rs113488022/hg38", "GET", None, 2)
+        api._request_finished(
+            "/lookup/rs113488022/hg38", "GET", None, 0.03, 503, attempt=2
+        )
+
+    def test_endpoint_metrics(self):
+        """Check requests are aggregated per endpoint without the variants in the path"""
+        request_metrics = metrics.RequestMetrics()
+        self.notify([request_metrics])
+        stats = request_metrics.stats
+        self.assertEqual(list(stats["endpoints"]), ["/lookup/batch/hg19", "/lookup"])
+        batch = stats["endpoints"]["/lookup/batch/hg19"]
+        self.assertEqual(
+            (batch["requests"], batch["variants"], batch["errors"]), (1, 2, 0)
+        )
+        self.assertEqual(batch["p50_latency"], 0.25)
+        lookup = stats["endpoints"]["/lookup"]
+        self.assertEqual(
+            (lookup["retries"], lookup["errors"], lookup["variants"]), (1, 1, 0)
+        )
+        self.assertEqual(stats["status_codes"], {200: 1, 503: 1})
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(metrics.request_endpoint("/lookup/schema"), "/lookup/schema")
+
+    def test_invalid_json_finishes_request(self):
+        """Check a response that cannot be decoded still finishes its request"""
+        request_metrics = metrics.RequestMetrics()
+        with MockVarSomeServer() as server:
+            api = VarSomeAPIClient(api_url=server.url, hooks=[request_metrics])
+            # decode a truncated body
+            api.json_loads = lambda content: json.loads(content[:-1])
+            with self.assertRaises(ValueError):
+                api.lookup("chr1-10000-A-G")
+        self.assertEqual(request_metrics.stats["in_flight"], 0)
+        self.assertEqual(request_metrics.stats["status_codes"], {"": 1})
+
+    @unittest.skipIf(async_client.aiohttp is None, "aiohttp is not installed")
+    def test_async_invalid_json_finishes_request(self):
+        request_metrics = metrics.RequestMetrics()
+
+        async def lookup(url):
+            async with async_client.AsyncVarSomeAPIClient(
+                api_url=url, hooks=[request_metrics]
+            ) as api:
+                api.json_loads = lambda content: json.loads(content[:-1])
+                return await api.lookup("chr1-10000-A-G")
+
+        with MockVarSomeServer() as server:
+            with self.assertRaises(ValueError):
+                asyncio.run(lookup(server.url))
+        self.assertEqual(request_metrics.stats["in_flight"], 0)
+
+    @unittest.skipIf(
+        metrics.prometheus_client is None, "prometheus_client is not installed"
+    )
+    def test_prometheus(self):
+        registry = metrics.prometheus_client.CollectorRegistry()
+        self.notify([metrics.PrometheusHooks(registry)])
+        labels = {"endpoint": "/lookup/batch/hg19", "method": "POST"}
+        self.assertEqual(
+            registry.get_sample_value("varsome_api_variants_total", labels), 2
+        )
+        self.assertEqual(
+            registry.get_sample_value(
+                "varsome_api_requests_total", dict(labels, status="200")
+            ),
+            1,
+        )
+        self.assertEqual(
+            registry.get_sample_value(
+                "varsome_api_retries_total", {"endpoint": "/lookup", "method": "GET"}
+            ),
+            1,
+        )
+
+    @unittest.skipIf(
+        metrics.prometheus_client is None, "prometheus_client is not installed"
+    )
+    def test_parallel_requires_picklable_hooks(self):
+        """Check annotate_parallel rejects hooks that cannot be copied to its workers"""
+        registry = metrics.prometheus_client.CollectorRegistry()
+        annotator = VCFAnnotator(hooks=[metrics.PrometheusHooks(registry)])
+        with self.assertRaisesRegex(ValueError, "PrometheusHooks cannot be copied"):
+            annotator.annotate_parallel(VARIANTS_VCF_FILE, processes=2)
+
+
+class TestMockServer(unittest.TestCase):
+    """Hermetic tests against a local stand-in for the api"""
+
+    def test_batch_lookup_with_throttling(self):
+        """Check throttled batch requests are retried until every variant is annotated"""
+        variants = ["chr1-%s-A-G" % pos for pos in range(10000, 10500)]
+        with MockVarSomeServer(throttle_rate=0.3, retry_after=0, seed=1) as server:
+            api = VarSomeAPIClient(
+                "key",
+                api_url=server.url,
+                max_variants_per_batch=50,
+                retry=RetryPolicy(max_attempts=10, backoff_factor=0.01),
+                request_compression="gzip",
+            )
+            results = api.batch_lookup(variants, max_threads=4)
+            self.assertEqual(
+                [result["pos"] for result in results], list(range(10000, 10500))
+            )
+            self.assertIn(429, server.stats["status_codes"])
+            self.assertEqual(server.stats["variants"], 500)
+            self.assertEqual(api.schema(), SCHEMA)
+
+    def test_retry_connection_errors(self):
+        """Check requests that cannot connect are retried and raise a connection error"""
+        with MockVarSomeServer() as server:
+            url = server.url
+        policy = RetryPolicy(max_attempts=3, backoff_factor=0.01)
+        api = VarSomeAPIClient(api_url=url, retry=policy)
+        with self.assertRaises(VarSomeAPIConnectionError):
+            api.lookup("chr1-10000-A-G")
+        self.assertEqual(policy.stats, {"retries": 2, "splits": 0, "failures": 1})
+
+    def test_batch_decoding(self):
+        """Check small batch responses are decoded at once and large ones incrementally"""
+        variants = ["chr1-%s-A-G" % pos for pos in range(10000, 10100)]
+        with MockVarSomeServer(compress_responses=True) as server:
+            api = VarSomeAPIClient(api_url=server.url)
+            with mock.patch(
+                "varsome_api.client.iter_json_array", wraps=decoder.iter_json_array
+            ) as iter_json_array:
+                results = api.batch_lookup(variants)
+                self.assertFalse(iter_json_array.called)
+                api.incremental_decode_size = 100
+                self.assertEqual(api.batch_lookup(variants), results)
+                self.assertTrue(iter_json_array.called)
+        self.assertEqual(
+            [result["pos"] for result in results], list(range(10000, 10100))
+        )
+
+    def test_unknown_ref_genome(self):
+        """Check lookups and batches with an unknown reference genome raise a 404"""
+        with MockVarSomeServer() as server:
+            api = VarSomeAPIClient(api_url=server.url)
+            with self.assertRaises(VarSomeAPIException) as ve:
+                api.lookup("chrM:410:A:T", ref_genome="hg64")
+            self.assertEqual(ve.exception.status, 404)
+            with self.assertRaises(VarSomeAPIException) as ve:
+                api.batch_lookup(
+                    ["chrM:410:A:T"], ref_genome="hg64", raise_exceptions=True
+                )
+            self.assertEqual(ve.exception.status, 404)
+            self.assertEqual(api.lookup("chrM:410:A:T", ref_genome="hg38")["pos"], 410)
+
+    def test_fixtures_replay(self):
+        """Check recorded responses are replayed, as is or with the coordinates of the query"""
+        recorded = TestLazyAnnotatedVariant.result
+        with MockVarSomeServer(fixtures=[recorded], compress_responses=True) as server:
+            api = VarSomeAPIClient(api_url=server.url)
+            self.assertEqual(api.lookup("7:140453136:A:T"), recorded)
+            result = api.lookup("chr1-10000-A-G", ref_genome="hg38")
+            self.assertEqual((result["pos"], result["alt"]), (10000, "G"))
+            self.assertEqual(result["gnomad_genomes"], recorded["gnomad_genomes"])
+
+    @unittest.skipIf(async_client.aiohttp is None, "aiohttp is not installed")
+    def test_async_sqlite_cache(self):
+        """Check the asyncio client caches batches in an SQLiteCache and counts connections"""
+        variants = ["chr1-%s-A-G" % pos for pos in range(10000, 10020)]
+        cache_file = NamedTemporaryFile(suffix=".sqlite", delete=False)
+        cache_file.close()
+
+        async def batch_lookup(url):
+            async with async_client.AsyncVarSomeAPIClient(
+                "key",
+                api_url=url,
+                max_variants_per_batch=5,
+                cache=SQLiteCache(cache_file.name),
+            ) as client:
+                first = await client.batch_lookup(variants)
+                second = await client.batch_lookup(variants)
+                return first, second, client.connection_stats
+
+        with MockVarSomeServer() as server:
+            first, second, stats = asyncio.run(batch_lookup(server.url))
+            self.assertEqual(server.stats["variants"], 20)
+        os.remove(cache_file.name)
+        self.assertEqual(first, second)
+        self.assertEqual(stats["requests"], 4)
+        self.assertGreaterEqual(stats["connections_opened"], 1)
+
+    @unittest.skipIf(async_client.aiohttp is None, "aiohttp is not installed")
+    @unittest.skipIf(os.name != "posix", "requires fcntl")
+    def test_async_shared_rate_limiter(self):
+        """Check the asyncio client locks a shared rate limiter state file off the event loop"""
+        state_file = NamedTemporaryFile(delete=False)
+        state_file.close()
+        limiter = RateLimiter(requests_per_second=100, state_file=state_file.name)
+        reserve = limiter.reserve
+        threads = []
+
+        def record_thread(variants):
+            threads.append(threading.get_ident())
+            return reserve(variants)
+
+        limiter.reserve = record_thread
+
+        async def lookup(url):
+            async with async_client.AsyncVarSomeAPIClient(
+                "key", api_url=url, rate_limiter=limiter
+            ) as client:
+                return await client.lookup("chr1-10000-A-G"), threading.get_ident()
+
+        with MockVarSomeServer() as server:
+            result, loop_thread = asyncio.run(lookup(server.url))
+        os.remove(state_file.name)
+        self.assertEqual(result["pos"], 10000)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+
+    def test_annotate_vcf(self):
+        """Check that we can annotate a vcf file without network access"""
+        output_vcf_file = NamedTemporaryFile(delete=False)
+        output_vcf_file.close()
+        with MockVarSomeServer(payload_size=2000) as server:
+            annotator = VCFAnnotator("key", api_url=server.url, max_threads=2)
+            annotator.annotate(VARIANTS_VCF_FILE, output_vcf_file.name)
+        with vcf_reader(
+            filename=output_vcf_file.name, strict_whitespace=True
+        ) as reader:
+            self.assertEqual(
+                [record.INFO["gnomad_genomes_AN"] for record in reader],
+                [[31000]] * annotator.total_variants,
+            )
+        os.remove(output_vcf_file.name)
+
+
+class TestRecordAssembly(unittest.TestCase):
+    records = [
+        "1\t100\trs9\tA\tG,C\t.\tPASS\tAC=1,2",
+        "1\t100\t.\tA\tG\t.\tPASS\t.",
+        "1\t200\t.\tA\tT,<DEL>\t.\tPASS\tAC=3,4",
+        "1\t300\t.\tA\t<DEL>\t.\tPASS\t.",
+    ]
+
+    def test_records_written_once(self):
+        """Check every input record is written once with one value per ALT sequence"""
+        input_vcf_file = NamedTemporaryFile("w", suffix=".vcf", delete=False)
+        input_vcf_file.write(
+            "##fileformat=VCFv4.1\n"
+            '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n'
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+            + "\n".join(self.records)
+            + "\n"
+        )
+        input_vcf_file.close()
+        output_vcf_file = input_vcf_file.name + ".annotated.vcf"
+        with MockVarSomeServer() as server:
+            annotator = BaseVCFAnnotator("key", api_url=server.url)
+            annotator.annotate(input_vcf_file.name, output_vcf_file)
+        with vcf_reader(filename=output_vcf_file, strict_whitespace=True) as reader:
+            records = list(reader)
+        os.remove(input_vcf_file.name)
+        os.remove(output_vcf_file)
+        self.assertEqual(
+            [(record.POS, len(record.ALT)) for record in records],
+            [(100, 2), (100, 1), (200, 2)],
+        )
+        self.assertEqual(records[0].INFO["AC"], [1, 2])
+        self.assertEqual(
+            records[0].INFO["original_variant"], ["1:100:A:G", "1:100:A:C"]
+        )
+        self.assertEqual(records[0].ID, "rs9;rs100")
+        self.assertEqual(
+            records[1].INFO["variant_id"], records[0].INFO["variant_id"][:1]
+        )
+        # the mock server can't annotate the symbolic allele
+        self.assertEqual(records[2].INFO["original_variant"], ["1:200:A:T", None])
+        # records without any annotated ALT sequence are left out
+        self.assertEqual(annotator.variants_with_errors, 2)
+
+
+class TestRawVcf(unittest.TestCase):
+    header = (
+        "##fileformat=VCFv4.1\n"
+        '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n'
+        '##INFO=<ID=DB,Number=0,Type=Flag,Description="dbSNP membership">\n'
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+        "##contig=<ID=1>\n"
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"
+    )
+    records = [
+        "1\t100\trs9\tA\tG,C\t50\tPASS\tAC=1,2;DB\tGT\t0/1\t1/2",
+        "1\t100\t.\tA\tG\t.\tPASS\t.\tGT\t0/0\t./.",
+        "1\t200\t.\tA\tT,<DEL>\t.\tPASS\tAC=3,4\tGT\t1/2\t0/1",
+    ]
+
+    def test_raw_record(self):
+        """Check only the info fields set are written in place of the input ones"""
+        record = raw_vcf.RawRecord(self.records[0] + "\n")
+        self.assertEqual((record.CHROM, record.POS, record.ID), ("1", 100, "rs9"))
+        self.assertEqual(record.ALT, ["G", "C"])
+        self.assertEqual(record.INFO["AC"], ["1", "2"])
+        self.assertTrue(record.INFO["DB"])
+        self.assertNotIn("gene", record.INFO)
+        record.INFO["AC"] = [3, 4]
+        record.INFO["gene"] = ["A", None]
+        del record.INFO["DB"]
+        self.assertNotIn("DB", record.INFO)
+        stream = io.StringIO()
+        template = vcf.Reader(io.StringIO(self.header))
+        template.infos["gene"] = _Info(
+            "gene", "A", "String", "Gene", None, None, _encode_type("String")
+        )
+        raw_vcf.VCFWriter(stream, template).write_record(record)
+        self.assertEqual(
+            stream.getvalue().splitlines()[-1],
+            "1\t100\trs9\tA\tG,C\t50\tPASS\tAC=3,4;gene=A,.\tGT\t0/1\t1/2",
+        )
+
+    def _annotate(self, backend, records=None):
+        input_vcf_file = NamedTemporaryFile("w", suffix=".vcf", delete=False)
+        input_vcf_file.write(self.header + "\n".join(records or self.records) + "\n")
+        input_vcf_file.close()
+        output_vcf_file = input_vcf_file.name + ".annotated.vcf"
+        with MockVarSomeServer() as server:
+            annotator = BaseVCFAnnotator("key", api_url=server.url, vcf_backend=backend)
+            annotator.annotate(input_vcf_file.name, output_vcf_file)
+        with open(output_vcf_file) as f:
+            lines = [line for line in f if not line.startswith("##")]
+        os.remove(input_vcf_file.name)
+        os.remove(output_vcf_file)
+        return lines
+
+    def test_raw_backend(self):
+        """Check the raw backend writes the same vcf file as pyvcf"""
+        lines = self._annotate("raw")
+        self.assertEqual(lines, self._annotate("pyvcf"))
+        self.assertTrue(lines[1].endswith("\tGT\t0/1\t1/2\n"))
+
+    @unittest.skipIf(raw_vcf.cyvcf2 is None, "cyvcf2 is not installed")
+    def test_cyvcf2_backend(self):
+        """Check the cyvcf2 backend writes the same vcf file as pyvcf"""
+        self.assertEqual(self._annotate("cyvcf2"), self._annotate("pyvcf"))
+
+    @unittest.skipIf(raw_vcf.cyvcf2 is None, "cyvcf2 is not installed")
+    def test_cyvcf2_rewrites_records(self):
+        """Check the raw backend keeps the input text and cyvcf2 writes it as htslib formats it"""
+        records = [self.records[0].replace("\t50\t", "\t50.00\t")]
+        self.assertIn("\t50.00\t", self._annotate("raw", records)[1])
+        self.assertIn("\t50\t", self._annotate("cyvcf2", records)[1])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            BaseVCFAnnotator("key", vcf_backend="htslib")
+
+
+class TestDeduplication(unittest.TestCase):
+    variants = [
+        "chr1-10000-A-G",
+        "1:10000:a:g",
+        "chr1-10001-A-G",
+        "rs113488022",
+        "RS113488022",
+        "1-10000-A-G",
+    ]
+
+    def test_chunks_of_distinct_variants(self):
+        """Check chunks are filled with distinct variants and duplicates ride along"""
+        self.assertEqual(
+            [len(chunk) for chunk in chunked_variants(self.variants, 2)], [3, 3]
+        )
+
+    def test_batch_lookup_fan_out(self):
+        """Check every distinct variant is requested once and its result returned for every duplicate"""
+        with MockVarSomeServer() as server:
+            api = VarSomeAPIClient("key", api_url=server.url)
+            results = api.batch_lookup(self.variants)
+            self.assertEqual(server.stats["variants"], 3)
+        self.assertEqual(len(results), len(self.variants))
+        self.assertIs(results[0], results[1])
+        self.assertIs(results[0], results[5])
+        self.assertEqual(results[2]["pos"], 10001)
+        self.assertIs(results[3], results[4])
+
+    def test_missing_result(self):
+        """Check a batch response with fewer results than variants raises"""
+        with MockVarSomeServer() as server:
+            for cache in (None, MemoryCache()):
+                with self.subTest(cache=cache):
+                    api = VarSomeAPIClient("key", api_url=server.url, cache=cache)
+                    post = api.post
+                    with mock.patch.object(
+                        api, "post", side_effect=lambda *args: post(*args)[:-1]
+                    ):
+                        with self.assertRaisesRegex(
+                            VarSomeAPIException, "2 results for 3 variants"
+                        ):
+                            api.batch_lookup(self.variants)
+
+    @unittest.skipIf(async_client.aiohttp is None, "aiohttp is not installed")
+    def test_async_batch_lookup_fan_out(self):
+        async def batch_lookup(url):
+            async with async_client.AsyncVarSomeAPIClient("key", api_url=url) as api:
+                return await api.batch_lookup(self.variants)
+
+        with MockVarSomeServer() as server:
+            results = asyncio.run(batch_lookup(server.url))
+            self.assertEqual(server.stats["variants"], 3)
+        self.assertEqual(
+            [result["pos"] for result in results[:3]], [10000, 10000, 10001]
+        )
+
+
+class KeylessClient(VarSomeAPIClient):
+    def lookup(self, query, params=None, ref_genome=None):
+        if query == "fail":
+            raise VarSomeAPIException(404, "Not found")
+        time.sleep(0.01 if query == 0 else 0)
+        return {"variant_id": query}
+
+
+class TestIterLookup(unittest.TestCase):
+    def test_ordered_results(self):
+        """Check single lookups are yielded in input order with errors in place"""
+        api = KeylessClient()
+        queries = [0, 1, "fail", 3]
+        results = list(api.iter_lookup(iter(queries), max_threads=2))
+        self.assertEqual([query for query, _ in results], queries)
+        self.assertEqual(results[1][1], {"variant_id": 1})
+        self.assertIn("error", results[2][1])
+        with self.assertRaises(VarSomeAPIException):
+            list(api.iter_lookup(queries, raise_exceptions=True))
+
+
+@unittest.skipIf(output.pyarrow is None, "pyarrow is not installed")
+class TestArrowSink(unittest.TestCase):
+    def test_parquet_row_groups(self):
+        """Check results are written in row groups with a schema derived from AnnotatedVariant"""
+        output_file = NamedTemporaryFile(suffix=".parquet", delete=False)
+        output_file.close()
+        with output.ArrowSink(output_file.name, row_group_size=2) as sink:
+            sink.write("chr7:140453136:A:T", TestLazyAnnotatedVariant.result)
+            sink.write("chr7:1:A:T", {"error": "Could not annotate variant"})
+            sink.write_many([("rs113488022", [TestLazyAnnotatedVariant.result] * 2)])
+        parquet_file = output.pyarrow.parquet.ParquetFile(output_file.name)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        rows = parquet_file.read().to_pylist()
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]["gnomad_genomes"][0]["af"], 0.0001)
+        self.assertEqual(
+            rows[0]["acmg_annotation"]["verdict"]["ACMG_rules"]["verdict"],
+            "Pathogenic",
+        )
+        self.assertEqual(rows[1]["error"], "Could not annotate variant")
+        self.assertIsNone(rows[1]["variant_id"])
+        self.assertEqual(rows[3]["query"], "rs113488022")
+        os.remove(output_file.name)
+
+
 class VCFAnnotator(BaseVCFAnnotator):
     def annotate_record(self, record, variant_result, original_variant):
         record.INFO["gnomad_genomes_AN"] = variant_result.gnomad_genomes_an
@@ -163,3 +1365,18 @@ class TestVcfAnnotator(unittest.TestCase):
                 with self.subTest(i=i):
                     self.assertTrue("gnomad_genomes_AN" in record.INFO)
         self.annotator.session.close()
+
+    def test_annotate_vcf_parallel(self):
+        """Check that annotating in several processes gives the same vcf file"""
+        output_vcf_file = NamedTemporaryFile(delete=False)
+        output_vcf_file.close()
+        parallel_output_vcf_file = NamedTemporaryFile(delete=False)
+        parallel_output_vcf_file.close()
+        self.annotator.annotate(VARIANTS_VCF_FILE, output_vcf_file.name)
+        self.annotator.annotate_parallel(
+            VARIANTS_VCF_FILE, parallel_output_vcf_file.name, processes=3
+        )
+        with open(output_vcf_file.name) as expected:
+            with open(parallel_output_vcf_file.name) as result:
+                self.assertEqual(expected.read(), result.read())
+        self.annotator.session.close()
@@ -0,0 +1,176 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+
+class AdaptiveBatchController(object):
+    """
+    Tunes batch size and the number of in flight batch requests using additive increase /
+    multiplicative decrease. Every successful batch that completes within target_latency
+    grows the batch size by batch_size_step and the concurrency by roughly one request per
+    window of requests. A throttled or failed request (429, 502, 503, 504, timeouts and
+    connection errors) halves both, at most once per window so that a burst of failures is only
+    counted once. Other errors leave them as they are. Slow or oversized responses shrink the
+    batch size only
+    """
+
+    congestion_statuses = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        batch_size=200,
+        min_batch_size=10,
+        max_batch_size=3000,
+        batch_size_step=50,
+        concurrency=2,
+        min_concurrency=1,
+        max_concurrency=16,
+        target_latency=30.0,
+        max_response_bytes=None,
+        decrease_factor=0.5,
+    ):
+        """
+        :param batch_size: initial number of variants per batch request
+        :param min_batch_size: lower bound for the batch size
+        :param max_batch_size: upper bound for the batch size
+        :param batch_size_step: variants added to the batch size after every fast successful batch
+        :param concurrency: initial number of batch requests in flight
+        :param min_concurrency: lower bound for the concurrency
+        :param max_concurrency: upper bound for the concurrency
+        :param target_latency: seconds above which a batch is considered too slow
+        :param max_response_bytes: optional upper bound for the size of a batch response
+        :param decrease_factor: multiplier applied on congestion
+        """
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size_step = batch_size_step
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_response_bytes = max_response_bytes
+        self.decrease_factor = decrease_factor
+        self._batch_size = float(
+            self._clamp(batch_size, min_batch_size, max_batch_size)
+        )
+        self._concurrency = float(
+            self._clamp(concurrency, min_concurrency, max_concurrency)
+        )
+        self._bytes_per_variant = None
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.total_latency = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clamp(value, lower, upper):
+        return max(lower, min(upper, value))
+
+    @property
+    def batch_size(self):
+        return int(self._batch_size)
+
+    @property
+    def concurrency(self):
+        return int(self._concurrency)
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary with the current settings and request counters
+        """
+        return {
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "average_latency": (
+                self.total_latency / self.requests if self.requests else None
+            ),
+        }
+
+    def record(
+        self, variants, elapsed, status=200, response_bytes=None, transient=False
+    ):
+        """
+        Feed the outcome of a batch request to the controller
+        :param variants: number of variants in the request
+        :param elapsed: seconds the request took
+        :param status: http status code or an empty string if no response was received
+        :param response_bytes: size of the response body if known
+        :param transient: the request timed out or could not connect, see
+        VarSomeAPIException.transient
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            self.total_latency += elapsed
+            if transient or status in self.congestion_statuses:
+                self.throttled += 1
+                # requests started before the last decrease belong to the same window
+                if now - elapsed >= self._last_decrease:
+                    self._batch_size = max(
+                        self.min_batch_size, self._batch_size * self.decrease_factor
+                    )
+                    self._concurrency = max(
+                        self.min_concurrency, self._concurrency * self.decrease_factor
+                    )
+                    self._last_decrease = now
+                return
+            if status == "" or status >= 400:
+                # client errors and responses that cannot be read say nothing about
+                # the server load
+                self.errors += 1
+                return
+            if response_bytes and variants:
+                bytes_per_variant = response_bytes / float(variants)
+                if self._bytes_per_variant is None:
+                    self._bytes_per_variant = bytes_per_variant
+                else:
+                    self._bytes_per_variant = (
+                        0.8 * self._bytes_per_variant + 0.2 * bytes_per_variant
+                    )
+            if elapsed > self.target_latency:
+                self._batch_size = max(
+                    self.min_batch_size, self._batch_size * self.decrease_factor
+                )
+            else:
+                self._batch_size = min(
+                    self.max_batch_size, self._batch_size + self.batch_size_step
+                )
+                self._concurrency = min(
+                    self.max_concurrency, self._concurrency + 1.0 / self._concurrency
+                )
+            if self.max_response_bytes and self._bytes_per_variant:
+                self._batch_size = self._clamp(
+                    min(
+                        self._batch_size,
+                        self.max_response_bytes / self._bytes_per_variant,
+                    ),
+                    self.min_batch_size,
+                    self.max_batch_size,
+                )
@@ -0,0 +1,507 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from collections import OrderedDict
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from varsome_api.cache import BaseCache, normalize_variant
+from varsome_api.client import (
+    VarSomeAPIClient,
+    VarSomeAPIClientBase,
+    VarSomeAPIConnectionError,
+    VarSomeAPIException,
+    chunked_variants,
+)
+from varsome_api.retry import parse_retry_after
+
+
+async def achunked_variants(variants, size):
+    """
+    Lazily split a sync or async iterable of variants into lists holding at most size distinct
+    variants, see chunked_variants
+    :param variants: any iterable or async iterable of variant representations
+    :param size: maximum number of distinct variants per chunk
+    :return: async generator of lists
+    """
+    if not hasattr(variants, "__aiter__"):
+        for chunk in chunked_variants(variants, size):
+            yield chunk
+        return
+    chunk = []
+    seen = set()
+    async for variant in variants:
+        seen.add(normalize_variant(variant))
+        chunk.append(variant)
+        if len(seen) >= size:
+            yield chunk
+            chunk = []
+            seen = set()
+    if chunk:
+        yield chunk
+
+
+class AsyncVarSomeAPIClientBase(VarSomeAPIClientBase):
+    """
+    Base asyncio client. All requests share a single aiohttp connection pool
+    and at most max_concurrent_requests requests are in flight at any time
+    """
+
+    def __init__(
+        self,
+        api_key=None,
+        logger=None,
+        api_url=None,
+        max_concurrent_requests=10,
+        cache=None,
+        retry=None,
+        rate_limiter=None,
+        json_decoder=None,
+        request_compression=None,
+        timeout=None,
+        hooks=None,
+    ):
+        """
+        :param timeout: seconds to wait for the server, either a single value or a (connect, read) tuple.
+        None for the aiohttp defaults
+        :param hooks: optional list of varsome_api.metrics.RequestHooks instances notified when
+        every request starts and finishes
+        """
+        if aiohttp is None:
+            raise RuntimeError(
+                "aiohttp is required for the asyncio client. "
+                "Install it with pip install varsome_api_client[async]"
+            )
+        self.max_concurrent_requests = max_concurrent_requests
+        self._semaphore = None
+        # connections opened and requests made by the current session
+        self._connection_counts = [0, 0]
+        super(AsyncVarSomeAPIClientBase, self).__init__(
+            api_key,
+            logger,
+            api_url,
+            cache,
+            retry,
+            rate_limiter,
+            json_decoder,
+            request_compression,
+            timeout,
+            hooks=hooks,
+        )
+
+    def _create_session(self):
+        # aiohttp sessions must be created within a running event loop
+        return None
+
+    @property
+    def connection_stats(self):
+        """
+        :return: dictionary with the pool size and the number of connections opened and reused
+        """
+        opened, requested = self._connection_counts
+        return {
+            "pool_maxsize": self.max_concurrent_requests,
+            "requests": requested,
+            "connections_opened": opened,
+            "connections_reused": max(requested - opened, 0),
+        }
+
+    def _trace_config(self):
+        counts = self._connection_counts
+
+        async def on_connection_create_end(session, context, params):
+            counts[0] += 1
+
+        async def on_request_start(session, context, params):
+            counts[1] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_request_start.append(on_request_start)
+        return trace_config
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent_requests)
+            # aiohttp negotiates the response encodings it is able to decode itself
+            headers = dict(self._headers)
+            del headers["Accept-Encoding"]
+            options = {}
+            if self.timeout is not None:
+                connect, read = (
+                    self.timeout
+                    if isinstance(self.timeout, tuple)
+                    else (self.timeout, self.timeout)
+                )
+                options["timeout"] = aiohttp.ClientTimeout(
+                    sock_connect=connect, sock_read=read
+                )
+            self.session = aiohttp.ClientSession(
+                headers=headers,
+                connector=connector,
+                trace_configs=[self._trace_config()],
+                **options,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def __aenter__(self):
+        self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _make_request(self, path, method="GET", params=None, json_data=None):
+        if method not in self._accepted_methods:
+            raise VarSomeAPIException("", "Unsupported method %s" % method)
+        if method == "POST" and json_data is None:
+            raise RuntimeError("You need to provide a post request body")
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.rate_limiter is not None:
+                variants = len(json_data["variants"]) if json_data is not None else 1
+                if self.rate_limiter.state_file is None:
+                    wait = self.rate_limiter.reserve(variants)
+                else:
+                    # the state file is locked and read, possibly while another process holds it
+                    wait = await self._run_blocking(self.rate_limiter.reserve, variants)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self._request_started(path, method, json_data, attempt)
+            # includes the time waiting for one of the max_concurrent_requests slots
+            start = time.monotonic()
+            try:
+                result, bytes_sent, bytes_received = await self._send_request(
+                    path, method, params, json_data
+                )
+            except VarSomeAPIException as e:
+                self._request_finished(
+                    path,
+                    method,
+                    json_data,
+                    time.monotonic() - start,
+                    e.status,
+                    attempt=attempt,
+                    error=e,
+                )
+                if self.retry is None or not self.retry.should_retry(e, attempt):
+                    raise
+                delay = self.retry.get_delay(attempt, e.retry_after)
+                self.logger.warning(
+                    "Request to %s failed with %s. Retrying in %.2f seconds"
+                    % (path, e, delay)
+                )
+                await asyncio.sleep(delay)
+                continue
+            except (Exception, asyncio.CancelledError):
+                # e.g. a body that is not valid json or a cancelled task, the request still
+                # has to be finished
+                self._request_finished(
+                    path,
+                    method,
+                    json_data,
+                    time.monotonic() - start,
+                    "",
+                    attempt=attempt,
+                )
+                raise
+            self._request_finished(
+                path,
+                method,
+                json_data,
+                time.monotonic() - start,
+                200,
+                attempt=attempt,
+                bytes_sent=bytes_sent,
+                bytes_received=bytes_received,
+            )
+            return result
+
+    async def _send_request(self, path, method="GET", params=None, json_data=None):
+        """
+        :return: tuple of the decoded json response, the request and the response body sizes
+        """
+        session = self._get_session()
+        try:
+            if method == "POST":
+                body, headers = self._encode_body(json_data)
+            else:
+                body, headers = None, None
+                self.transfer_stats.record_request(0, 0)
+            async with self._semaphore:
+                async with session.request(
+                    method,
+                    self._api_url + path,
+                    params=params,
+                    data=body,
+                    headers=headers,
+                ) as r:
+                    if r.status >= 400:
+                        if r.status in VarSomeAPIException.ERROR_CODES:
+                            error_message = "Unexpected error"
+                            if r.content_type == "application/json":
+                                error_message = (await r.json()).get("detail", None)
+                            raise VarSomeAPIException(
+                                r.status,
+                                error_message,
+                                parse_retry_after(r.headers.get("Retry-After")),
+                            )
+                        raise VarSomeAPIException(
+                            "", "Unknown http error %s %s" % (r.status, r.reason)
+                        )
+                    content = await r.read()
+                    # aiohttp decompresses transparently, so only the announced
+                    # length tells the size on the wire
+                    bytes_received = self._content_length(r) or len(content)
+                    self.transfer_stats.record_response(bytes_received, len(content))
+                    return (
+                        self.json_loads(content),
+                        len(body) if body is not None else 0,
+                        bytes_received,
+                    )
+        except asyncio.TimeoutError as e:
+            raise VarSomeAPIConnectionError("", "Request timed out %s" % e)
+        except aiohttp.ClientConnectionError as e:
+            raise VarSomeAPIConnectionError(
+                "", "Connection failure or connection refused %s" % e
+            )
+        except aiohttp.ClientError as e:
+            raise VarSomeAPIException("", "Unknown error %s" % e)
+
+    async def get(self, path, params=None):
+        return await self._make_request(path, "GET", params=params)
+
+    async def _run_blocking(self, func, *args):
+        """
+        Run a blocking call, e.g. to an SQLiteCache, in the default executor so that it does
+        not block the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _cached_get(self, key, path, params=None):
+        if self.cache is None:
+            return await self.get(path, params=params)
+        result = await self._run_blocking(self.cache.get, key)
+        if result is None:
+            result = await self.get(path, params=params)
+            if self.cache.is_cacheable(result):
+                await self._run_blocking(self.cache.set, key, result)
+        return result
+
+    async def _asplit_chunk(self, queries, ref_genome, params):
+        if self.cache is None:
+            return self._split_chunk(queries, ref_genome, params)
+        return await self._run_blocking(self._split_chunk, queries, ref_genome, params)
+
+    async def _amerge_chunk(self, chunk, results):
+        if self.cache is None:
+            return self._merge_chunk(chunk, results)
+        return await self._run_blocking(self._merge_chunk, chunk, results)
+
+    async def post(self, path, params=None, json_data=None, raise_exceptions=True):
+        # handle api errors in batch requests.
+        try:
+            return await self._make_request(
+                path, "POST", params=params, json_data=json_data
+            )
+        except VarSomeAPIException as e:
+            variants = json_data.get("variants")
+            if self.retry is not None and self.retry.should_split(e, variants):
+                half = len(variants) // 2
+                self.logger.warning(
+                    "Splitting failed batch of %s variants in half" % len(variants)
+                )
+                return await self.post(
+                    path,
+                    params,
+                    dict(json_data, variants=variants[:half]),
+                    raise_exceptions,
+                ) + await self.post(
+                    path,
+                    params,
+                    dict(json_data, variants=variants[half:]),
+                    raise_exceptions,
+                )
+            if raise_exceptions:
+                raise e
+            self.logger.error(e)
+            return [
+                {
+                    "error": "Could not annotate variant %s because "
+                    "request failed with %s" % (variant, e)
+                }
+                for variant in json_data["variants"]
+            ]
+
+
+class AsyncVarSomeAPIClient(AsyncVarSomeAPIClientBase):
+    """
+    asyncio counterpart of VarSomeAPIClient. Use it as an async context manager
+    or call close when done so that the connection pool is released
+
+        async with AsyncVarSomeAPIClient(api_key) as api:
+            results = await api.batch_lookup(variants, ref_genome="hg38")
+    """
+
+    schema_lookup_path = VarSomeAPIClient.schema_lookup_path
+    lookup_path = VarSomeAPIClient.lookup_path
+    ref_genome_lookup_path = VarSomeAPIClient.ref_genome_lookup_path
+    batch_lookup_path = VarSomeAPIClient.batch_lookup_path
+    query_is_variant_id = staticmethod(VarSomeAPIClient.query_is_variant_id)
+
+    def __init__(
+        self,
+        api_key=None,
+        logger=None,
+        api_url=None,
+        max_variants_per_batch=200,
+        max_concurrent_requests=10,
+        cache=None,
+        retry=None,
+        rate_limiter=None,
+        json_decoder=None,
+        request_compression=None,
+        timeout=None,
+        hooks=None,
+    ):
+        super(AsyncVarSomeAPIClient, self).__init__(
+            api_key,
+            logger,
+            api_url,
+            max_concurrent_requests,
+            cache,
+            retry,
+            rate_limiter,
+            json_decoder,
+            request_compression,
+            timeout,
+            hooks,
+        )
+        self.max_variants_per_batch = max_variants_per_batch
+
+    async def schema(self):
+        return await self._cached_get(
+            BaseCache.make_key(self.schema_lookup_path), self.schema_lookup_path
+        )
+
+    async def lookup(self, query, params=None, ref_genome=None):
+        """
+
+        :param query: variant representation
+        :param params: dictionary of key value pairs for http GET parameters. Refer to the api documentation
+        of https://api.varsome.com for examples
+        :param ref_genome: reference genome (hg19 or hg38 or None) default for requests with no ref genome is hg19
+        :return:dictionary of annotations. refer to https://api.varsome.com/lookup/schema for dictionary properties
+        """
+        url = self.lookup_path % query
+        if ref_genome is not None and not self.query_is_variant_id(query):
+            url = self.ref_genome_lookup_path % (query, ref_genome)
+        return await self._cached_get(
+            BaseCache.make_key(query, ref_genome, params), url, params=params
+        )
+
+    async def batch_lookup(
+        self, variants, params=None, ref_genome="hg19", raise_exceptions=False
+    ):
+        """
+
+        :param variants: list of variant representations
+        :param params: dictionary of key value pairs for http GET parameters. Refer to the api documentation
+        of https://api.varsome.com for examples
+        :param ref_genome: reference genome (hg19 or hg38)
+        :param raise_exceptions: If a post request should raise an exception True, thus terminating the whole
+        process or if it should proceed to let the process continue
+        :return: list of dictionaries with annotations per variant refer to https://api.varsome.com/lookup/schema
+        for dictionary properties
+        """
+        return [
+            result
+            async for _, result in self.iter_batch_lookup(
+                variants,
+                params=params,
+                ref_genome=ref_genome,
+                raise_exceptions=raise_exceptions,
+            )
+        ]
+
+    async def iter_batch_lookup(
+        self,
+        variants,
+        params=None,
+        ref_genome="hg19",
+        raise_exceptions=False,
+        max_pending_chunks=None,
+        ordered=True,
+    ):
+        """
+        Streaming version of batch_lookup. Variants are consumed lazily and only a bounded number
+        of chunks is kept in flight, so memory depends on the window size and not the input size
+
+        :param variants: any iterable or async iterable of variant representations
+        :param params: dictionary of key value pairs for http GET parameters. Refer to the api documentation
+        of https://api.varsome.com for examples
+        :param ref_genome: reference genome (hg19 or hg38)
+        :param raise_exceptions: If a post request should raise an exception True, thus terminating the whole
+        process or if it should proceed to let the process continue
+        :param max_pending_chunks: maximum number of chunks submitted but not yet yielded.
+        Defaults to twice max_concurrent_requests
+        :param ordered: if True results are yielded in input order, otherwise as soon as each chunk completes
+        :return: async generator of (input variant, annotation dictionary) tuples
+        """
+        max_pending_chunks = max_pending_chunks or self.max_concurrent_requests * 2
+        path = self.batch_lookup_path % ref_genome
+        pending = OrderedDict()
+        try:
+            async for queries in achunked_variants(
+                variants, self.max_variants_per_batch
+            ):
+                chunk, misses = await self._asplit_chunk(queries, ref_genome, params)
+                if misses:
+                    task = asyncio.ensure_future(
+                        self.post(path, params, {"variants": misses}, raise_exceptions)
+                    )
+                else:
+                    task = asyncio.get_running_loop().create_future()
+                    task.set_result([])
+                pending[task] = chunk
+                if len(pending) >= max_pending_chunks:
+                    for pair in await self._pop_completed(pending, ordered):
+                        yield pair
+            while pending:
+                for pair in await self._pop_completed(pending, ordered):
+                    yield pair
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _pop_completed(self, pending, ordered):
+        if ordered:
+            task, chunk = pending.popitem(last=False)
+            return await self._amerge_chunk(chunk, await task)
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pairs = []
+        for task in done:
+            pairs.extend(await self._amerge_chunk(pending.pop(task), task.result()))
+        return pairs
@@ -0,0 +1,124 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import os
+import struct
+import zlib
+from collections import deque
+
+# uncompressed bytes per block, like htslib, so that a compressed block never exceeds 64 KiB
+BLOCK_SIZE = 0xFF00
+
+# gzip header with FEXTRA and the BC subfield, followed by the total block size - 1
+BLOCK_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+
+# empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, compresslevel=6):
+    """
+    :param data: at most BLOCK_SIZE bytes
+    :param compresslevel: zlib compression level
+    :return: BGZF block, i.e. a gzip member with the compressed block size in its BC extra field
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    return b"".join(
+        (
+            BLOCK_HEADER,
+            struct.pack("<H", len(BLOCK_HEADER) + len(deflated) + 9),
+            deflated,
+            struct.pack("<2I", zlib.crc32(data), len(data)),
+        )
+    )
+
+
+class BGZFWriter(object):
+    """
+    Text stream writing utf-8 encoded BGZF, the blocked gzip format of bgzip that tabix
+    and htslib need to seek in compressed vcf files. Blocks are compressed by a pool of
+    threads and written in order. flush ends the current block, so that a file truncated
+    to its size after a flush is still valid BGZF to append to
+    """
+
+    def __init__(self, fileobj, threads=None, compresslevel=6):
+        """
+        :param fileobj: binary file object to write to. Closed with the writer
+        :param threads: compression threads. Defaults to the number of cpus
+        :param compresslevel: zlib compression level
+        """
+        self.fileobj = fileobj
+        self.threads = threads or os.cpu_count() or 1
+        self.compresslevel = compresslevel
+        self._buffer = []
+        self._buffered = 0
+        self._pending = deque()
+        self._executor = None
+        if self.threads > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+
+    def write(self, data):
+        data = data.encode("utf-8")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            self._compress_buffer(partial=False)
+        return len(data)
+
+    def _compress_buffer(self, partial):
+        """
+        :param partial: also compress the last block if it is not full
+        """
+        data = b"".join(self._buffer)
+        end = len(data) if partial else len(data) - len(data) % BLOCK_SIZE
+        for start in range(0, end, BLOCK_SIZE):
+            self._submit(data[start : start + BLOCK_SIZE])
+        rest = data[end:]
+        self._buffer = [rest] if rest else []
+        self._buffered = len(rest)
+
+    def _submit(self, block):
+        if self._executor is None:
+            self.fileobj.write(compress_block(block, self.compresslevel))
+            return
+        self._pending.append(
+            self._executor.submit(compress_block, block, self.compresslevel)
+        )
+        # zlib releases the gil, keep every thread busy without buffering the whole file
+        while len(self._pending) > self.threads * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def flush(self):
+        if self._buffered:
+            self._compress_buffer(partial=True)
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+        try:
+            self.flush()
+            self.fileobj.write(EOF_BLOCK)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,338 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+VARIANT_RE = re.compile(
+    r"^(?:chr)?(?P<chromosome>[A-Za-z0-9_.]+)[:\-](?P<pos>\d+)[:\-]"
+    r"(?P<ref>[A-Za-z0-9]*)[:\-](?P<alt>[A-Za-z]*)$",
+    re.IGNORECASE,
+)
+
+
+def normalize_variant(query):
+    """
+    Normalize a variant representation so that equivalent queries share the same cache key
+    e.g. 7-140453136-a-t, chr7:140453136:A:T and chr7-140453136-A-T all become chr7:140453136:A:T
+    Queries that are not coordinates (rsids, variant ids, genes, cnvs etc) are only stripped
+    :param query: variant representation
+    :return: normalized variant representation
+    """
+    query = str(query).strip()
+    match = VARIANT_RE.match(query)
+    if match is None:
+        return query.lower() if query.lower().startswith("rs") else query
+    chromosome = match.group("chromosome")
+    if chromosome.upper() in ("X", "Y", "M", "MT"):
+        chromosome = chromosome.upper().replace("MT", "M")
+    return "chr%s:%s:%s:%s" % (
+        chromosome,
+        match.group("pos"),
+        match.group("ref").upper(),
+        match.group("alt").upper(),
+    )
+
+
+class BaseCache(object):
+    """
+    Base annotation cache. Subclasses need to implement get_many and set_many
+    and should update the hits, misses and evictions counters
+    """
+
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary with hits, misses and evictions counters
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    @staticmethod
+    def make_key(query, ref_genome=None, params=None, endpoint="lookup"):
+        """
+        :param query: variant representation
+        :param ref_genome: reference genome
+        :param params: dictionary of request parameters
+        :param endpoint: lookup or batch. A lookup may return a list of annotations, e.g. for an rsid,
+        where a batch returns a single one per query, so their results are cached separately
+        :return: cache key for the endpoint, normalized query, reference genome and sorted parameters
+        """
+        params = sorted((str(k), str(v)) for k, v in (params or {}).items())
+        return hashlib.sha1(
+            json.dumps([endpoint, normalize_variant(query), ref_genome, params]).encode(
+                "utf-8"
+            )
+        ).hexdigest()
+
+    @staticmethod
+    def is_cacheable(result):
+        return isinstance(result, (dict, list)) and not (
+            isinstance(result, dict) and "error" in result
+        )
+
+    def get_many(self, keys):
+        """
+        :param keys: list of cache keys
+        :return: dictionary of key to cached value for the keys found
+        """
+        raise NotImplementedError
+
+    def set_many(self, mapping):
+        """
+        :param mapping: dictionary of key to value
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def split_batch(self, queries, ref_genome=None, params=None):
+        """
+        Look up a batch of queries in the cache
+        :param queries: list of variant representations
+        :param ref_genome: reference genome
+        :param params: dictionary of request parameters
+        :return: tuple of cache keys, dictionary of index to cached result and list of queries not in the cache
+        """
+        keys = [
+            self.make_key(query, ref_genome, params, endpoint="batch")
+            for query in queries
+        ]
+        found = self.get_many(list(set(keys)))
+        hits = {i: found[key] for i, key in enumerate(keys) if key in found}
+        misses = [query for i, query in enumerate(queries) if i not in hits]
+        return keys, hits, misses
+
+    def merge_batch(self, keys, hits, results):
+        """
+        Store the results fetched for the cache misses and merge them with the cache hits
+        :param keys: cache keys as returned by split_batch
+        :param hits: cached results as returned by split_batch
+        :param results: results for the queries not in the cache, in the same order
+        :return: list of results in input order
+        """
+        results = iter(results)
+        merged = []
+        fetched = {}
+        for i, key in enumerate(keys):
+            if i in hits:
+                merged.append(hits[i])
+                continue
+            result = next(results)
+            if self.is_cacheable(result):
+                fetched[key] = result
+            merged.append(result)
+        if fetched:
+            self.set_many(fetched)
+        return merged
+
+
+class MemoryCache(BaseCache):
+    """
+    Bounded in-process LRU cache with optional TTL. It is thread safe so a single
+    instance may be used by the threads of batch_lookup.
+    Cached values are returned as is, so callers should not modify them
+    """
+
+    def __init__(self, max_entries=10000, ttl=None):
+        """
+        :param max_entries: maximum number of cached annotations. Least recently used entries are evicted first
+        :param ttl: seconds after which a cached annotation expires. None for no expiration
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __getstate__(self):
+        # every process keeps its own entries
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_entries"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and self.ttl is not None:
+                    if entry[1] < now - self.ttl:
+                        del self._entries[key]
+                        self.evictions += 1
+                        entry = None
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+                self.hits += 1
+        return found
+
+    def set_many(self, mapping):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries[key] = (value, now)
+                self._entries.move_to_end(key)
+            while (
+                self.max_entries is not None and len(self._entries) > self.max_entries
+            ):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache(BaseCache):
+    """
+    Annotation cache stored in a local SQLite database as compressed json.
+    The database file may be shared between processes
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None, compress_level=6):
+        """
+        :param path: path to the SQLite database file
+        :param ttl: seconds after which a cached annotation expires. None for no expiration
+        :param max_entries: maximum number of cached annotations. Least recently used entries are evicted first
+        :param compress_level: zlib compression level
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.compress_level = compress_level
+        self._connect()
+
+    def __getstate__(self):
+        # every process opens its own connection to the same database
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_connection"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False
+        )
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS annotations ("
+                "key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS annotations_accessed "
+                "ON annotations (accessed)"
+            )
+
+    def _dumps(self, value):
+        return zlib.compress(
+            json.dumps(value, separators=(",", ":")).encode("utf-8"),
+            self.compress_level,
+        )
+
+    @staticmethod
+    def _loads(value):
+        return json.loads(zlib.decompress(value).decode("utf-8"))
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock, self._connection:
+            # stay well below SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self._connection.execute(
+                    "SELECT key, value, created FROM annotations WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                ).fetchall()
+                expired = []
+                for key, value, created in rows:
+                    if self.ttl is not None and created < now - self.ttl:
+                        expired.append((key,))
+                        continue
+                    found[key] = self._loads(value)
+                if expired:
+                    self._connection.executemany(
+                        "DELETE FROM annotations WHERE key = ?", expired
+                    )
+                    self.evictions += len(expired)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if found:
+                self._connection.executemany(
+                    "UPDATE annotations SET accessed = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        return found
+
+    def set_many(self, mapping):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO annotations (key, value, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, self._dumps(value), now, now) for key, value in mapping.items()],
+            )
+            if self.max_entries is not None:
+                self.evictions += self._connection.execute(
+                    "DELETE FROM annotations WHERE key IN ("
+                    "SELECT key FROM annotations ORDER BY accessed DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM annotations")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM annotations"
+            ).fetchone()[0]
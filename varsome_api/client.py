@@ -12,15 +12,119 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
 import concurrent.futures
+import json
 import logging
 import os
 import re
-from itertools import chain
+import socket
+import time
+from collections import OrderedDict
+from itertools import islice
 
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 from requests.exceptions import HTTPError, Timeout, ConnectionError, RequestException
+from urllib3.connection import HTTPConnection
+
+from varsome_api.cache import BaseCache, normalize_variant
+from varsome_api.compression import (
+    RESPONSE_ENCODINGS,
+    TransferStats,
+    check_request_encoding,
+    compress_body,
+)
+from varsome_api.decoder import get_decoder, iter_json_array
+from varsome_api.metrics import request_endpoint
+from varsome_api.retry import parse_retry_after
+
+
+def chunked(iterable, size):
+    """
+    Lazily split an iterable into lists of at most size items
+    :param iterable: any iterable, including unbounded generators
+    :param size: maximum number of items per chunk
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def chunked_variants(variants, size):
+    """
+    Lazily split variants into lists holding at most size distinct variants, so that batches
+    stay full once duplicates are removed. Duplicates are compared with normalize_variant
+    :param variants: any iterable of variant representations, including unbounded generators
+    :param size: maximum number of distinct variants per chunk, or a function returning it
+    :return: generator of lists
+    """
+    chunk = []
+    seen = set()
+    limit = size() if callable(size) else size
+    for variant in variants:
+        seen.add(normalize_variant(variant))
+        chunk.append(variant)
+        if len(seen) >= limit:
+            yield chunk
+            chunk = []
+            seen = set()
+            limit = size() if callable(size) else size
+    if chunk:
+        yield chunk
+
+
+def deduplicate_variants(variants):
+    """
+    :param variants: list of variant representations
+    :return: tuple of the list of distinct variants, keeping the first representation of each,
+    and the index in that list of every variant
+    """
+    unique = []
+    indexes = {}
+    positions = []
+    for variant in variants:
+        key = normalize_variant(variant)
+        if key not in indexes:
+            indexes[key] = len(unique)
+            unique.append(variant)
+        positions.append(indexes[key])
+    return unique, positions
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter sending TCP keep-alive probes on idle pooled connections, so that firewalls and NAT
+    gateways don't silently drop them between batch requests
+    """
+
+    def __init__(self, keep_alive=None, **kwargs):
+        """
+        :param keep_alive: seconds a connection stays idle before probes are sent. None for the
+        operating system defaults
+        """
+        # init_poolmanager is called by the HTTPAdapter constructor
+        self.keep_alive = keep_alive
+        super(KeepAliveAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive is not None:
+            options = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                options.append(
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(self.keep_alive))
+                )
+            if hasattr(socket, "TCP_KEEPINTVL"):
+                options.append(
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(self.keep_alive))
+                )
+            kwargs["socket_options"] = options
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
 
 
 class VarSomeAPIException(Exception):
@@ -31,6 +135,7 @@ class VarSomeAPIException(Exception):
         403: "Bad Request: your request is invalid, and we'll return an error message that tells you why. This is the "
         "status code returned if you've exceeded the rate limit (see below).",
         404: "Not Found: either you're requesting an invalid URI or the resource in question doesn't exist",
+        429: "Too Many Requests: you have exceeded the rate limit. Try again later.",
         500: "Internal Server Error: we did something wrong.",
         501: "Not implemented.",
         502: "Bad Gateway: returned if VariantAPI is down or being upgraded.",
@@ -38,27 +143,62 @@ class VarSomeAPIException(Exception):
         504: "Gateway Timeout",
     }
 
-    def __init__(self, status, response=None):
+    # set for failures that may succeed if the request is sent again
+    transient = False
+
+    def __init__(self, status, response=None, retry_after=None):
         self.status = status
         self.response = response
+        self.retry_after = retry_after
 
     def __str__(self):
         return "%s (%s)" % (
             self.status,
-            self.ERROR_CODES.get(self.status, "Unknown error.")
-            if self.response is None
-            else self.response,
+            (
+                self.ERROR_CODES.get(self.status, "Unknown error.")
+                if self.response is None
+                else self.response
+            ),
         )
 
     def __repr__(self):
         return "%s(status=%s)" % (self.__class__.__name__, self.status)
 
 
+class VarSomeAPIConnectionError(VarSomeAPIException):
+    """
+    The request timed out or the connection failed before a response was received
+    """
+
+    transient = True
+
+
 class VarSomeAPIClientBase(object):
     _api_url = "https://api.varsome.com"
     _accepted_methods = ("GET", "POST")
+    # bytes read at a time while decoding batch responses
+    response_chunk_size = 256 * 1024
+    # batch responses larger than this, or of unknown length, are decoded one variant at a time
+    # as they are received. Smaller ones are read at once and decoded with a single call
+    incremental_decode_size = 8 * 1024 * 1024
 
-    def __init__(self, api_key=None, logger=None, api_url=None):
+    def __init__(
+        self,
+        api_key=None,
+        logger=None,
+        api_url=None,
+        cache=None,
+        retry=None,
+        rate_limiter=None,
+        json_decoder=None,
+        request_compression=None,
+        timeout=None,
+        pool_connections=DEFAULT_POOLSIZE,
+        pool_maxsize=None,
+        keep_alive=None,
+        hooks=None,
+    ):
+        check_request_encoding(request_compression)
         if logger is None:
             BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
             logger = logging.getLogger(__name__)
@@ -74,33 +214,247 @@ class VarSomeAPIClientBase(object):
             self._api_url = api_url
         self.logger = logger
         self.api_key = api_key
+        self.cache = cache
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.json_loads = get_decoder(json_decoder)
+        self.request_compression = request_compression
+        self.transfer_stats = TransferStats()
+        self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.hooks = list(hooks or ())
+        # without an explicit pool_maxsize the pool grows with the concurrency of the requests
+        self._pool_size = pool_maxsize or DEFAULT_POOLSIZE
+        self._retired_pool_counts = (0, 0)
         self._headers = {
             "Accept": "application/json",
+            "Accept-Encoding": RESPONSE_ENCODINGS,
             "user-agent": "VarSomeApiClientPython/2.0",
         }
         if self.api_key is not None:
             self._headers["Authorization"] = "Token " + self.api_key
-        self.session = requests.Session()
-        self.session.headers.update(self._headers)
+        self.session = self._create_session()
+
+    def _create_session(self):
+        session = requests.Session()
+        session.headers.update(self._headers)
+        self._mount_adapter(session)
+        return session
+
+    def _mount_adapter(self, session):
+        adapter = KeepAliveAdapter(
+            keep_alive=self.keep_alive,
+            pool_connections=self.pool_connections,
+            pool_maxsize=self._pool_size,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def _ensure_pool_size(self, concurrency):
+        """
+        Grow the connection pool to the number of concurrent requests, so that connections are
+        reused instead of being opened and discarded by the threads that don't fit in the pool.
+        Does nothing if pool_maxsize was given explicitly
+        :param concurrency: maximum number of requests in flight
+        """
+        if self.pool_maxsize is not None or concurrency <= self._pool_size:
+            return
+        self._pool_size = concurrency
+        adapter = self.session.get_adapter(self._api_url)
+        opened, requested = self._pool_counts(adapter)
+        self._retired_pool_counts = (
+            self._retired_pool_counts[0] + opened,
+            self._retired_pool_counts[1] + requested,
+        )
+        self._mount_adapter(self.session)
+        adapter.close()
+
+    @staticmethod
+    def _pool_counts(adapter):
+        """
+        :return: tuple of connections opened and requests made through the pools of an adapter
+        """
+        opened = requested = 0
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requested += pool.num_requests
+        return opened, requested
+
+    @property
+    def connection_stats(self):
+        """
+        :return: dictionary with the pool size and the number of connections opened and reused
+        """
+        opened, requested = self._pool_counts(self.session.get_adapter(self._api_url))
+        opened += self._retired_pool_counts[0]
+        requested += self._retired_pool_counts[1]
+        return {
+            "pool_maxsize": self._pool_size,
+            "requests": requested,
+            "connections_opened": opened,
+            "connections_reused": max(requested - opened, 0),
+        }
+
+    def __getstate__(self):
+        # sessions are not shared between processes
+        state = self.__dict__.copy()
+        del state["session"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._retired_pool_counts = (0, 0)
+        self.session = self._create_session()
 
     def _make_request(self, path, method="GET", params=None, json_data=None):
+        """
+        Send a request, retrying it according to the retry policy, and read its response
+        :return: decoded json response
+        """
         if method not in self._accepted_methods:
             raise VarSomeAPIException("", "Unsupported method %s" % method)
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(
+                    len(json_data["variants"]) if json_data is not None else 1
+                )
+            self._request_started(path, method, json_data, attempt)
+            start = time.monotonic()
+            try:
+                r = self._send_request(path, method, params=params, json_data=json_data)
+                result = self._read_response(r)
+            except VarSomeAPIException as e:
+                self._request_finished(
+                    path,
+                    method,
+                    json_data,
+                    time.monotonic() - start,
+                    e.status,
+                    attempt=attempt,
+                    error=e,
+                )
+                if self.retry is None or not self.retry.should_retry(e, attempt):
+                    raise
+                delay = self.retry.get_delay(attempt, e.retry_after)
+                self.logger.warning(
+                    "Request to %s failed with %s. Retrying in %.2f seconds"
+                    % (path, e, delay)
+                )
+                time.sleep(delay)
+                continue
+            except Exception:
+                # e.g. a body that is not valid json, the request still has to be finished
+                self._request_finished(
+                    path,
+                    method,
+                    json_data,
+                    time.monotonic() - start,
+                    "",
+                    attempt=attempt,
+                )
+                raise
+            self._request_finished(
+                path,
+                method,
+                json_data,
+                time.monotonic() - start,
+                r.status_code,
+                r,
+                attempt,
+            )
+            return result
+
+    def _request_started(self, path, method, json_data, attempt):
+        """
+        Called before every attempt of a request is sent
+        :param path: request path
+        :param method: request method
+        :param json_data: post request body if any
+        :param attempt: 1 for the first attempt, higher for retries
+        """
+        if self.hooks:
+            endpoint = request_endpoint(path)
+            variants = len(json_data["variants"]) if json_data is not None else 1
+            for hook in self.hooks:
+                hook.request_started(endpoint, method, variants, attempt)
+
+    def _request_finished(
+        self,
+        path,
+        method,
+        json_data,
+        elapsed,
+        status,
+        response=None,
+        attempt=1,
+        bytes_sent=None,
+        bytes_received=None,
+        error=None,
+    ):
+        """
+        Called after every request completes or fails. Subclasses may override it to collect measurements
+        :param path: request path
+        :param method: request method
+        :param json_data: post request body if any
+        :param elapsed: seconds between sending the request and reading the response or the failure
+        :param status: http status code or an empty string if no response was received
+        :param response: requests response object for successful requests
+        :param attempt: 1 for the first attempt, higher for retries
+        :param bytes_sent: size of the request body as sent, if there is no response object
+        :param bytes_received: size of the response body as received, if there is no response object
+        :param error: VarSomeAPIException the request failed with, if any
+        """
+        if self.hooks:
+            endpoint = request_endpoint(path)
+            variants = len(json_data["variants"]) if json_data is not None else 1
+            if response is not None:
+                bytes_sent = len(response.request.body or b"")
+                bytes_received = self._bytes_received(response)
+            for hook in self.hooks:
+                hook.request_finished(
+                    endpoint,
+                    method,
+                    variants,
+                    attempt,
+                    elapsed,
+                    status,
+                    bytes_sent,
+                    bytes_received,
+                )
+
+    def _send_request(self, path, method="GET", params=None, json_data=None):
         try:
             if method == "GET":
-                r = self.session.get(self._api_url + path, params=params, stream=True)
+                self.transfer_stats.record_request(0, 0)
+                r = self.session.get(
+                    self._api_url + path,
+                    params=params,
+                    stream=True,
+                    timeout=self.timeout,
+                )
             if method == "POST":
                 if json_data is None:
                     raise RuntimeError("You need to provide a post request body")
+                body, headers = self._encode_body(json_data)
                 r = self.session.post(
                     self._api_url + path,
                     params=params,
-                    json=json_data,
-                    headers={"Content-Type": "application/json"},
+                    data=body,
+                    headers=headers,
                     stream=True,
+                    timeout=self.timeout,
                 )
                 self.logger.info("Time between request and response %s" % r.elapsed)
-                self.logger.info("Content length %s" % len(r.content))
+                self.logger.info(
+                    "Content length %s" % r.headers.get("Content-Length", "unknown")
+                )
             r.raise_for_status()
             return r
         except HTTPError as e:
@@ -109,29 +463,136 @@ class VarSomeAPIClientBase(object):
                 error_message = "Unexpected error"
                 if r.headers["Content-Type"] == "application/json":
                     error_message = response.json().get("detail", None)
-                raise VarSomeAPIException(response.status_code, error_message)
+                raise VarSomeAPIException(
+                    response.status_code,
+                    error_message,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
             raise VarSomeAPIException("", "Unknown http error %s" % e)
         except Timeout as e:
-            raise VarSomeAPIException("", "Request timed out %s" % e)
+            raise VarSomeAPIConnectionError("", "Request timed out %s" % e)
         except ConnectionError as e:
-            raise VarSomeAPIException(
+            raise VarSomeAPIConnectionError(
                 "", "Connection failure or connection refused %s" % e
             )
         except RequestException as e:
             raise VarSomeAPIException("", "Unknown error %s" % e)
 
+    def _encode_body(self, json_data):
+        """
+        :param json_data: post request body
+        :return: tuple of the encoded, optionally compressed, body and the request headers
+        """
+        body = json.dumps(json_data, allow_nan=False).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        size = len(body)
+        if self.request_compression is not None:
+            body = compress_body(body, self.request_compression)
+            headers["Content-Encoding"] = self.request_compression
+        self.transfer_stats.record_request(size, len(body))
+        return body, headers
+
+    @staticmethod
+    def _bytes_received(response):
+        """
+        :param response: requests response object whose body has been read
+        :return: bytes read from the connection, before decompression, if known
+        """
+        try:
+            return response.raw.tell()
+        except (AttributeError, TypeError):
+            return None
+
+    @staticmethod
+    def _content_length(response):
+        """
+        :param response: requests response object
+        :return: size of the response body as sent by the server if known, without reading the body
+        """
+        try:
+            return int(response.headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+
     def get(self, path, params=None):
-        response = self._make_request(path, "GET", params=params)
-        return response.json()
+        return self._make_request(path, "GET", params=params)
+
+    def _read_response(self, response):
+        """
+        :param response: streamed requests response object
+        :return: decoded json response
+        """
+        if response.request.method == "POST":
+            content_length = self._content_length(response)
+            if content_length is None or content_length > self.incremental_decode_size:
+                return self._decode_batch(response)
+        try:
+            content = response.content
+        except (Timeout, ConnectionError) as e:
+            raise VarSomeAPIConnectionError("", "Failed to read response %s" % e)
+        except RequestException as e:
+            raise VarSomeAPIException("", "Failed to read response %s" % e)
+        self.transfer_stats.record_response(
+            self._bytes_received(response) or len(content), len(content)
+        )
+        return self.json_loads(content)
+
+    def _decode_batch(self, response):
+        """
+        Decode the annotations of a batch response one variant at a time as the body
+        is received, instead of reading the whole body and decoding it at once. Only the
+        decoding is incremental: the results are returned once the whole body has been
+        decoded, so a batch is not held as raw bytes and decoded dictionaries at the same time
+        but post and iter_batch_lookup still wait for the complete response
+        :param response: streamed requests response object
+        :return: list of annotation dictionaries
+        """
+        bytes_decoded = [0]
+
+        def read_chunks():
+            for chunk in response.iter_content(self.response_chunk_size):
+                bytes_decoded[0] += len(chunk)
+                yield chunk
+
+        chunks = read_chunks()
+        try:
+            results = list(iter_json_array(chunks, self.json_loads))
+            # read the end of the body so that the connection goes back to the pool
+            for _ in chunks:
+                pass
+            self.transfer_stats.record_response(
+                self._bytes_received(response) or bytes_decoded[0], bytes_decoded[0]
+            )
+            return results
+        except (Timeout, ConnectionError) as e:
+            raise VarSomeAPIConnectionError("", "Failed to read response %s" % e)
+        except RequestException as e:
+            raise VarSomeAPIException("", "Failed to read response %s" % e)
+        finally:
+            response.close()
 
     def post(self, path, params=None, json_data=None, raise_exceptions=True):
         # handle api errors in batch requests.
         try:
-            response = self._make_request(
-                path, "POST", params=params, json_data=json_data
-            )
-            return response.json()
+            return self._make_request(path, "POST", params=params, json_data=json_data)
         except VarSomeAPIException as e:
+            variants = json_data.get("variants")
+            if self.retry is not None and self.retry.should_split(e, variants):
+                half = len(variants) // 2
+                self.logger.warning(
+                    "Splitting failed batch of %s variants in half" % len(variants)
+                )
+                return self.post(
+                    path,
+                    params,
+                    dict(json_data, variants=variants[:half]),
+                    raise_exceptions,
+                ) + self.post(
+                    path,
+                    params,
+                    dict(json_data, variants=variants[half:]),
+                    raise_exceptions,
+                )
             if raise_exceptions:
                 raise e
             self.logger.error(e)
@@ -143,6 +604,44 @@ class VarSomeAPIClientBase(object):
                 for variant in json_data["variants"]
             ]
 
+    def _cached_get(self, key, path, params=None):
+        if self.cache is None:
+            return self.get(path, params=params)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.get(path, params=params)
+            if self.cache.is_cacheable(result):
+                self.cache.set(key, result)
+        return result
+
+    def _split_chunk(self, queries, ref_genome, params):
+        """
+        Every distinct variant of a chunk is requested once, unless it is cached
+        :return: tuple of (queries, index of the distinct variant of every query, cache keys,
+        cached results by index, number of queries to request) and the queries to request
+        """
+        unique, positions = deduplicate_variants(queries)
+        if self.cache is None:
+            return (queries, positions, None, None, len(unique)), unique
+        keys, hits, misses = self.cache.split_batch(unique, ref_genome, params)
+        return (queries, positions, keys, hits, len(misses)), misses
+
+    def _merge_chunk(self, chunk, results):
+        """
+        :return: list of (query, result) tuples in input order. Duplicate queries share the
+        same result object
+        """
+        queries, positions, keys, hits, requested = chunk
+        if len(results) != requested:
+            raise VarSomeAPIException(
+                "",
+                "Batch response has %s results for %s variants"
+                % (len(results), requested),
+            )
+        if self.cache is not None:
+            results = self.cache.merge_batch(keys, hits, results)
+        return [(query, results[i]) for query, i in zip(queries, positions)]
+
 
 class VarSomeAPIClient(VarSomeAPIClientBase):
     schema_lookup_path = "/lookup/schema"
@@ -151,10 +650,100 @@ class VarSomeAPIClient(VarSomeAPIClientBase):
     batch_lookup_path = "/lookup/batch/%s"
 
     def __init__(
-        self, api_key=None, logger=None, api_url=None, max_variants_per_batch=200
+        self,
+        api_key=None,
+        logger=None,
+        api_url=None,
+        max_variants_per_batch=200,
+        cache=None,
+        adaptive=None,
+        retry=None,
+        rate_limiter=None,
+        json_decoder=None,
+        request_compression=None,
+        timeout=None,
+        pool_connections=DEFAULT_POOLSIZE,
+        pool_maxsize=None,
+        keep_alive=None,
+        hooks=None,
     ):
-        super(VarSomeAPIClient, self).__init__(api_key, logger, api_url)
+        """
+        :param cache: optional varsome_api.cache.BaseCache instance. Annotations found in the cache
+        are not requested again
+        :param adaptive: optional varsome_api.adaptive.AdaptiveBatchController instance. When given
+        batch requests ignore max_variants_per_batch and max_threads and use the batch size and
+        concurrency suggested by the controller instead
+        :param retry: optional varsome_api.retry.RetryPolicy instance used to retry transient failures
+        :param rate_limiter: optional varsome_api.ratelimit.RateLimiter instance used to pace requests
+        :param json_decoder: orjson, msgspec, json or a function decoding json bytes. Defaults to the
+        fastest installed decoder
+        :param request_compression: gzip or zstd to compress the body of batch requests
+        :param timeout: seconds to wait for the server, either a single value or a (connect, read) tuple.
+        None to wait forever
+        :param pool_connections: number of hosts to keep connection pools for
+        :param pool_maxsize: maximum number of connections kept open per host. Defaults to the
+        number of concurrent requests
+        :param keep_alive: seconds an idle pooled connection waits before sending TCP keep-alive probes.
+        None for the operating system defaults
+        :param hooks: optional list of varsome_api.metrics.RequestHooks instances notified when
+        every request starts and finishes
+        """
+        super(VarSomeAPIClient, self).__init__(
+            api_key,
+            logger,
+            api_url,
+            cache,
+            retry,
+            rate_limiter,
+            json_decoder,
+            request_compression,
+            timeout,
+            pool_connections,
+            pool_maxsize,
+            keep_alive,
+            hooks,
+        )
         self.max_variants_per_batch = max_variants_per_batch
+        self.adaptive = adaptive
+
+    def _request_finished(
+        self,
+        path,
+        method,
+        json_data,
+        elapsed,
+        status,
+        response=None,
+        attempt=1,
+        bytes_sent=None,
+        bytes_received=None,
+        error=None,
+    ):
+        super(VarSomeAPIClient, self)._request_finished(
+            path,
+            method,
+            json_data,
+            elapsed,
+            status,
+            response,
+            attempt,
+            bytes_sent,
+            bytes_received,
+            error,
+        )
+        if self.adaptive is not None and json_data is not None:
+            self.adaptive.record(
+                len(json_data["variants"]),
+                elapsed,
+                status,
+                self._bytes_received(response) if response is not None else None,
+                error is not None and error.transient,
+            )
+
+    def _chunks(self, variants):
+        if self.adaptive is None:
+            return chunked_variants(variants, self.max_variants_per_batch)
+        return chunked_variants(variants, lambda: self.adaptive.batch_size)
 
     @staticmethod
     def query_is_variant_id(query):
@@ -166,7 +755,9 @@ class VarSomeAPIClient(VarSomeAPIClientBase):
         return re.search(r"^\d{20}$", str(query))
 
     def schema(self):
-        return self.get(self.schema_lookup_path)
+        return self._cached_get(
+            BaseCache.make_key(self.schema_lookup_path), self.schema_lookup_path
+        )
 
     def lookup(self, query, params=None, ref_genome=None):
         """
@@ -180,7 +771,77 @@ class VarSomeAPIClient(VarSomeAPIClientBase):
         url = self.lookup_path % query
         if ref_genome is not None and not self.query_is_variant_id(query):
             url = self.ref_genome_lookup_path % (query, ref_genome)
-        return self.get(url, params=params)
+        return self._cached_get(
+            BaseCache.make_key(query, ref_genome, params), url, params=params
+        )
+
+    def iter_lookup(
+        self,
+        queries,
+        params=None,
+        ref_genome=None,
+        max_threads=3,
+        raise_exceptions=False,
+        ordered=True,
+    ):
+        """
+        Look up queries one at a time with up to max_threads concurrent requests. Unlike batch
+        lookups this does not need an api key, but requests without a key are limited more strictly,
+        so use a rate_limiter to stay below the limits
+
+        :param queries: any iterable of variant representations, including unbounded generators
+        :param params: dictionary of key value pairs for http GET parameters. Refer to the api documentation
+        of https://api.varsome.com for examples
+        :param ref_genome: reference genome (hg19 or hg38 or None)
+        :param max_threads: how many concurrent requests to make
+        :param raise_exceptions: If a failed request should raise an exception True, thus terminating the whole
+        process or if it should proceed with an error result for the query
+        :param ordered: if True results are yielded in input order, otherwise as soon as each request completes
+        :return: generator of (query, annotation dictionary) tuples
+        """
+
+        def lookup(query):
+            try:
+                result = self.lookup(query, params=params, ref_genome=ref_genome)
+            except VarSomeAPIException as e:
+                if raise_exceptions:
+                    raise
+                self.logger.error(e)
+                return {
+                    "error": "Could not annotate variant %s because "
+                    "request failed with %s" % (query, e)
+                }
+            if not result:
+                return {"error": "Could not fetch annotations for %s" % query}
+            return result
+
+        self._ensure_pool_size(max_threads)
+        pending = OrderedDict()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_threads,
+        ) as executor:
+            try:
+                for query in queries:
+                    pending[executor.submit(lookup, query)] = query
+                    while len(pending) >= max_threads * 2:
+                        for pair in self._pop_lookups(pending, ordered):
+                            yield pair
+                while pending:
+                    for pair in self._pop_lookups(pending, ordered):
+                        yield pair
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _pop_lookups(pending, ordered):
+        if ordered:
+            future, query = pending.popitem(last=False)
+            return [(query, future.result())]
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        return [(pending.pop(future), future.result()) for future in done]
 
     def batch_lookup(
         self,
@@ -204,29 +865,88 @@ class VarSomeAPIClient(VarSomeAPIClientBase):
         for dictionary properties
         """
 
-        @asyncio.coroutine
-        def batch(batch_executor):
-            batch_loop = asyncio.get_event_loop()
-            futures = [
-                batch_loop.run_in_executor(
-                    batch_executor,
-                    self.post,
-                    self.batch_lookup_path % ref_genome,
-                    params,
-                    {"variants": queries},
-                    raise_exceptions,
-                )
-                for queries in [
-                    variants[x : x + self.max_variants_per_batch]
-                    for x in range(0, len(variants), self.max_variants_per_batch)
-                ]
-            ]
-            responses = yield from asyncio.gather(*futures)
-            return responses
+        return [
+            result
+            for _, result in self.iter_batch_lookup(
+                variants,
+                params=params,
+                ref_genome=ref_genome,
+                max_threads=max_threads,
+                raise_exceptions=raise_exceptions,
+            )
+        ]
 
+    def iter_batch_lookup(
+        self,
+        variants,
+        params=None,
+        ref_genome="hg19",
+        max_threads=3,
+        raise_exceptions=False,
+        max_pending_chunks=None,
+        ordered=True,
+    ):
+        """
+        Streaming version of batch_lookup. Variants are consumed lazily and only a bounded number
+        of chunks is kept in flight, so memory depends on the window size and not the input size
+
+        :param variants: any iterable of variant representations, including unbounded generators
+        :param params: dictionary of key value pairs for http GET parameters. Refer to the api documentation
+        of https://api.varsome.com for examples
+        :param ref_genome: reference genome (hg19 or hg38)
+        :param max_threads: how many concurrent requests to make
+        :param raise_exceptions: If a post request should raise an exception True, thus terminating the whole
+        process or if it should proceed to let the process continue
+        :param max_pending_chunks: maximum number of chunks submitted but not yet yielded.
+        Defaults to twice max_threads. The adaptive controller concurrency is used instead if set
+        :param ordered: if True results are yielded in input order, otherwise as soon as each chunk completes
+        :return: generator of (input variant, annotation dictionary) tuples
+        """
+        max_pending_chunks = max_pending_chunks or max_threads * 2
+        if self.adaptive is not None:
+            max_threads = self.adaptive.max_concurrency
+        self._ensure_pool_size(max_threads)
+        path = self.batch_lookup_path % ref_genome
+        pending = OrderedDict()
         # Create a limited thread pool.
-        executor = concurrent.futures.ThreadPoolExecutor(
+        with concurrent.futures.ThreadPoolExecutor(
             max_workers=max_threads,
+        ) as executor:
+            try:
+                for queries in self._chunks(variants):
+                    chunk, misses = self._split_chunk(queries, ref_genome, params)
+                    if misses:
+                        future = executor.submit(
+                            self.post,
+                            path,
+                            params,
+                            {"variants": misses},
+                            raise_exceptions,
+                        )
+                    else:
+                        future = concurrent.futures.Future()
+                        future.set_result([])
+                    pending[future] = chunk
+                    if self.adaptive is not None:
+                        max_pending_chunks = self.adaptive.concurrency
+                    while len(pending) >= max_pending_chunks:
+                        for pair in self._pop_completed(pending, ordered):
+                            yield pair
+                while pending:
+                    for pair in self._pop_completed(pending, ordered):
+                        yield pair
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _pop_completed(self, pending, ordered):
+        if ordered:
+            future, chunk = pending.popitem(last=False)
+            return self._merge_chunk(chunk, future.result())
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
         )
-        loop = asyncio.get_event_loop()
-        return list(chain.from_iterable(loop.run_until_complete(batch(executor))))
+        pairs = []
+        for future in done:
+            pairs.extend(self._merge_chunk(pending.pop(future), future.result()))
+        return pairs
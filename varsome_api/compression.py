@@ -0,0 +1,130 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import threading
+
+from urllib3.util.request import ACCEPT_ENCODING
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+REQUEST_ENCODINGS = ("gzip", "zstd")
+
+# every response encoding urllib3 is able to decode, e.g. gzip,deflate,br,zstd
+# depending on the installed packages
+RESPONSE_ENCODINGS = ACCEPT_ENCODING
+
+
+def compress_body(body, encoding):
+    """
+    :param body: request body bytes
+    :param encoding: gzip or zstd
+    :return: compressed body
+    """
+    if encoding == "gzip":
+        # level 6 is much faster than the default 9 for almost the same size
+        return gzip.compress(body, compresslevel=6)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(body)
+    raise ValueError("Unsupported request compression %s" % encoding)
+
+
+def check_request_encoding(encoding):
+    """
+    :param encoding: requested request body compression or None
+    :raise ValueError: if the compression is not supported
+    :raise RuntimeError: if the compression requires a package that is not installed
+    """
+    if encoding is None:
+        return
+    if encoding not in REQUEST_ENCODINGS:
+        raise ValueError("Unsupported request compression %s" % encoding)
+    if encoding == "zstd" and zstandard is None:
+        raise RuntimeError(
+            "zstandard is required for zstd compression. "
+            "Install it with pip install varsome_api_client[zstd]"
+        )
+
+
+class TransferStats(object):
+    """
+    Thread safe counters of the bytes exchanged with the API. Sent and received bytes are
+    counted as transferred, i.e. after compression, body and decoded bytes before compression
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.body_bytes = 0
+        self.responses = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record_request(self, body_bytes, bytes_sent):
+        """
+        :param body_bytes: size of the request body before compression
+        :param bytes_sent: size of the request body as sent
+        """
+        with self._lock:
+            self.requests += 1
+            self.body_bytes += body_bytes
+            self.bytes_sent += bytes_sent
+
+    def record_response(self, bytes_received, bytes_decoded):
+        """
+        :param bytes_received: size of the response body as received
+        :param bytes_decoded: size of the response body after decompression
+        """
+        with self._lock:
+            self.responses += 1
+            self.bytes_received += bytes_received
+            self.bytes_decoded += bytes_decoded
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary with the transfer counters and compression ratios
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "bytes_sent": self.bytes_sent,
+                "body_bytes": self.body_bytes,
+                "request_compression_ratio": (
+                    self.body_bytes / float(self.bytes_sent)
+                    if self.bytes_sent
+                    else None
+                ),
+                "responses": self.responses,
+                "bytes_received": self.bytes_received,
+                "bytes_decoded": self.bytes_decoded,
+                "response_compression_ratio": (
+                    self.bytes_decoded / float(self.bytes_received)
+                    if self.bytes_received
+                    else None
+                ),
+            }
@@ -0,0 +1,139 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# decoder name to function decoding json bytes or text, fastest first
+DECODERS = OrderedDict()
+if orjson is not None:
+    DECODERS["orjson"] = orjson.loads
+if msgspec is not None:
+    DECODERS["msgspec"] = msgspec.json.decode
+DECODERS["json"] = json.loads
+
+_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+
+def _skip_pattern(other, depth):
+    """
+    :param other: character class of the characters to skip besides strings and nested values
+    :param depth: maximum nesting of the values to skip
+    :return: pattern matching strings, other characters and complete arrays or objects
+    """
+    value = _STRING
+    if depth:
+        value = rb"(?:%s|[\[{]%s[\]}])" % (
+            _STRING,
+            _skip_pattern(rb'[^"\[\]{}]', depth - 1),
+        )
+    return rb"%s*(?:%s%s*)*" % (other, value, other)
+
+
+# skip strings, complete values nested up to 16 levels and anything else up to the next
+# structural character, an unterminated string or the end of the data
+_TOP_LEVEL_SKIP = re.compile(_skip_pattern(rb'[^"\[\]{},]', 16))
+# commas only separate items of the top level array
+_NESTED_SKIP = re.compile(_skip_pattern(rb'[^"\[\]{}]', 16))
+_WHITESPACE_SKIP = re.compile(rb"[ \t\r\n]*")
+_OPENING_BRACKET = ord("[")
+_QUOTE = ord('"')
+_COMMA = ord(",")
+_OPENING = frozenset(b"[{")
+_WHITESPACE = b" \t\r\n"
+
+
+def get_decoder(decoder=None):
+    """
+    :param decoder: orjson, msgspec, json or a function decoding json bytes. Defaults to the
+    fastest installed decoder
+    :return: function decoding json bytes or text
+    """
+    if decoder is None:
+        return next(iter(DECODERS.values()))
+    if callable(decoder):
+        return decoder
+    if decoder not in ("orjson", "msgspec", "json"):
+        raise ValueError("Unsupported json decoder %s" % decoder)
+    if decoder not in DECODERS:
+        raise RuntimeError(
+            "%s is not installed. Install it with pip install %s" % (decoder, decoder)
+        )
+    return DECODERS[decoder]
+
+
+def iter_json_array(chunks, loads=None):
+    """
+    Incrementally decode a json array, yielding every item as soon as it has been received.
+    Only the bytes of the item being received are kept besides the decoded items
+    :param chunks: iterable of bytes, e.g. response.iter_content()
+    :param loads: function decoding the json bytes of a single item. Defaults to the fastest
+    installed decoder
+    :return: generator of decoded items
+    """
+    loads = loads or get_decoder()
+    buffer = bytearray()
+    # position to resume scanning from, start of the current item and nesting level
+    position = start = depth = 0
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            if depth == 0:
+                skip = _WHITESPACE_SKIP
+            elif depth == 1:
+                skip = _TOP_LEVEL_SKIP
+            else:
+                skip = _NESTED_SKIP
+            position = skip.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            token = buffer[position]
+            if depth == 0:
+                if token != _OPENING_BRACKET:
+                    raise ValueError("Expected a json array")
+                depth = 1
+                position = start = position + 1
+                continue
+            if token == _QUOTE:
+                # wait for the rest of the string
+                break
+            position += 1
+            if token in _OPENING:
+                depth += 1
+            elif depth > 1:
+                depth -= 1
+            else:
+                item = buffer[start : position - 1]
+                if token == _COMMA or item.strip(_WHITESPACE):
+                    yield loads(item)
+                if token != _COMMA:
+                    return
+                start = position
+        if depth == 1 and start:
+            # drop the items already decoded
+            del buffer[:start]
+            position -= start
+            start = 0
+    raise ValueError("Unterminated json array")
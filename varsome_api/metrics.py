@@ -0,0 +1,379 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import metrics as otel_metrics
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_metrics = otel_trace = None
+
+# request latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def request_endpoint(path):
+    """
+    :param path: request path e.g. /lookup/chr7-140453136-A-T/hg19
+    :return: the path without variants, i.e. /lookup, /lookup/batch/<ref genome> or /lookup/schema
+    """
+    path = path.split("?", 1)[0]
+    if path.startswith("/lookup/batch/") or path == "/lookup/schema":
+        return path
+    if path.startswith("/lookup/"):
+        return "/lookup"
+    return path
+
+
+class RequestHooks(object):
+    """
+    Base class of the hooks passed to a client. Methods are called for every attempt of every
+    request, from the thread (or task) making it, so implementations need to be thread safe
+    """
+
+    def request_started(self, endpoint, method, variants, attempt):
+        """
+        :param endpoint: request path without variants, see request_endpoint
+        :param method: GET or POST
+        :param variants: number of variants requested
+        :param attempt: 1 for the first attempt, higher for retries
+        """
+        pass
+
+    def request_finished(
+        self,
+        endpoint,
+        method,
+        variants,
+        attempt,
+        elapsed,
+        status,
+        bytes_sent=None,
+        bytes_received=None,
+    ):
+        """
+        :param endpoint: request path without variants, see request_endpoint
+        :param method: GET or POST
+        :param variants: number of variants requested
+        :param attempt: 1 for the first attempt, higher for retries
+        :param elapsed: seconds from sending the request until the response was read or the request failed
+        :param status: http status code or an empty string if no response was received
+        :param bytes_sent: size of the request body as sent, if known
+        :param bytes_received: size of the response body as received, if known
+        """
+        pass
+
+
+class Histogram(object):
+    """
+    Counts of observations per bucket, with an inclusive upper bound per bucket
+    and an extra bucket for observations above the last bound
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        :param q: quantile between 0 and 1
+        :return: upper bound of the bucket containing the quantile, inf if above the last bucket
+        or None without observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class RequestMetrics(RequestHooks):
+    """
+    Aggregates request metrics in process: latency histograms, requests, retries, variants
+    and bytes per endpoint as well as the number of responses per status code
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: latency histogram bucket upper bounds in seconds
+        """
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.endpoints = OrderedDict()
+        self.status_codes = {}
+        self.in_flight = 0
+        self._first_started = None
+        self._last_finished = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = {
+                "requests": 0,
+                "errors": 0,
+                "retries": 0,
+                "variants": 0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "latency": Histogram(self.buckets),
+            }
+        return self.endpoints[name]
+
+    def request_started(self, endpoint, method, variants, attempt):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+            if self._first_started is None:
+                self._first_started = now
+
+    def request_finished(
+        self,
+        endpoint,
+        method,
+        variants,
+        attempt,
+        elapsed,
+        status,
+        bytes_sent=None,
+        bytes_received=None,
+    ):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            self._last_finished = now
+            metrics = self._endpoint(endpoint)
+            metrics["requests"] += 1
+            metrics["latency"].observe(elapsed)
+            if attempt > 1:
+                metrics["retries"] += 1
+            if status == "" or status >= 400:
+                metrics["errors"] += 1
+            else:
+                metrics["variants"] += variants
+            metrics["bytes_sent"] += bytes_sent or 0
+            metrics["bytes_received"] += bytes_received or 0
+            self.status_codes[status] = self.status_codes.get(status, 0) + 1
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary with the metrics of every endpoint, including latency quantiles
+        and annotated variants per second, and the number of responses per status code
+        """
+        with self._lock:
+            endpoints = OrderedDict()
+            for name, metrics in self.endpoints.items():
+                latency = metrics["latency"]
+                endpoints[name] = dict(
+                    (key, value) for key, value in metrics.items() if key != "latency"
+                )
+                endpoints[name].update(
+                    average_latency=(
+                        latency.sum / latency.count if latency.count else None
+                    ),
+                    p50_latency=latency.quantile(0.5),
+                    p95_latency=latency.quantile(0.95),
+                    p99_latency=latency.quantile(0.99),
+                )
+            duration = None
+            if self._first_started is not None and self._last_finished is not None:
+                duration = self._last_finished - self._first_started
+            variants = sum(metrics["variants"] for metrics in self.endpoints.values())
+            return {
+                "endpoints": endpoints,
+                "status_codes": dict(self.status_codes),
+                "in_flight": self.in_flight,
+                "variants_per_second": variants / duration if duration else None,
+            }
+
+
+class PrometheusHooks(RequestHooks):
+    """
+    Exports request metrics with prometheus_client. Serve them with
+    prometheus_client.start_http_server or the registry of your application
+    """
+
+    def __init__(self, registry=None, namespace="varsome_api", buckets=DEFAULT_BUCKETS):
+        """
+        :param registry: prometheus_client registry. Defaults to the global registry
+        :param namespace: prefix of the metric names
+        :param buckets: latency histogram bucket upper bounds in seconds
+        """
+        if prometheus_client is None:
+            raise RuntimeError(
+                "prometheus_client is required for prometheus metrics. "
+                "Install it with pip install varsome_api_client[prometheus]"
+            )
+        options = {"namespace": namespace}
+        if registry is not None:
+            options["registry"] = registry
+        labels = ("endpoint", "method")
+        self.latency = prometheus_client.Histogram(
+            "request_duration_seconds",
+            "Time from sending a request until its response was read",
+            labels,
+            buckets=buckets,
+            **options,
+        )
+        self.requests = prometheus_client.Counter(
+            "requests",
+            "Requests by response status, empty if no response was received",
+            labels + ("status",),
+            **options,
+        )
+        self.retries = prometheus_client.Counter(
+            "retries", "Retried requests", labels, **options
+        )
+        self.variants = prometheus_client.Counter(
+            "variants", "Variants annotated", labels, **options
+        )
+        self.bytes_sent = prometheus_client.Counter(
+            "sent_bytes", "Request body bytes sent", labels, **options
+        )
+        self.bytes_received = prometheus_client.Counter(
+            "received_bytes", "Response body bytes received", labels, **options
+        )
+        self.in_flight = prometheus_client.Gauge(
+            "requests_in_flight", "Requests waiting for a response", **options
+        )
+
+    def request_started(self, endpoint, method, variants, attempt):
+        self.in_flight.inc()
+
+    def request_finished(
+        self,
+        endpoint,
+        method,
+        variants,
+        attempt,
+        elapsed,
+        status,
+        bytes_sent=None,
+        bytes_received=None,
+    ):
+        self.in_flight.dec()
+        self.latency.labels(endpoint, method).observe(elapsed)
+        self.requests.labels(endpoint, method, str(status)).inc()
+        if attempt > 1:
+            self.retries.labels(endpoint, method).inc()
+        if status != "" and status < 400:
+            self.variants.labels(endpoint, method).inc(variants)
+        if bytes_sent:
+            self.bytes_sent.labels(endpoint, method).inc(bytes_sent)
+        if bytes_received:
+            self.bytes_received.labels(endpoint, method).inc(bytes_received)
+
+
+class OpenTelemetryHooks(RequestHooks):
+    """
+    Records a span and metrics for every request with the OpenTelemetry api. Spans are children
+    of the span that is current when the request is made. Configure the OpenTelemetry sdk and
+    exporters as usual for your application
+    """
+
+    def __init__(self, tracer_provider=None, meter_provider=None):
+        """
+        :param tracer_provider: OpenTelemetry tracer provider. Defaults to the global one
+        :param meter_provider: OpenTelemetry meter provider. Defaults to the global one
+        """
+        if otel_trace is None:
+            raise RuntimeError(
+                "opentelemetry-api is required for OpenTelemetry tracing. "
+                "Install it with pip install varsome_api_client[opentelemetry]"
+            )
+        self.tracer = otel_trace.get_tracer(__name__, tracer_provider=tracer_provider)
+        meter = otel_metrics.get_meter(__name__, meter_provider=meter_provider)
+        self.latency = meter.create_histogram(
+            "varsome_api.request.duration",
+            unit="s",
+            description="Time from sending a request until its response was read",
+        )
+        self.variants = meter.create_counter(
+            "varsome_api.variants", description="Variants annotated"
+        )
+        self.bytes_sent = meter.create_counter(
+            "varsome_api.request.body.size", unit="By", description="Bytes sent"
+        )
+        self.bytes_received = meter.create_counter(
+            "varsome_api.response.body.size", unit="By", description="Bytes received"
+        )
+
+    def request_finished(
+        self,
+        endpoint,
+        method,
+        variants,
+        attempt,
+        elapsed,
+        status,
+        bytes_sent=None,
+        bytes_received=None,
+    ):
+        end_time = time.time_ns()
+        attributes = {
+            "http.request.method": method,
+            "url.path": endpoint,
+            "varsome_api.variants": variants,
+            "varsome_api.attempt": attempt,
+        }
+        if status != "":
+            attributes["http.response.status_code"] = status
+        span = self.tracer.start_span(
+            "%s %s" % (method, endpoint),
+            kind=otel_trace.SpanKind.CLIENT,
+            attributes=attributes,
+            start_time=end_time - int(elapsed * 1e9),
+        )
+        if status == "" or status >= 400:
+            span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+        span.end(end_time=end_time)
+        attributes = {"http.request.method": method, "url.path": endpoint}
+        self.latency.record(
+            elapsed,
+            dict(attributes, **{"http.response.status_code": str(status)}),
+        )
+        if status != "" and status < 400:
+            self.variants.add(variants, attributes)
+        if bytes_sent:
+            self.bytes_sent.add(bytes_sent, attributes)
+        if bytes_received:
+            self.bytes_received.add(bytes_received, attributes)
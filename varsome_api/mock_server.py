@@ -0,0 +1,391 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from varsome_api.cache import VARIANT_RE, normalize_variant
+
+SCHEMA = {
+    "title": "Mock VarSome API schema",
+    "type": "object",
+    "properties": {
+        "chromosome": {"type": "string"},
+        "pos": {"type": "integer"},
+        "ref": {"type": "string"},
+        "alt": {"type": "string"},
+        "variant_id": {"type": "string"},
+    },
+}
+
+
+def load_fixtures(path):
+    """
+    :param path: json file with a list of recorded responses, e.g. written by
+    varsome_api_run.py -p add-all-data=1 -o fixtures.json, or one response per line.
+    Gzip compressed if it ends with .gz
+    :return: list of responses
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        data = f.read()
+    try:
+        fixtures = json.loads(data)
+    except ValueError:
+        fixtures = [json.loads(line) for line in data.splitlines() if line.strip()]
+    return fixtures if isinstance(fixtures, list) else [fixtures]
+
+
+def _variant_key(annotation):
+    return normalize_variant(
+        "%s:%s:%s:%s"
+        % (
+            annotation.get("chromosome"),
+            annotation.get("pos"),
+            annotation.get("ref") or "",
+            annotation.get("alt") or "",
+        )
+    )
+
+
+class MockVarSomeServer(object):
+    """
+    Local stand-in for the VarSome API, so that the client can be tested and benchmarked
+    without network access. Threaded http server answering /lookup/<query>, /lookup/<query>/<ref genome>,
+    /lookup/batch/<ref genome> and /lookup/schema like the VarSome API.
+    Coordinate queries get a synthetic annotation, or a recorded one when fixtures are given
+
+        with MockVarSomeServer(latency=0.05, throttle_rate=0.01) as server:
+            api = VarSomeAPIClient("key", api_url=server.url)
+
+    Run it standalone with python -m varsome_api.mock_server --port 8000 and pass
+    -u http://127.0.0.1:8000 to the scripts
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        latency_per_variant=0.0,
+        payload_size=None,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        error_status=503,
+        retry_after=1,
+        fixtures=None,
+        compress_responses=False,
+        seed=None,
+    ):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on. 0 picks a free port, see url
+        :param latency: seconds every request takes before it is answered
+        :param latency_per_variant: additional seconds per variant of a batch request
+        :param payload_size: approximate size in bytes of every synthetic annotation. None for the
+        minimal annotation
+        :param error_rate: fraction of requests answered with error_status
+        :param throttle_rate: fraction of requests answered with 429 and a Retry-After header
+        :param error_status: http status of the injected errors
+        :param retry_after: seconds sent in the Retry-After header of throttled requests
+        :param fixtures: list of recorded responses or path of a file to load them from with
+        load_fixtures. Queries matching a recorded variant get its response and other coordinate
+        queries a copy of the next recorded response with the coordinates of the query
+        :param compress_responses: gzip responses for clients accepting it
+        :param seed: random seed of the error and throttle injection
+        """
+        self.latency = latency
+        self.latency_per_variant = latency_per_variant
+        self.payload_size = payload_size
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.compress_responses = compress_responses
+        if isinstance(fixtures, str):
+            fixtures = load_fixtures(fixtures)
+        self.fixtures = {}
+        self._templates = []
+        for result in fixtures or ():
+            for annotation in result if isinstance(result, list) else [result]:
+                if not isinstance(annotation, dict) or "variant_id" not in annotation:
+                    continue
+                self.fixtures[_variant_key(annotation)] = result
+                self.fixtures[str(annotation["variant_id"])] = result
+                self._templates.append(annotation)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_template = 0
+        self.requests = 0
+        self.variants = 0
+        self.status_codes = {}
+        self._server = ThreadingHTTPServer((host, port), _MockRequestHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary with the number of requests, requested variants and responses per status
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "variants": self.variants,
+                "status_codes": dict(self.status_codes),
+            }
+
+    def start(self):
+        """
+        Serve requests from a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def injected_error(self):
+        """
+        :return: tuple of http status and headers of an error to answer with, or None
+        """
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return 429, {"Retry-After": str(self.retry_after)}
+        if draw < self.throttle_rate + self.error_rate:
+            return self.error_status, {}
+        return None
+
+    def record(self, status, variants):
+        with self._lock:
+            self.requests += 1
+            self.status_codes[status] = self.status_codes.get(status, 0) + 1
+            if status < 400:
+                self.variants += variants
+
+    def annotate(self, query):
+        """
+        :param query: variant representation
+        :return: annotation dictionary, or list of them for recorded queries matching several variants
+        """
+        query = str(query).strip()
+        recorded = self.fixtures.get(normalize_variant(query)) or self.fixtures.get(
+            query
+        )
+        if recorded is not None:
+            return recorded
+        match = VARIANT_RE.match(query)
+        if match is None:
+            return {"error": "Could not parse variant %s" % query}
+        chromosome = match.group("chromosome")
+        coordinates = {
+            "chromosome": "chr%s" % chromosome,
+            "pos": int(match.group("pos")),
+            "ref": match.group("ref").upper(),
+            "alt": match.group("alt").upper(),
+            # stable 20 digit identifier like the ones of the api
+            "variant_id": "%020d"
+            % (zlib.crc32(normalize_variant(query).encode("utf-8")) * 10**10),
+        }
+        if self._templates:
+            with self._lock:
+                template = self._templates[self._next_template]
+                self._next_template = (self._next_template + 1) % len(self._templates)
+            return dict(template, **coordinates)
+        annotation = dict(
+            coordinates,
+            refseq_transcripts=[
+                {
+                    "version": "1",
+                    "items": [{"name": "NM_000000", "gene_symbol": "MOCK"}],
+                }
+            ],
+            gnomad_genomes=[{"version": "2", "af": 0.0001, "an": 31000}],
+            ncbi_dbsnp=[{"version": "150", "rsid": [coordinates["pos"]]}],
+        )
+        if self.payload_size:
+            padding = self.payload_size - len(json.dumps(annotation)) - 15
+            annotation["padding"] = "x" * max(padding, 0)
+        return annotation
+
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ref_genomes = ("hg19", "hg38")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, result, headers=None):
+        body = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if self.server.mock.compress_responses and "gzip" in self.headers.get(
+            "Accept-Encoding", ""
+        ):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, variants, respond):
+        mock = self.server.mock
+        delay = mock.latency + mock.latency_per_variant * variants
+        if delay > 0:
+            time.sleep(delay)
+        error = mock.injected_error()
+        if error is not None:
+            status, headers = error
+            mock.record(status, variants)
+            return self._send(status, {"detail": "Injected error"}, headers)
+        mock.record(200, variants)
+        self._send(200, respond())
+
+    def _read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            return gzip.decompress(body)
+        if encoding == "zstd" and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        return body
+
+    def do_GET(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if parts == ["lookup", "schema"]:
+            return self._answer(0, lambda: SCHEMA)
+        if (
+            parts[0] != "lookup"
+            or len(parts) not in (2, 3)
+            or parts[2:]
+            and parts[2] not in self.ref_genomes
+        ):
+            return self._send(404, {"detail": "Not found."})
+        self._answer(1, lambda: self.server.mock.annotate(parts[1]))
+
+    def do_POST(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if (
+            parts[:2] != ["lookup", "batch"]
+            or len(parts) != 3
+            or parts[2] not in self.ref_genomes
+        ):
+            self._read_body()
+            return self._send(404, {"detail": "Not found."})
+        try:
+            variants = json.loads(self._read_body())["variants"]
+        except (ValueError, KeyError, TypeError, OSError, EOFError):
+            return self._send(400, {"detail": "Invalid request body"})
+        annotate = self.server.mock.annotate
+        self._answer(len(variants), lambda: [annotate(query) for query in variants])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock VarSome API server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", help="Seconds per request", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--latency-per-variant",
+        help="Additional seconds per variant of a batch request",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--payload-size",
+        help="Approximate size in bytes of every synthetic annotation",
+        type=int,
+    )
+    parser.add_argument(
+        "--error-rate",
+        help="Fraction of requests answered with 503",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        help="Fraction of requests answered with 429",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--fixtures", help="Json file with recorded responses to replay", type=str
+    )
+    parser.add_argument(
+        "--compress-responses",
+        help="Gzip responses for clients accepting it",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    server = MockVarSomeServer(
+        args.host,
+        args.port,
+        latency=args.latency,
+        latency_per_variant=args.latency_per_variant,
+        payload_size=args.payload_size,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        fixtures=args.fixtures,
+        compress_responses=args.compress_responses,
+    )
+    print("Serving mock VarSome API on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
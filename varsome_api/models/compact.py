@@ -0,0 +1,143 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+
+def _entries(result, name):
+    return result.get(name) or ()
+
+
+def _first(result, name, key):
+    for entry in _entries(result, name):
+        return entry.get(key)
+    return None
+
+
+def _transcript_genes(result, name):
+    return tuple(
+        item["gene_symbol"]
+        for transcript in _entries(result, name)
+        for item in transcript.get("items") or ()
+        if item.get("gene_symbol")
+    )
+
+
+def _acmg_verdict(result):
+    verdict = (result.get("acmg_annotation") or {}).get("verdict") or {}
+    return (verdict.get("ACMG_rules") or {}).get("verdict")
+
+
+# property name to function extracting it from a response dictionary.
+# Names and values match the AnnotatedVariant properties, lists are returned as tuples
+VARIANT_PROJECTION = OrderedDict(
+    [
+        ("chromosome", lambda result: result.get("chromosome")),
+        ("pos", lambda result: result.get("pos")),
+        ("ref", lambda result: result.get("ref")),
+        ("alt", lambda result: result.get("alt")),
+        ("variant_id", lambda result: result.get("variant_id")),
+        (
+            "genes",
+            lambda result: tuple(
+                sorted(
+                    set(_transcript_genes(result, "refseq_transcripts"))
+                    | set(_transcript_genes(result, "ensembl_transcripts"))
+                )
+            ),
+        ),
+        (
+            "rs_ids",
+            lambda result: tuple(
+                "rs%s" % rs_id
+                for entry in _entries(result, "ncbi_dbsnp")
+                for rs_id in entry.get("rsid") or ()
+            ),
+        ),
+        ("gnomad_exomes_af", lambda result: _first(result, "gnomad_exomes", "af")),
+        ("gnomad_exomes_an", lambda result: _first(result, "gnomad_exomes", "an")),
+        ("gnomad_genomes_af", lambda result: _first(result, "gnomad_genomes", "af")),
+        ("gnomad_genomes_an", lambda result: _first(result, "gnomad_genomes", "an")),
+        ("acmg_verdict", _acmg_verdict),
+    ]
+)
+
+
+class CompactModel(object):
+    """
+    Base of the read only __slots__ records created by compact_model
+    """
+
+    __slots__ = ()
+    _projection = OrderedDict()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        :param result: annotation dictionary as returned by the api
+        :return: record with the projected properties. The result is not validated
+        """
+        return cls(*[extract(result) for extract in cls._projection.values()])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read only" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is read only" % self.__class__.__name__)
+
+    def __reduce__(self):
+        return self.__class__, tuple(self)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join(
+                "%s=%r" % (name, value) for name, value in zip(self.__slots__, self)
+            ),
+        )
+
+    def to_dict(self):
+        return OrderedDict(zip(self.__slots__, self))
+
+
+def compact_model(name, projection):
+    """
+    Generate a read only __slots__ record class
+    :param name: class name
+    :param projection: ordered mapping of property name to function extracting it from a response dictionary
+    :return: CompactModel subclass
+    """
+    projection = OrderedDict(projection)
+    return type(
+        name,
+        (CompactModel,),
+        {"__slots__": tuple(projection), "_projection": projection},
+    )
+
+
+# compact alternative to AnnotatedVariant for the most commonly used properties
+CompactVariant = compact_model("CompactVariant", VARIANT_PROJECTION)
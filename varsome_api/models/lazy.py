@@ -0,0 +1,128 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+from weakref import WeakKeyDictionary
+
+from jsonmodels import fields, models
+
+try:
+    from jsonmodels.models import _CacheKey
+except ImportError:
+    _CacheKey = None
+
+_lazy_models = {}
+_lazy_field_classes = {}
+
+
+def _supports_lazy_fields():
+    """
+    :return: True if the installed jsonmodels has the internals lazy fields build on,
+    i.e. the per field memory keyed by the _cache_key of the model
+    """
+    if _CacheKey is None:
+        return False
+    for name in ("_check_value", "_finish_initialization", "structue_name"):
+        if not hasattr(fields.BaseField, name):
+            return False
+    return hasattr(fields.BaseField(), "memory")
+
+
+# lazy_model falls back to the model itself with jsonmodels versions that lack these internals
+LAZY_FIELDS = _supports_lazy_fields()
+
+
+class LazyModel(object):
+    """
+    Mixin of the models created by lazy_model. The response dictionary is kept as is and
+    every field is parsed the first time it is accessed and cached afterwards.
+    Embedded models and list items are lazy models as well. Values are not validated
+    """
+
+    def __init__(self, **kwargs):
+        self._cache_key = _CacheKey()
+        self._raw = kwargs
+
+
+class LazyField(object):
+    """
+    Mixin of the fields of lazy models, parsing the raw value on first access
+    """
+
+    attr_name = None
+    structure_name = None
+
+    def _check_value(self, obj):
+        if obj._cache_key in self.memory:
+            return
+        raw = obj._raw
+        if self.structure_name in raw:
+            value = raw[self.structure_name]
+        elif self.attr_name in raw:
+            value = raw[self.attr_name]
+        else:
+            value = self.get_default_value()
+        self.memory[obj._cache_key] = self.parse_value(value)
+
+
+def _lazy_types(types):
+    return tuple(
+        (
+            lazy_model(type_)
+            if isinstance(type_, type) and issubclass(type_, models.Base)
+            else type_
+        )
+        for type_ in types
+    )
+
+
+def _lazy_field(field, owner, attr_name):
+    field._finish_initialization(owner)
+    field_class = type(field)
+    if field_class not in _lazy_field_classes:
+        _lazy_field_classes[field_class] = type(
+            "Lazy%s" % field_class.__name__, (LazyField, field_class), {}
+        )
+    lazy = copy.copy(field)
+    lazy.__class__ = _lazy_field_classes[field_class]
+    lazy.memory = WeakKeyDictionary()
+    lazy.attr_name = attr_name
+    lazy.structure_name = field.structue_name(attr_name)
+    if isinstance(field, fields.ListField):
+        lazy.items_types = _lazy_types(field.items_types)
+    elif isinstance(field, fields.EmbeddedField):
+        lazy.types = _lazy_types(field.types)
+    return lazy
+
+
+def lazy_model(model_class):
+    """
+    :param model_class: jsonmodels model class
+    :return: subclass of model_class that parses its fields on demand
+    e.g. lazy_model(AnnotatedVariant)(**result).gnomad_genomes_af only parses gnomad_genomes.
+    model_class itself, which parses every field at once, if LAZY_FIELDS is False
+    """
+    if not LAZY_FIELDS:
+        return model_class
+    if model_class not in _lazy_models:
+        attributes = {
+            name: _lazy_field(field, model_class, name)
+            for name, field in model_class.iterate_over_fields()
+        }
+        attributes["__doc__"] = model_class.__doc__
+        attributes["__module__"] = model_class.__module__
+        _lazy_models[model_class] = type(
+            "Lazy%s" % model_class.__name__, (LazyModel, model_class), attributes
+        )
+    return _lazy_models[model_class]
@@ -0,0 +1,331 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+from collections import OrderedDict
+from itertools import compress
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from varsome_api.models.compact import VARIANT_PROJECTION, _first
+
+NAN = float("nan")
+
+GNOMAD_POPULATIONS = ("afr", "amr", "asj", "eas", "fin", "nfe", "oth")
+
+DBNSFP_SCORES = (
+    "sift_score",
+    "mutationtaster_score",
+    "mutationassessor_score",
+    "fathmm_score",
+    "provean_score",
+    "metasvm_score",
+    "metalr_score",
+    "cadd_phred",
+)
+
+PROJECTION_KINDS = {
+    "pos": "int",
+    "genes": "str_list",
+    "rs_ids": "str_list",
+    "gnomad_exomes_af": "float",
+    "gnomad_exomes_an": "float",
+    "gnomad_genomes_af": "float",
+    "gnomad_genomes_an": "float",
+}
+
+
+def _first_getter(name, key):
+    return lambda result: _first(result, name, key)
+
+
+def _default_columns():
+    columns = OrderedDict(
+        (name, (PROJECTION_KINDS.get(name, "str"), extract))
+        for name, extract in VARIANT_PROJECTION.items()
+    )
+    for source in ("gnomad_exomes", "gnomad_genomes"):
+        keys = ["ac"]
+        for population in GNOMAD_POPULATIONS:
+            keys.extend(["af_%s" % population, "an_%s" % population])
+        for key in keys:
+            columns["%s_%s" % (source, key)] = ("float", _first_getter(source, key))
+    for score in DBNSFP_SCORES:
+        columns["dbnsfp_%s" % score] = ("float_list", _first_getter("dbnsfp", score))
+    return columns
+
+
+# column name to (kind, function extracting the value from a response dictionary).
+# kind is one of int, float, str, str_list or float_list
+COLUMNS = _default_columns()
+
+
+class IntColumn(object):
+    """
+    64 bit integer column with a validity flag per row, so that missing values are
+    told apart from 0. Missing values are returned as None
+    """
+
+    def __init__(self, values=None, valid=None):
+        self.values = values if values is not None else array("q")
+        self.valid = valid if valid is not None else array("b")
+
+    def append(self, value):
+        self.values.append(0 if value is None else value)
+        self.valid.append(value is not None)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i] if self.valid[i] else None
+
+    def __iter__(self):
+        for value, valid in zip(self.values, self.valid):
+            yield value if valid else None
+
+
+class ListColumn(object):
+    """
+    Variable length column stored as a flat values column and offsets, so that
+    row i holds values[offsets[i]:offsets[i + 1]]
+    """
+
+    def __init__(self, values, offsets=None):
+        self.values = values
+        self.offsets = offsets if offsets is not None else array("q", [0])
+
+    def append(self, items):
+        self.values.extend(items)
+        self.offsets.append(len(self.values))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.values[self.offsets[i] : self.offsets[i + 1]]
+
+    def lengths(self):
+        return [end - start for start, end in zip(self.offsets, self.offsets[1:])]
+
+
+def _empty_column(kind):
+    if kind == "int":
+        return IntColumn()
+    if kind == "float":
+        return array("d")
+    if kind == "str_list":
+        return ListColumn([])
+    if kind == "float_list":
+        return ListColumn(array("d"))
+    return []
+
+
+def _append(column, kind, value):
+    if kind == "float":
+        column.append(NAN if value is None else value)
+    elif kind == "float_list":
+        column.append([NAN if item is None else item for item in value or ()])
+    elif kind == "str_list":
+        column.append(value or ())
+    else:
+        column.append(value)
+
+
+def _compress(column, mask):
+    """
+    :param column: column of an AnnotationTable or one of the arrays a column is made of
+    :param mask: numpy boolean array if numpy is installed, otherwise a list of booleans
+    :return: new column with the rows where mask is True
+    """
+    if isinstance(column, IntColumn):
+        return IntColumn(_compress(column.values, mask), _compress(column.valid, mask))
+    if isinstance(column, ListColumn):
+        if numpy is not None:
+            lengths = numpy.diff(numpy.frombuffer(column.offsets, dtype=numpy.int64))
+            offsets = numpy.zeros(int(mask.sum()) + 1, dtype=numpy.int64)
+            numpy.cumsum(lengths[mask], out=offsets[1:])
+            return ListColumn(
+                _compress(column.values, numpy.repeat(mask, lengths)),
+                array("q", offsets.tobytes()),
+            )
+        offsets = array("q", [0])
+        values_mask = []
+        for keep, length in zip(mask, column.lengths()):
+            values_mask.extend([keep] * length)
+            if keep:
+                offsets.append(offsets[-1] + length)
+        return ListColumn(_compress(column.values, values_mask), offsets)
+    if isinstance(column, array):
+        if numpy is not None:
+            selected = numpy.frombuffer(column, dtype=column.typecode)[mask]
+            return array(column.typecode, selected.tobytes())
+        return array(column.typecode, compress(column, mask))
+    return list(compress(column, mask))
+
+
+class AnnotationTable(object):
+    """
+    Columnar container for batch lookup results. Float columns are stored in compact
+    typed arrays with NaN for missing values, so that they can be used by numpy without
+    copying, int columns as IntColumn objects with None for missing values, string columns
+    as lists and variable length columns as ListColumn objects
+    """
+
+    def __init__(self, columns, kinds):
+        """
+        :param columns: ordered dictionary of column name to column
+        :param kinds: dictionary of column name to column kind
+        """
+        self.columns = columns
+        self.kinds = kinds
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def row(self, i):
+        """
+        :param i: row index
+        :return: dictionary of column name to value
+        """
+        return OrderedDict((name, column[i]) for name, column in self.columns.items())
+
+    def filter(self, mask):
+        """
+        :param mask: sequence of booleans, one per row, e.g. a numpy boolean array
+        :return: AnnotationTable with the rows where mask is True. With numpy installed every
+        column is filtered with the boolean mask instead of row by row
+        """
+        if numpy is not None:
+            mask = numpy.asarray(mask, dtype=bool)
+        else:
+            mask = [bool(keep) for keep in mask]
+        if len(mask) != len(self):
+            raise ValueError(
+                "Mask has %s values for a table of %s rows" % (len(mask), len(self))
+            )
+        columns = OrderedDict(
+            (name, _compress(column, mask)) for name, column in self.columns.items()
+        )
+        return AnnotationTable(columns, dict(self.kinds))
+
+    def to_numpy(self):
+        """
+        :return: dictionary of column name to numpy array. Int columns are masked arrays
+        masking the missing values and variable length columns are (values, offsets) tuples
+        of numpy arrays
+        """
+        if numpy is None:
+            raise RuntimeError("numpy is required to convert annotation tables")
+
+        def convert(column, kind):
+            if kind == "int":
+                return numpy.ma.MaskedArray(
+                    numpy.frombuffer(column.values, dtype=numpy.int64),
+                    mask=numpy.frombuffer(column.valid, dtype=numpy.int8) == 0,
+                )
+            if kind == "float":
+                return numpy.frombuffer(column, dtype=numpy.float64)
+            return numpy.array(column, dtype=object)
+
+        converted = OrderedDict()
+        for name, column in self.columns.items():
+            kind = self.kinds[name]
+            if isinstance(column, ListColumn):
+                converted[name] = (
+                    convert(column.values, kind.replace("_list", "")),
+                    numpy.frombuffer(column.offsets, dtype=numpy.int64),
+                )
+            else:
+                converted[name] = convert(column, kind)
+        return converted
+
+    def to_arrow(self):
+        """
+        :return: pyarrow Table. Missing values become nulls and variable length columns large lists
+        """
+        if pyarrow is None:
+            raise RuntimeError("pyarrow is required to convert annotation tables")
+        types = {
+            "int": pyarrow.int64(),
+            "float": pyarrow.float64(),
+            "str": pyarrow.string(),
+        }
+        arrays = []
+        for name, column in self.columns.items():
+            kind = self.kinds[name]
+            if isinstance(column, ListColumn):
+                values = pyarrow.array(
+                    column.values, types[kind.replace("_list", "")], from_pandas=True
+                )
+                arrays.append(
+                    pyarrow.LargeListArray.from_arrays(
+                        pyarrow.array(column.offsets, pyarrow.int64()), values
+                    )
+                )
+            elif isinstance(column, IntColumn):
+                arrays.append(pyarrow.array(list(column), types[kind]))
+            else:
+                arrays.append(pyarrow.array(column, types[kind], from_pandas=True))
+        return pyarrow.Table.from_arrays(arrays, names=self.names)
+
+
+def to_columns(results, fields=None):
+    """
+    Turn annotation results into an AnnotationTable with one row per annotated variant.
+    Results without a variant_id, i.e. errors and filtered out variants, are skipped
+    :param results: iterable of annotation dictionaries, e.g. as returned by batch_lookup
+    :param fields: list of column names from COLUMNS or (name, kind, function) tuples. Defaults to all COLUMNS
+    :return: AnnotationTable
+    """
+    spec = OrderedDict()
+    for field in fields or COLUMNS:
+        if isinstance(field, str):
+            spec[field] = COLUMNS[field]
+        else:
+            name, kind, extract = field
+            spec[name] = (kind, extract)
+    columns = OrderedDict(
+        (name, _empty_column(kind)) for name, (kind, _) in spec.items()
+    )
+    appenders = [
+        (columns[name], kind, extract) for name, (kind, extract) in spec.items()
+    ]
+    for result in results:
+        # queries such as rsids may match several variants
+        for annotation in result if isinstance(result, list) else [result]:
+            if not isinstance(annotation, dict) or not annotation.get("variant_id"):
+                continue
+            for column, kind, extract in appenders:
+                _append(column, kind, extract(annotation))
+    return AnnotationTable(columns, {name: kind for name, (kind, _) in spec.items()})
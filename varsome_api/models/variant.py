@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from .elements import *
+from .lazy import lazy_model
 
 
 class AnnotatedVariant(models.Base):
@@ -191,3 +192,7 @@ class AnnotatedVariant(models.Base):
         if acmg_annotation is not None and acmg_annotation.verdict is not None:
             return acmg_annotation.verdict.ACMG_rules.verdict
         return None
+
+
+# AnnotatedVariant that only parses the fields that are accessed
+LazyAnnotatedVariant = lazy_model(AnnotatedVariant)
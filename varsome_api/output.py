@@ -0,0 +1,335 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import json
+import sys
+import textwrap
+
+from jsonmodels import fields
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from varsome_api.models.variant import AnnotatedVariant
+
+
+def _to_int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_bool(value):
+    return bool(value) if value is not None else None
+
+
+def _to_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+
+def _items_type(items_types):
+    if len(items_types) == 1 and hasattr(items_types[0], "iterate_with_name"):
+        return _model_type(items_types[0])
+    items_types = set(items_types) - {type(None)}
+    if items_types and items_types <= {int, float}:
+        if float in items_types:
+            return pyarrow.float64(), _to_float
+        return pyarrow.int64(), _to_int
+    return pyarrow.string(), _to_str
+
+
+def _field_type(field):
+    """
+    :param field: jsonmodels field
+    :return: tuple of arrow type and function converting a json value to it
+    """
+    if isinstance(field, fields.ListField):
+        item_type, convert_item = _items_type(field.items_types)
+
+        def convert_list(values):
+            if not isinstance(values, list):
+                return None
+            return [convert_item(value) for value in values]
+
+        return pyarrow.list_(item_type), convert_list
+    if isinstance(field, fields.EmbeddedField):
+        return _model_type(field.types[0])
+    if isinstance(field, fields.BoolField):
+        return pyarrow.bool_(), _to_bool
+    if isinstance(field, fields.IntField):
+        return pyarrow.int64(), _to_int
+    if isinstance(field, fields.FloatField):
+        return pyarrow.float64(), _to_float
+    return pyarrow.string(), _to_str
+
+
+_model_types = {}
+
+
+def _model_type(model_class):
+    """
+    :param model_class: jsonmodels model class
+    :return: tuple of arrow struct type and function converting a json dictionary to it
+    """
+    if model_class not in _model_types:
+        struct_fields = []
+        converters = []
+        for _, name, field in model_class.iterate_with_name():
+            field_type, convert = _field_type(field)
+            struct_fields.append(pyarrow.field(name, field_type))
+            converters.append((name, convert))
+
+        def convert_model(value):
+            if not isinstance(value, dict):
+                return None
+            return {name: convert(value.get(name)) for name, convert in converters}
+
+        _model_types[model_class] = (pyarrow.struct(struct_fields), convert_model)
+    return _model_types[model_class]
+
+
+def annotation_schema(model_class=AnnotatedVariant):
+    """
+    Arrow schema derived from the fields of a model. Besides the model fields every row has
+    the query that was requested and the error or filtered out message returned for it
+    :param model_class: jsonmodels model class describing an annotation
+    :return: tuple of arrow schema and function converting an annotation dictionary to a row
+    """
+    if pyarrow is None:
+        raise RuntimeError(
+            "pyarrow is required for parquet and arrow output. "
+            "Install it with pip install varsome_api_client[columns]"
+        )
+    struct_type, convert_model = _model_type(model_class)
+    schema = pyarrow.schema(
+        [
+            pyarrow.field("query", pyarrow.string()),
+            pyarrow.field("error", pyarrow.string()),
+            pyarrow.field("filtered_out", pyarrow.string()),
+        ]
+        + list(struct_type)
+    )
+    return schema, convert_model
+
+
+class ArrowSink(object):
+    """
+    Streams annotation results to a Parquet or Arrow IPC file. Rows are buffered and
+    written as a row group (or record batch) every row_group_size rows, so memory
+    stays bounded however many results are written
+    """
+
+    formats = ("parquet", "arrow")
+
+    def __init__(
+        self,
+        path,
+        output_format=None,
+        model_class=AnnotatedVariant,
+        row_group_size=10000,
+        compression=None,
+    ):
+        """
+        :param path: output file path
+        :param output_format: parquet or arrow. Defaults to arrow for .arrow, .feather and .ipc files
+        and parquet otherwise
+        :param model_class: jsonmodels model class the schema is derived from
+        :param row_group_size: number of rows per row group
+        :param compression: optional compression codec e.g. zstd or snappy
+        """
+        if output_format is None:
+            output_format = (
+                "arrow" if path.endswith((".arrow", ".feather", ".ipc")) else "parquet"
+            )
+        if output_format not in self.formats:
+            raise ValueError("Unsupported output format %s" % output_format)
+        self.schema, self._convert = annotation_schema(model_class)
+        self.path = path
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+        self._rows = []
+        if output_format == "parquet":
+            options = {"compression": compression} if compression else {}
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema, **options)
+        else:
+            options = None
+            if compression:
+                options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+            self._writer = pyarrow.ipc.new_file(path, self.schema, options=options)
+
+    def write(self, query, result):
+        """
+        :param query: the requested variant
+        :param result: annotation dictionary, or list of them, as returned by the api
+        """
+        for annotation in result if isinstance(result, list) else [result]:
+            annotation = annotation if isinstance(annotation, dict) else {}
+            row = self._convert(annotation) or {}
+            row["query"] = query
+            row["error"] = _to_str(annotation.get("error"))
+            row["filtered_out"] = _to_str(annotation.get("filtered_out"))
+            self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def write_many(self, pairs):
+        """
+        :param pairs: iterable of (query, result) tuples as yielded by iter_batch_lookup
+        """
+        for query, result in pairs:
+            self.write(query, result)
+
+    def flush(self):
+        if not self._rows:
+            return
+        table = pyarrow.Table.from_pylist(self._rows, schema=self.schema)
+        self._writer.write_table(table)
+        self.rows_written += len(self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class NDJSONSink(object):
+    """
+    Writes one compact json line per result, optionally gzip or zstd compressed,
+    so output starts with the first completed batch and memory stays flat
+    """
+
+    compressions = ("gzip", "zstd")
+
+    def __init__(self, path=None, compression=None):
+        """
+        :param path: output file path. None for standard output
+        :param compression: gzip or zstd. Defaults to gzip for .gz files, zstd for .zst files
+        and no compression otherwise
+        """
+        if compression is None and path is not None:
+            if path.endswith(".gz"):
+                compression = "gzip"
+            elif path.endswith(".zst"):
+                compression = "zstd"
+        if compression is not None and compression not in self.compressions:
+            raise ValueError("Unsupported compression %s" % compression)
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError(
+                "zstandard is required for zstd compression. "
+                "Install it with pip install zstandard"
+            )
+        self.path = path
+        self.compression = compression
+        self.rows_written = 0
+        target = path if path is not None else sys.stdout.buffer
+        if compression == "gzip":
+            self._stream = gzip.open(target, "wt", encoding="utf-8")
+        elif compression == "zstd":
+            self._stream = zstandard.open(target, "wt", encoding="utf-8")
+        elif path is not None:
+            self._stream = open(path, "w", encoding="utf-8")
+        else:
+            self._stream = io.TextIOWrapper(
+                sys.stdout.buffer, encoding="utf-8", write_through=True
+            )
+        self._encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def write(self, query, result):
+        """
+        :param query: the requested variant
+        :param result: annotation dictionary, or list of them, as returned by the api
+        """
+        self._stream.write(self._encoder.encode(result))
+        self._stream.write("\n")
+        self.rows_written += 1
+
+    def write_many(self, pairs):
+        """
+        :param pairs: iterable of (query, result) tuples as yielded by iter_batch_lookup
+        """
+        for query, result in pairs:
+            self.write(query, result)
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        if self.path is None and self.compression is None:
+            # leave standard output open
+            self._stream.flush()
+            self._stream.detach()
+            return
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JSONSink(NDJSONSink):
+    """
+    Writes results as an indented json array one item at a time. The output is the same
+    as dumping the whole list of results at once, without keeping the results in memory
+    """
+
+    def __init__(self, path=None, compression=None, indent=4):
+        """
+        :param path: output file path. None for standard output
+        :param compression: gzip or zstd. Defaults to gzip for .gz files, zstd for .zst files
+        and no compression otherwise
+        :param indent: json indentation
+        """
+        super(JSONSink, self).__init__(path, compression)
+        self._indent = " " * indent
+        self._encoder = json.JSONEncoder(indent=indent, sort_keys=True)
+        self._stream.write("[")
+
+    def write(self, query, result):
+        self._stream.write(",\n" if self.rows_written else "\n")
+        self._stream.write(textwrap.indent(self._encoder.encode(result), self._indent))
+        self.rows_written += 1
+
+    def close(self):
+        self._stream.write("\n]\n" if self.rows_written else "]\n")
+        super(JSONSink, self).close()
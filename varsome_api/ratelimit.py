@@ -0,0 +1,153 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter for requests per second and variants per second.
+    Each request reserves one request token and as many variant tokens as the variants it carries.
+    Buckets may go into debt, so a single batch larger than the burst size is still allowed
+    and simply delays the requests that follow it.
+
+    The bucket state is kept in memory and shared by all threads using the limiter.
+    If state_file is given the state is kept in that file instead, guarded by an
+    exclusive lock, so that several processes on the same host share the same limits
+    """
+
+    _state_format = "ddd"
+
+    def __init__(
+        self,
+        requests_per_second=None,
+        variants_per_second=None,
+        burst=1.0,
+        state_file=None,
+    ):
+        """
+        :param requests_per_second: maximum sustained requests per second. None for no limit
+        :param variants_per_second: maximum sustained variants per second. None for no limit
+        :param burst: seconds worth of tokens that may be used at once after an idle period
+        :param state_file: optional path of a file used to share the limits between processes
+        """
+        if state_file is not None and fcntl is None:
+            raise RuntimeError("Sharing rate limits between processes requires fcntl")
+        self.requests_per_second = requests_per_second
+        self.variants_per_second = variants_per_second
+        self.burst = burst
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._state = None
+        self.total_wait = 0.0
+
+    def __getstate__(self):
+        # processes only share limits through state_file, never through the lock
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _capacity(self, rate):
+        return max(1.0, rate * self.burst) if rate else 0.0
+
+    def _full_state(self, now):
+        return (
+            self._capacity(self.requests_per_second),
+            self._capacity(self.variants_per_second),
+            now,
+        )
+
+    def _read_state(self, fd, now):
+        if fd is None:
+            return self._state or self._full_state(now)
+        data = os.pread(fd, struct.calcsize(self._state_format), 0)
+        if len(data) < struct.calcsize(self._state_format):
+            return self._full_state(now)
+        return struct.unpack(self._state_format, data)
+
+    def _write_state(self, fd, state):
+        if fd is None:
+            self._state = state
+            return
+        os.pwrite(fd, struct.pack(self._state_format, *state), 0)
+
+    @staticmethod
+    def _take(tokens, rate, elapsed, capacity, amount):
+        """
+        :return: remaining tokens and seconds to wait until the amount taken is covered
+        """
+        if not rate:
+            return tokens, 0.0
+        tokens = min(capacity, tokens + elapsed * rate) - amount
+        return tokens, max(0.0, -tokens / rate)
+
+    def reserve(self, variants=0):
+        """
+        Reserve tokens for a request without blocking
+        :param variants: number of variants in the request
+        :return: seconds the caller needs to wait before sending the request
+        """
+        with self._lock:
+            fd = None
+            if self.state_file is not None:
+                fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # wall clock time, since the state may be shared between processes
+                now = time.time()
+                request_tokens, variant_tokens, last = self._read_state(fd, now)
+                elapsed = max(0.0, now - last)
+                request_tokens, request_wait = self._take(
+                    request_tokens,
+                    self.requests_per_second,
+                    elapsed,
+                    self._capacity(self.requests_per_second),
+                    1,
+                )
+                variant_tokens, variant_wait = self._take(
+                    variant_tokens,
+                    self.variants_per_second,
+                    elapsed,
+                    self._capacity(self.variants_per_second),
+                    variants,
+                )
+                self._write_state(fd, (request_tokens, variant_tokens, now))
+            finally:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+            wait = max(request_wait, variant_wait)
+            self.total_wait += wait
+            return wait
+
+    def acquire(self, variants=0):
+        """
+        Block until a request carrying the given number of variants may be sent
+        :param variants: number of variants in the request
+        """
+        wait = self.reserve(variants)
+        if wait > 0:
+            time.sleep(wait)
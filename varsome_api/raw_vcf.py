@@ -0,0 +1,269 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import gzip
+import io
+
+import vcf
+
+try:
+    import cyvcf2
+except ImportError:
+    cyvcf2 = None
+
+
+def parse_info(info):
+    """
+    :param info: INFO column of a vcf line
+    :return: dictionary of field to value. Values are lists of strings, flags are True
+    """
+    fields = {}
+    if not info or info == ".":
+        return fields
+    for field in info.split(";"):
+        key, separator, value = field.partition("=")
+        fields[key] = value.split(",") if separator else True
+    return fields
+
+
+class RawInfo(dict):
+    """
+    INFO column of a RawRecord. The dictionary holds the fields set by the annotator and
+    the input INFO column is kept as it is. Reading a field that was not set parses the
+    input column on first use, with values as lists of strings since the header is not
+    consulted. Fields that are set or deleted replace the input ones when the record is written
+    """
+
+    def __init__(self, raw):
+        super(RawInfo, self).__init__()
+        self.raw = raw
+        self.replaced = set()
+        self._input = None
+
+    def input_fields(self):
+        if self._input is None:
+            self._input = parse_info(self.raw)
+        return self._input
+
+    def __missing__(self, key):
+        if key in self.replaced:
+            raise KeyError(key)
+        return self.input_fields()[key]
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        return key not in self.replaced and key in self.input_fields()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.replaced.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+        elif key not in self:
+            raise KeyError(key)
+        self.replaced.add(key)
+
+
+class RawRecord(object):
+    """
+    Vcf record with only the columns needed to request and annotate a variant tokenized.
+    QUAL, FILTER, the INFO column and the FORMAT and sample columns are kept as they are
+    and written back unchanged, apart from the INFO fields set by the annotator
+    """
+
+    __slots__ = ("CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "rest")
+
+    def __init__(self, line, strict_whitespace=True):
+        """
+        :param line: vcf record line
+        :param strict_whitespace: split columns on tabs only, otherwise on any whitespace
+        """
+        columns = line.rstrip("\r\n").split("\t" if strict_whitespace else None, 8)
+        if len(columns) < 8:
+            raise ValueError("Invalid vcf record %s" % line)
+        self.CHROM = columns[0]
+        self.POS = int(columns[1])
+        self.ID = columns[2] if columns[2] != "." else None
+        self.REF = columns[3]
+        # like vcf.Reader, missing ALT sequences are None
+        self.ALT = [alt if alt != "." else None for alt in columns[4].split(",")]
+        self.QUAL = columns[5]
+        self.FILTER = columns[6]
+        self.INFO = RawInfo(columns[7])
+        self.rest = columns[8] if len(columns) > 8 else None
+
+    def __repr__(self):
+        return "RawRecord(CHROM=%s, POS=%s, REF=%s, ALT=%s)" % (
+            self.CHROM,
+            self.POS,
+            self.REF,
+            self.ALT,
+        )
+
+
+class RawVCFReader(object):
+    """
+    Reads vcf records as RawRecord objects. Only CHROM, POS, ID, REF and ALT are
+    tokenized, which makes reading cohort vcf files with many samples much faster than vcf.Reader
+    """
+
+    def __init__(self, fsock, strict_whitespace=True):
+        """
+        :param fsock: iterable of vcf lines, header included, e.g. an open text file
+        :param strict_whitespace: split columns on tabs only, otherwise on any whitespace
+        """
+        self._reader = fsock
+        self._lines = iter(fsock)
+        self.strict_whitespace = strict_whitespace
+        self.header_lines = []
+        self._first = None
+        for line in self._lines:
+            if not line.startswith("#"):
+                self._first = line
+                break
+            self.header_lines.append(line)
+
+    def __iter__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            if first.strip():
+                yield RawRecord(first, self.strict_whitespace)
+        for line in self._lines:
+            if line.strip():
+                yield RawRecord(line, self.strict_whitespace)
+
+
+@contextlib.contextmanager
+def raw_vcf_reader(filename=None, fsock=None, strict_whitespace=True):
+    """
+    :param filename: path to a plain or gzipped vcf file
+    :param fsock: iterable of vcf lines instead of a file name
+    :param strict_whitespace: split columns on tabs only, otherwise on any whitespace
+    :return: context manager yielding a RawVCFReader
+    """
+    if fsock is None:
+        if filename.endswith(".gz"):
+            fsock = gzip.open(filename, "rt")
+        else:
+            fsock = open(filename)
+    try:
+        yield RawVCFReader(fsock, strict_whitespace)
+    finally:
+        fsock.close()
+
+
+class _CyVCF2Lines(object):
+    """
+    vcf lines of a file read with cyvcf2. cyvcf2 does not keep the input text, so every
+    record is parsed and formatted again by htslib, which may normalize it, e.g. QUAL values
+    """
+
+    def __init__(self, filename, threads=None):
+        self._vcf = cyvcf2.VCF(filename, lazy=True, threads=threads)
+
+    def __iter__(self):
+        yield self._vcf.raw_header
+        for variant in self._vcf:
+            yield str(variant)
+
+    def close(self):
+        self._vcf.close()
+
+
+@contextlib.contextmanager
+def cyvcf2_vcf_reader(filename, strict_whitespace=True, threads=None):
+    """
+    Read a vcf or bcf file with htslib through cyvcf2. Unlike raw_vcf_reader, the lines
+    are not the input text but records parsed and formatted again by htslib, so the output
+    may differ from the input in more than the annotated INFO fields. Use it for bcf input
+    :param filename: path to a vcf, bgzipped vcf or bcf file
+    :param strict_whitespace: split columns on tabs only, otherwise on any whitespace
+    :param threads: htslib decompression threads
+    :return: context manager yielding a RawVCFReader
+    """
+    if cyvcf2 is None:
+        raise RuntimeError(
+            "cyvcf2 is required for the cyvcf2 vcf backend. "
+            "Install it with pip install varsome_api_client[cyvcf2]"
+        )
+    lines = _CyVCF2Lines(filename, threads)
+    try:
+        yield RawVCFReader(lines, strict_whitespace)
+    finally:
+        lines.close()
+
+
+def cyvcf2_header(filename):
+    """
+    :param filename: path to a vcf, bgzipped vcf or bcf file
+    :return: text stream with the header of the file, e.g. to read bcf templates with vcf.Reader
+    """
+    reader = cyvcf2.VCF(filename)
+    try:
+        return io.StringIO(reader.raw_header)
+    finally:
+        reader.close()
+
+
+class VCFWriter(vcf.Writer):
+    """
+    vcf.Writer that also writes RawRecord objects, appending the INFO fields set by the annotator
+    to the input line instead of formatting every column again
+    """
+
+    def write_record(self, record):
+        if not isinstance(record, RawRecord):
+            return super(VCFWriter, self).write_record(record)
+        line = "\t".join(
+            (
+                record.CHROM,
+                str(record.POS),
+                record.ID or ".",
+                record.REF,
+                self._format_alt(record.ALT),
+                record.QUAL,
+                record.FILTER,
+                self._format_raw_info(record.INFO),
+            )
+        )
+        if record.rest is not None:
+            line = "%s\t%s" % (line, record.rest)
+        self.stream.write(line + "\n")
+
+    def _format_raw_info(self, info):
+        fields = []
+        if info.raw and info.raw != ".":
+            if info.replaced:
+                fields = [
+                    field
+                    for field in info.raw.split(";")
+                    if field.partition("=")[0] not in info.replaced
+                ]
+            else:
+                fields = [info.raw]
+        for key, value in dict.items(info):
+            field = self._stringify_pair(key, value)
+            if field:
+                fields.append(field)
+        return ";".join(fields) or "."
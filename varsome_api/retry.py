@@ -0,0 +1,153 @@
+# Copyright 2018 Saphetor S.A.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import email.utils
+import random
+import threading
+import time
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header value, either seconds or an http date
+    :return: seconds to wait or None if the value cannot be parsed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RetryPolicy(object):
+    """
+    Retry transient request failures, i.e. timeouts, connection errors and the statuses in
+    retry_statuses, with exponential backoff and jitter.
+    The delay before attempt n + 1 is backoff_factor * 2 ** (n - 1) seconds, capped at max_backoff,
+    reduced by a random fraction of up to jitter and never shorter than the Retry-After header
+    """
+
+    retry_statuses = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_attempts=5,
+        backoff_factor=1.0,
+        max_backoff=60.0,
+        jitter=0.5,
+        respect_retry_after=True,
+        split_batches=False,
+        min_split_size=1,
+    ):
+        """
+        :param max_attempts: maximum number of attempts per request, including the first one
+        :param backoff_factor: delay in seconds before the first retry
+        :param max_backoff: maximum computed delay in seconds
+        :param jitter: fraction (0 to 1) of the delay that is randomized
+        :param respect_retry_after: wait at least as long as the Retry-After header asks for
+        :param split_batches: if a batch request still fails after max_attempts, split it in half and
+        request each half separately
+        :param min_split_size: batches with fewer variants than this are not split any further
+        """
+        self.max_attempts = max_attempts
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.respect_retry_after = respect_retry_after
+        self.split_batches = split_batches
+        self.min_split_size = max(1, min_split_size)
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.splits = 0
+        self.failures = 0
+
+    def __getstate__(self):
+        # locks cannot be pickled, e.g. when sending a client to a worker process
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary with retries, splits and failures (requests that gave up) counters
+        """
+        return {
+            "retries": self.retries,
+            "splits": self.splits,
+            "failures": self.failures,
+        }
+
+    def is_retryable(self, error):
+        """
+        :param error: VarSomeAPIException instance
+        :return: True if the error is transient. Other failures, e.g. responses that cannot be
+        decoded, would fail again and are raised at once
+        """
+        return error.transient or error.status in self.retry_statuses
+
+    def should_retry(self, error, attempt):
+        """
+        :param error: VarSomeAPIException raised by the last attempt
+        :param attempt: number of attempts made so far
+        :return: True if the request should be attempted again
+        """
+        retry = self.is_retryable(error) and attempt < self.max_attempts
+        with self._lock:
+            if retry:
+                self.retries += 1
+            else:
+                self.failures += 1
+        return retry
+
+    def should_split(self, error, variants):
+        """
+        :param error: VarSomeAPIException raised after all attempts
+        :param variants: variants of the failed batch request
+        :return: True if the batch should be split in half and retried
+        """
+        split = (
+            self.split_batches
+            and self.is_retryable(error)
+            and variants is not None
+            and len(variants) > self.min_split_size
+        )
+        if split:
+            with self._lock:
+                self.splits += 1
+        return split
+
+    def get_delay(self, attempt, retry_after=None):
+        """
+        :param attempt: number of attempts made so far
+        :param retry_after: seconds requested by the server through the Retry-After header
+        :return: seconds to wait before the next attempt
+        """
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** (attempt - 1))
+        delay -= delay * self.jitter * random.random()
+        if self.respect_retry_after and retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
@@ -11,21 +11,57 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import concurrent.futures
 import contextlib
+import gzip
+import json
 import os
+import pickle
+import queue
+import re
+import shutil
+import tempfile
+import threading
 import time
-from collections import OrderedDict
+from collections import deque
+from itertools import chain
 
 import vcf
 from vcf.parser import _Info, _encode_type
 
-from varsome_api.client import VarSomeAPIClient
-from varsome_api.models.variant import AnnotatedVariant
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+from varsome_api.bgzf import BGZFWriter
+from varsome_api.cache import SQLiteCache
+from varsome_api.client import VarSomeAPIClient, chunked
+from varsome_api.models.variant import AnnotatedVariant, LazyAnnotatedVariant
+from varsome_api.output import ArrowSink
+from varsome_api.raw_vcf import (
+    VCFWriter,
+    cyvcf2,
+    cyvcf2_header,
+    cyvcf2_vcf_reader,
+    raw_vcf_reader,
+)
+
+# interval of a region e.g. 7,500,000-7,700,000, 7.5M-7.7M or 7500000- for the rest of the contig
+INTERVAL_RE = re.compile(
+    r"^(?P<start>[0-9][0-9,.]*[kmg]?)(?:(?P<range>-)(?P<end>[0-9][0-9,.]*[kmg]?)?)?$",
+    re.IGNORECASE,
+)
+POSITION_SUFFIXES = {"": 1, "k": 10**3, "m": 10**6, "g": 10**9}
+
+# pyvcf parses every column of every record, raw only tokenizes the columns needed to
+# request a variant and cyvcf2 reads lines formatted again by htslib, see varsome_api.raw_vcf
+VCF_BACKENDS = ("pyvcf", "raw", "cyvcf2")
 
 
 @contextlib.contextmanager
 def vcf_writer(*args, **kwargs):
-    writer = vcf.Writer(*args, **kwargs)
+    writer = VCFWriter(*args, **kwargs)
     yield writer
     writer.close()
 
@@ -37,11 +73,454 @@ def vcf_reader(*args, **kwargs):
     reader._reader.close()
 
 
+def prefetch(iterable, maxsize):
+    """
+    Consume an iterable in a background thread keeping at most maxsize items
+    ahead of the caller. Exceptions raised while iterating are re-raised to the caller
+    :param iterable: iterable to consume
+    :param maxsize: maximum number of items waiting to be consumed
+    :return: generator of the iterable items
+    """
+    done = object()
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ShardSource(object):
+    """
+    File like object feeding the header and the records of a vcf shard to vcf.Reader
+    """
+
+    def __init__(self, header_lines, lines, handle=None):
+        self.header_lines = header_lines
+        self.lines = lines
+        self._lines = chain(header_lines, lines)
+        self._handle = handle
+
+    def __iter__(self):
+        return self._lines
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+
+
+def is_tabix_indexed(input_vcf_file):
+    return input_vcf_file.endswith(".gz") and (
+        os.path.isfile(input_vcf_file + ".tbi")
+        or os.path.isfile(input_vcf_file + ".csi")
+    )
+
+
+def open_tabix(input_vcf_file):
+    """
+    :param input_vcf_file: path to a bgzipped vcf file with a tbi or csi index
+    :return: pysam.TabixFile
+    """
+    index = None
+    if not os.path.isfile(input_vcf_file + ".tbi"):
+        index = input_vcf_file + ".csi"
+    return pysam.TabixFile(input_vcf_file, index=index)
+
+
+def _position(value):
+    value = value.replace(",", "")
+    suffix = value[-1].lower() if value[-1].isalpha() else ""
+    number = value[: len(value) - len(suffix)]
+    return int(round(float(number) * POSITION_SUFFIXES[suffix]))
+
+
+def parse_region(region):
+    """
+    :param region: contig, contig:position, contig:start-end or contig:start- with 1-based
+    inclusive positions, optionally with thousands separators or a k, M or G suffix e.g. chr17:7.5M-7.7M
+    :return: tuple of contig, start and end, None for the end of the contig
+    """
+    contig, _, interval = region.strip().rpartition(":")
+    match = INTERVAL_RE.match(interval) if contig else None
+    if match is None:
+        return region.strip(), 1, None
+    start = _position(match.group("start"))
+    end = start
+    if match.group("range"):
+        end = _position(match.group("end")) if match.group("end") else None
+    if start < 1 or (end is not None and end < start):
+        raise ValueError("Invalid region %s" % region)
+    return contig, start, end
+
+
+def merge_regions(contigs, regions):
+    """
+    :param contigs: contigs of a tabix indexed vcf file in file order
+    :param regions: list of regions, see parse_region. Contigs match with or without a chr prefix
+    :return: list of non overlapping (contig, start, end) tuples in file order, regions on contigs
+    without records are left out
+    """
+    order = dict((contig, i) for i, contig in enumerate(contigs))
+    intervals = []
+    for region in regions:
+        # contig names like HLA-A*01:01 contain colons
+        contig, start, end = (
+            (region, 1, None) if region in order else parse_region(region)
+        )
+        if contig not in order:
+            contig = contig[3:] if contig.startswith("chr") else "chr" + contig
+            if contig not in order:
+                continue
+        intervals.append((order[contig], start, end))
+    merged = []
+    for contig, start, end in sorted(intervals, key=lambda i: (i[0], i[1])):
+        if merged and merged[-1][0] == contig:
+            last_end = merged[-1][2]
+            if last_end is None or start <= last_end + 1:
+                if last_end is not None and (end is None or end > last_end):
+                    merged[-1][2] = end
+                continue
+        merged.append([contig, start, end])
+    return [(contigs[contig], start, end) for contig, start, end in merged]
+
+
+def fetch_region(tabix_file, contig, start, end):
+    """
+    :param tabix_file: pysam.TabixFile of a vcf file
+    :param contig: contig name as in the file
+    :param start: 1-based first position
+    :param end: 1-based last position, None for the end of the contig
+    :return: generator of the vcf lines of the records starting in the region
+    """
+    for line in tabix_file.fetch(contig, start - 1, end):
+        # the index also returns records starting before the region and overlapping it,
+        # these belong to the previous region so that every record is annotated once
+        if int(line.split("\t", 2)[1]) >= start:
+            yield line
+
+
+def vcf_shards(input_vcf_file, count, regions=None):
+    """
+    Split a vcf file into shards that can be annotated independently.
+    Tabix indexed files are split by contig, plain vcf files in byte ranges of similar size
+    starting and ending at line boundaries
+    :param input_vcf_file: path to the vcf file
+    :param count: number of shards for plain vcf files
+    :param regions: optional list of regions to restrict tabix indexed files to, one shard per
+    region. See merge_regions
+    :return: list of shards in file order, either ("region", contig, start, end) or ("bytes", start, end)
+    """
+    if regions and not is_tabix_indexed(input_vcf_file):
+        raise RuntimeError(
+            "Annotating regions requires a bgzipped and tabix indexed vcf file"
+        )
+    if is_tabix_indexed(input_vcf_file):
+        if pysam is None:
+            raise RuntimeError("pysam is required to split tabix indexed vcf files")
+        with open_tabix(input_vcf_file) as tabix_file:
+            if regions:
+                return [
+                    ("region",) + interval
+                    for interval in merge_regions(tabix_file.contigs, regions)
+                ]
+            return [("region", contig, 1, None) for contig in tabix_file.contigs]
+    if input_vcf_file.endswith(".gz"):
+        raise RuntimeError(
+            "Compressed vcf files need a tabix index to be annotated in parallel"
+        )
+    with open(input_vcf_file, "rb") as f:
+        header_end = 0
+        for line in iter(f.readline, b""):
+            if not line.startswith(b"#"):
+                break
+            header_end = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        boundaries = [header_end]
+        for i in range(1, count):
+            f.seek(max(header_end + (size - header_end) * i // count, boundaries[-1]))
+            if f.tell() > header_end:
+                # move to the start of the next line
+                f.seek(f.tell() - 1)
+                f.readline()
+            boundaries.append(f.tell())
+        boundaries.append(size)
+    return [
+        ("bytes", start, end)
+        for start, end in zip(boundaries, boundaries[1:])
+        if end > start
+    ]
+
+
+def open_vcf_shard(input_vcf_file, shard):
+    """
+    :param input_vcf_file: path to the vcf file
+    :param shard: shard as returned by vcf_shards
+    :return: ShardSource with the vcf header and the records of the shard
+    """
+    if shard[0] == "region":
+        tabix_file = open_tabix(input_vcf_file)
+        return ShardSource(
+            tabix_file.header,
+            fetch_region(tabix_file, *shard[1:]),
+            handle=tabix_file,
+        )
+    _, start, end = shard
+    f = open(input_vcf_file, "rb")
+    header_lines = []
+    for line in iter(f.readline, b""):
+        if not line.startswith(b"#"):
+            break
+        header_lines.append(line.decode("utf-8"))
+    f.seek(start)
+
+    def lines():
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                return
+            yield line.decode("utf-8")
+
+    return ShardSource(header_lines, lines(), handle=f)
+
+
+def open_vcf_regions(input_vcf_file, regions):
+    """
+    :param input_vcf_file: path to a bgzipped and tabix indexed vcf file
+    :param regions: list of regions, see merge_regions
+    :return: ShardSource with the vcf header and the records starting in the regions, read
+    through the index in file order
+    """
+    shards = vcf_shards(input_vcf_file, 1, regions)
+    tabix_file = open_tabix(input_vcf_file)
+    lines = chain.from_iterable(
+        fetch_region(tabix_file, *shard[1:]) for shard in shards
+    )
+    return ShardSource(tabix_file.header, lines, handle=tabix_file)
+
+
+def open_vcf_after(input_vcf_file, records, regions=None):
+    """
+    :param input_vcf_file: path to a plain or gzipped vcf file
+    :param records: number of records to skip
+    :param regions: optional list of regions to restrict a tabix indexed vcf file to
+    :return: ShardSource with the vcf header and the records following the first records
+    """
+    if regions:
+        source = open_vcf_regions(input_vcf_file, regions)
+        for _ in range(records):
+            if next(source.lines, None) is None:
+                break
+        return source
+    if input_vcf_file.endswith(".gz"):
+        f = gzip.open(input_vcf_file, "rt")
+    else:
+        f = open(input_vcf_file)
+    header_lines = []
+    for line in f:
+        if not line.startswith("#"):
+            break
+        header_lines.append(line)
+    else:
+        return ShardSource(header_lines, iter(()), handle=f)
+    lines = chain([line], f)
+    for _ in range(records):
+        if next(lines, None) is None:
+            break
+    return ShardSource(header_lines, lines, handle=f)
+
+
+def index_vcf(vcf_file, index="tbi"):
+    """
+    :param vcf_file: path to a bgzipped vcf file sorted by contig and position
+    :param index: tbi, or csi for contigs longer than 512 Mbp
+    :return: path to the index
+    """
+    if pysam is None:
+        raise RuntimeError(
+            "pysam is required to index vcf files. "
+            "Install it with pip install varsome_api_client[tabix]"
+        )
+    pysam.tabix_index(vcf_file, preset="vcf", force=True, csi=index == "csi")
+    return "%s.%s" % (vcf_file, index)
+
+
+class HeaderlessStream(object):
+    """
+    Wraps an output stream and drops everything written to it until header_written is set.
+    Used to append records to a partially written vcf file with vcf.Writer,
+    which always writes the header on creation
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.header_written = False
+
+    def write(self, data):
+        if self.header_written:
+            return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+class AnnotationCheckpoint(object):
+    """
+    Append only journal of the progress of a vcf annotation. The first line holds the arguments
+    of the run and every following line the number of input records fully written, the size of
+    the output file at that point and the variant counters. A crash may leave a truncated last
+    line, which is ignored
+    """
+
+    def __init__(self, path, arguments):
+        """
+        :param path: path to the journal file
+        :param arguments: json serializable dictionary identifying the run
+        """
+        self.path = path
+        # compare arguments the way they are read back from the journal
+        self.arguments = json.loads(json.dumps(arguments))
+        self._handle = None
+
+    def load(self):
+        """
+        :return: the last complete checkpoint or None if there is none
+        """
+        if not os.path.isfile(self.path):
+            return None
+        checkpoint = None
+        with open(self.path) as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return None
+            if header.get("arguments") != self.arguments:
+                raise RuntimeError(
+                    "Checkpoint %s was created with different arguments. "
+                    "Remove it to start over" % self.path
+                )
+            for line in f:
+                try:
+                    checkpoint = json.loads(line)
+                except ValueError:
+                    break
+        return checkpoint
+
+    def start(self, checkpoint=None):
+        """
+        Rewrite the journal keeping only the checkpoint the run resumes from
+        :param checkpoint: checkpoint as returned by load or None
+        """
+        self._handle = open(self.path, "w")
+        self._handle.write(json.dumps({"arguments": self.arguments}) + "\n")
+        if checkpoint is not None:
+            self._handle.write(json.dumps(checkpoint) + "\n")
+        self._handle.flush()
+
+    def write(self, **checkpoint):
+        self._handle.write(json.dumps(checkpoint) + "\n")
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def alt_index(record, requested_variant):
+    """
+    :param record: vcf record object
+    :param requested_variant: variant requested for one of the ALT sequences of the record
+    :return: index of the ALT sequence of requested_variant in record.ALT
+    """
+    alt = requested_variant.rsplit(":", 1)[1]
+    for i, alt_seq in enumerate(record.ALT):
+        if alt_seq is None or alt_seq == ".":
+            alt_seq = ""
+        if str(alt_seq) == alt:
+            return i
+    raise ValueError("%s is not an ALT sequence of the record" % requested_variant)
+
+
+def set_allele_info(record, key, requested_variant, value):
+    """
+    Set the value of a Number=A INFO field for the ALT sequence of requested_variant,
+    leaving the values of the other ALT sequences as they are
+    :param record: vcf record object
+    :param key: INFO field
+    :param requested_variant: variant requested for one of the ALT sequences of the record
+    :param value: value for that ALT sequence
+    """
+    values = record.INFO.get(key)
+    if not isinstance(values, list) or len(values) != len(record.ALT):
+        values = record.INFO[key] = [None] * len(record.ALT)
+    values[alt_index(record, requested_variant)] = value
+
+
+def annotate_shard(annotator, input_vcf_file, shard, output_vcf_file, template, kwargs):
+    """
+    Annotate a single shard. Runs in a worker process of VCFAnnotator.annotate_parallel
+    :return: tuple of total, filtered out and failed variants
+    """
+    annotator.total_variants = 0
+    annotator.filtered_out_variants = 0
+    annotator.variants_with_errors = 0
+    with annotator.open_records(
+        fsock=open_vcf_shard(input_vcf_file, shard),
+        strict_whitespace=kwargs.get("strict_whitespace", True),
+    ) as reader:
+        annotator.annotate_reader(reader, output_vcf_file, template, **kwargs)
+    return (
+        annotator.total_variants,
+        annotator.filtered_out_variants,
+        annotator.variants_with_errors,
+    )
+
+
 class VCFAnnotator(VarSomeAPIClient):
     """
     VCFAnnotator will take an input vcf file parse it and produce an annotated vcf file
     """
 
+    # Number=A INFO fields added by add_vcf_header_info
+    _allele_fields = ()
+
     def __init__(
         self,
         api_key=None,
@@ -51,88 +530,263 @@ class VCFAnnotator(VarSomeAPIClient):
         ref_genome="hg19",
         get_parameters=None,
         max_threads=None,
+        cache=None,
+        adaptive=None,
+        retry=None,
+        rate_limiter=None,
+        lazy_models=False,
+        request_compression=None,
+        timeout=None,
+        hooks=None,
+        vcf_backend="pyvcf",
     ):
-        super().__init__(api_key, logger, api_url, max_variants_per_batch)
+        """
+        :param lazy_models: build results as LazyAnnotatedVariant objects, which only parse the
+        properties read by annotate_record instead of the whole response
+        :param request_compression: gzip or zstd to compress the body of batch requests
+        :param timeout: seconds to wait for the server, either a single value or a (connect, read) tuple
+        :param hooks: optional list of varsome_api.metrics.RequestHooks instances notified when
+        every request starts and finishes. annotate_parallel sends pickled copies of them to every
+        worker process, so it only accepts hooks that can be pickled, e.g. RequestMetrics but not
+        PrometheusHooks, and what the copies record is not sent back
+        :param vcf_backend: pyvcf to read records with vcf.Reader, raw to only tokenize the columns
+        needed to request a variant and write the rest of every line back as it is, or cyvcf2 to
+        read vcf and bcf files with htslib, which formats every record again before it is
+        handled like raw, so the rest of the line is htslib output. Records passed to annotate_record are
+        varsome_api.raw_vcf.RawRecord objects with the raw and cyvcf2 backends
+        """
+        if vcf_backend not in VCF_BACKENDS:
+            raise ValueError("Unsupported vcf backend %s" % vcf_backend)
+        if vcf_backend == "cyvcf2" and cyvcf2 is None:
+            raise RuntimeError(
+                "cyvcf2 is required for the cyvcf2 vcf backend. "
+                "Install it with pip install varsome_api_client[cyvcf2]"
+            )
+        super().__init__(
+            api_key,
+            logger,
+            api_url,
+            max_variants_per_batch,
+            cache=cache,
+            adaptive=adaptive,
+            retry=retry,
+            rate_limiter=rate_limiter,
+            request_compression=request_compression,
+            timeout=timeout,
+            hooks=hooks,
+        )
         self.ref_genome = ref_genome
         self.get_parameters = get_parameters
+        self.variant_model = LazyAnnotatedVariant if lazy_models else AnnotatedVariant
         self.total_variants = 0
         self.filtered_out_variants = 0
         self.variants_with_errors = 0
         self.max_threads = max_threads or 1
-        if self.max_variants_per_batch > 3000 and self.max_threads > 1:
+        self.vcf_backend = vcf_backend
+        if (
+            self.adaptive is None
+            and self.max_variants_per_batch > 3000
+            and self.max_threads > 1
+        ):
             self.logger.warning(
                 "Having more than 1 thread with more than 3000 variants per batch may not be optimal"
             )
 
-    def _process_request(self, input_batch, writer):
-        start = time.time()
-        input_batch_variants = list(input_batch.keys())
-        api_results = self.batch_lookup(
-            input_batch_variants,
-            params=self.get_parameters,
-            ref_genome=self.ref_genome,
-            max_threads=self.max_threads,
-        )
-        duration = time.time() - start
-        self.logger.info(
-            "Annotated %s variants from a source of %s in %s"
-            % (len(api_results), len(input_batch), duration)
+    def open_records(self, filename=None, fsock=None, strict_whitespace=True):
+        """
+        :param filename: path to the vcf file
+        :param fsock: iterable of vcf lines instead of a file name. The cyvcf2 backend
+        needs a file name and reads streams like the raw backend
+        :param strict_whitespace: split columns on tabs only, otherwise on any whitespace
+        :return: context manager yielding a reader of the records with the vcf backend
+        """
+        if self.vcf_backend == "cyvcf2" and fsock is None:
+            return cyvcf2_vcf_reader(filename, strict_whitespace)
+        if self.vcf_backend != "pyvcf":
+            return raw_vcf_reader(filename, fsock, strict_whitespace)
+        return vcf_reader(
+            filename=filename, fsock=fsock, strict_whitespace=strict_whitespace
         )
-        self.logger.info("Writing to output vcf file")
 
-        for i, results in enumerate(api_results):
+    def _variant_result(self, requested_variant, results):
+        """
+        :param requested_variant: variant as requested
+        :param results: annotation dictionary as returned by the api
+        :return: variant model object, or None for filtered out variants and errors
+        """
+        try:
+            if results:
+                if "filtered_out" in results:
+                    self.logger.info(
+                        "%s: %s" % (requested_variant, results["filtered_out"])
+                    )
+                    self.filtered_out_variants += 1
+                    return None
+                if "error" in results:
+                    self.logger.error("%s: %s" % (requested_variant, results["error"]))
+                    self.variants_with_errors += 1
+                    return None
+                if results.get("variant_id"):
+                    return self.variant_model(**results)
+                self.logger.error("%s: %s" % (requested_variant, results))
+                self.variants_with_errors += 1
+        except Exception as e:
+            self.logger.error("Result set error %s, %s" % (e, results))
+            self.variants_with_errors += 1
+        return None
+
+    def _write_record(self, record, alleles, writer):
+        """
+        Assemble the results of every ALT sequence of a record onto it and write it once.
+        Records without any annotated ALT sequence are left out, like filtered out variants
+        :param record: vcf record object
+        :param alleles: list of (requested variant, variant model or None) tuples, one per ALT sequence
+        :param writer: vcf writer object
+        """
+        if all(variant_result is None for _, variant_result in alleles):
+            return
+        for key in self._allele_fields:
+            record.INFO[key] = [None] * len(record.ALT)
+        for requested_variant, variant_result in alleles:
+            if variant_result is None:
+                continue
             try:
-                record = input_batch[input_batch_variants[i]]
-                if results:
-                    if "filtered_out" in results:
-                        self.logger.info(
-                            "%s: %s"
-                            % (input_batch_variants[i], results["filtered_out"])
-                        )
-                        self.filtered_out_variants += 1
-                        continue
-                    if "error" in results:
-                        self.logger.error(
-                            "%s: %s" % (input_batch_variants[i], results["error"])
-                        )
-                        self.variants_with_errors += 1
-                        continue
-                    if results.get("variant_id"):
-                        variant_result = AnnotatedVariant(**results)
-                        record = self.annotate_record(
-                            record, variant_result, input_batch_variants[i]
-                        )
-                        writer.write_record(record)
-                    else:
-                        self.logger.error("%s: %s" % (input_batch_variants[i], results))
-                        self.variants_with_errors += 1
+                record = self.annotate_record(record, variant_result, requested_variant)
             except Exception as e:
-                self.logger.error("Result set error %s, %s" % (e, results))
+                self.logger.error("Result set error %s, %s" % (e, requested_variant))
+                self.variants_with_errors += 1
+        for key in self._allele_fields:
+            values = record.INFO.get(key)
+            if isinstance(values, list) and all(value is None for value in values):
+                del record.INFO[key]
+        writer.write_record(record)
+
+    def _sink_result(self, requested_variant, record, results, sink):
+        if isinstance(results, dict):
+            if "filtered_out" in results:
+                self.filtered_out_variants += 1
+            elif "error" in results or not results.get("variant_id"):
                 self.variants_with_errors += 1
-                pass  # log an exception..
+        sink.write(requested_variant, results)
+
+    def _read_variants(self, reader):
+        """
+        :param reader: vcf reader object
+        :return: generator of (requested variant, record, last) tuples, one per ALT sequence.
+        last is True for the last ALT sequence of a record
+        """
+        for record in reader:
+            reference_sequence = record.REF
+            if reference_sequence is None or reference_sequence == ".":
+                reference_sequence = ""
+            alt_count = len(record.ALT)
+            for i, alt_seq in enumerate(record.ALT):
+                if alt_seq is None or alt_seq == ".":
+                    alt_seq = ""
+                requested_variant = "%s:%s:%s:%s" % (
+                    record.CHROM,
+                    record.POS,
+                    reference_sequence,
+                    alt_seq,
+                )
+                self.total_variants += 1
+                yield requested_variant, record, i == alt_count - 1
+
+    def _annotate_records(self, reader, writer, on_checkpoint=None):
+        """
+        Reading, annotating and writing run as a pipeline. A background thread parses the input
+        into a bounded queue, up to max_threads * 2 batches are in flight and results are written
+        in input order as soon as the oldest batch completes
+        :param on_checkpoint: optional callable called with the number of records and variants
+        written so far, roughly every max_variants_per_batch variants and always at a record boundary
+        """
+        records = deque()
+        sink = isinstance(writer, ArrowSink)
+        alleles = []
+
+        def requested_variants():
+            for chunk in prefetch(
+                chunked(self._read_variants(reader), self.max_variants_per_batch),
+                self.max_threads * 2,
+            ):
+                for requested_variant, record, last in chunk:
+                    records.append((record, last))
+                    yield requested_variant
+
+        start = time.time()
+        written_records = 0
+        checkpoint_at = self.max_variants_per_batch
+        for i, (requested_variant, results) in enumerate(
+            self.iter_batch_lookup(
+                requested_variants(),
+                params=self.get_parameters,
+                ref_genome=self.ref_genome,
+                max_threads=self.max_threads,
+            ),
+            1,
+        ):
+            record, last = records.popleft()
+            if sink:
+                self._sink_result(requested_variant, record, results, writer)
+            else:
+                alleles.append(
+                    (
+                        requested_variant,
+                        self._variant_result(requested_variant, results),
+                    )
+                )
+            if last:
+                if not sink:
+                    self._write_record(record, alleles, writer)
+                    alleles = []
+                written_records += 1
+                if on_checkpoint is not None and i >= checkpoint_at:
+                    on_checkpoint(written_records, i)
+                    checkpoint_at = i + self.max_variants_per_batch
+            if i % self.max_variants_per_batch == 0:
+                self.logger.info(
+                    "Annotated %s variants in %s" % (i, time.time() - start)
+                )
 
     def annotate_record(self, record, variant_result, original_variant):
         """
         Method to annotate a record. You should override this with your own implementation
-        to include variant result properties you want in your output vcf
+        to include variant result properties you want in your output vcf.
+        It is called for every annotated ALT sequence of a record and the record is written once
+        all of them have been annotated. Use set_allele_info for values that differ per ALT sequence
+        and declare them with Number=A in add_vcf_header_info
         :param record: vcf record object
         :param variant_result: AnnotatedVariant object
         :param original_variant: The variant as present in the request
         :return: annotated record object
         """
-        record.INFO["variant_id"] = variant_result.variant_id
-        record.INFO["gene"] = ",".join(variant_result.genes)
-        record.INFO["gnomad_exomes_AF"] = variant_result.gnomad_exomes_af
-        record.INFO["gnomad_genomes_AF"] = variant_result.gnomad_genomes_af
+        set_allele_info(
+            record, "variant_id", original_variant, variant_result.variant_id
+        )
+        set_allele_info(
+            record, "gene", original_variant, "&".join(variant_result.genes) or None
+        )
+        set_allele_info(
+            record,
+            "gnomad_exomes_AF",
+            original_variant,
+            variant_result.gnomad_exomes_af,
+        )
+        set_allele_info(
+            record,
+            "gnomad_genomes_AF",
+            original_variant,
+            variant_result.gnomad_genomes_af,
+        )
         acmg_verdict = variant_result.acmg_verdict
         if acmg_verdict is not None:
             acmg_verdict = acmg_verdict.replace(" ", "_")
-        record.INFO["acmg_verdict"] = acmg_verdict
-        record.INFO["original_variant"] = original_variant
-        record.REF = variant_result.ref or "."
-        record.ALT = [variant_result.alt]
-        record.POS = variant_result.pos
-        record.ID = ";".join(variant_result.rs_ids) or "."
+        set_allele_info(record, "acmg_verdict", original_variant, acmg_verdict)
+        set_allele_info(record, "original_variant", original_variant, original_variant)
+        ids = record.ID.split(";") if record.ID and record.ID != "." else []
+        rs_ids = [rs_id for rs_id in variant_result.rs_ids if rs_id not in ids]
+        if rs_ids:
+            record.ID = ";".join(ids + rs_ids)
         return record
 
     def add_vcf_header_info(self, vcf_template):
@@ -145,7 +799,7 @@ class VCFAnnotator(VarSomeAPIClient):
         """
         vcf_template.infos["variant_id"] = _Info(
             "variant_id",
-            1,
+            "A",
             "Integer",
             "Saphetor variant identifier",
             None,
@@ -154,16 +808,16 @@ class VCFAnnotator(VarSomeAPIClient):
         )
         vcf_template.infos["gene"] = _Info(
             "gene",
-            ".",
+            "A",
             "String",
-            "Genes related to this variant",
+            "Genes related to this variant, separated by &",
             None,
             None,
             _encode_type("String"),
         )
         vcf_template.infos["gnomad_exomes_AF"] = _Info(
             "gnomad_exomes_AF",
-            1,
+            "A",
             "Float",
             "GnomAD exomes allele frequency value",
             None,
@@ -172,7 +826,7 @@ class VCFAnnotator(VarSomeAPIClient):
         )
         vcf_template.infos["gnomad_genomes_AF"] = _Info(
             "gnomad_genomes_AF",
-            1,
+            "A",
             "Float",
             "GnomAD genomes allele frequency value",
             None,
@@ -181,7 +835,7 @@ class VCFAnnotator(VarSomeAPIClient):
         )
         vcf_template.infos["acmg_verdict"] = _Info(
             "acmg_verdict",
-            ".",
+            "A",
             "String",
             "ACMG Classification Verdict",
             None,
@@ -190,7 +844,7 @@ class VCFAnnotator(VarSomeAPIClient):
         )
         vcf_template.infos["original_variant"] = _Info(
             "original_variant",
-            ".",
+            "A",
             "String",
             "Variant as present in the request",
             None,
@@ -198,57 +852,353 @@ class VCFAnnotator(VarSomeAPIClient):
             _encode_type("String"),
         )
 
-    def annotate(self, input_vcf_file, output_vcf_file=None, template=None, **kwargs):
+    def annotate(
+        self,
+        input_vcf_file,
+        output_vcf_file=None,
+        template=None,
+        checkpoint=False,
+        output_format="vcf",
+        regions=None,
+        index="tbi",
+        compression_threads=None,
+        **kwargs,
+    ):
         """
         :param input_vcf_file: The input vcf file to be annotated
         :param output_vcf_file: The file to write annotations back if none input_vcf_file.annotated.vcf will be
         generated instead
         :param template: An alternate vcf file to use for vcf file headers. If none the input vcf file will
         be used
+        :param checkpoint: If True the progress is journaled to output_vcf_file.checkpoint and fetched
+        annotations are kept in output_vcf_file.checkpoint.sqlite unless an SQLiteCache is already used.
+        If a previous run with the same arguments was interrupted, annotation resumes from its last
+        checkpoint and appends to the partial output. Both files are removed once annotation completes
+        :param output_format: vcf, or parquet or arrow to write the full annotations of every variant
+        to a columnar file instead, see varsome_api.output.ArrowSink
+        :param regions: optional list of regions e.g. ["chr17:7.5M-7.7M"] to only annotate the
+        records starting in them, read through the index of a bgzipped and tabix indexed input.
+        See parse_region
+        :param index: tbi or csi index written for bgzipped output, i.e. an output_vcf_file ending
+        with .gz, or None
+        :param compression_threads: threads compressing bgzipped output. Defaults to the number of cpus
         :return:
         """
         annotations_start = time.time()
         if not os.path.isfile(input_vcf_file):
             raise FileNotFoundError("%s does not exist" % input_vcf_file)
+        if checkpoint and output_format != "vcf":
+            raise ValueError("Checkpoints are only supported for vcf output")
         if output_vcf_file is None:
-            output_vcf_file = "%s.annotated.vcf" % input_vcf_file
+            output_vcf_file = "%s.annotated.%s" % (input_vcf_file, output_format)
+        if output_format == "vcf":
+            self._check_index(output_vcf_file, index)
         if template is None:
             template = input_vcf_file
+        if checkpoint:
+            self._annotate_with_checkpoint(
+                input_vcf_file,
+                output_vcf_file,
+                template,
+                regions=regions,
+                index=index,
+                compression_threads=compression_threads,
+                **kwargs,
+            )
+        else:
+            if regions:
+                source = {"fsock": open_vcf_regions(input_vcf_file, regions)}
+            else:
+                source = {"filename": input_vcf_file}
+            with self.open_records(
+                strict_whitespace=kwargs.get("strict_whitespace", True), **source
+            ) as reader:
+                self.annotate_reader(
+                    reader,
+                    output_vcf_file,
+                    template,
+                    output_format=output_format,
+                    index=index,
+                    compression_threads=compression_threads,
+                    **kwargs,
+                )
+        self._log_summary(annotations_start)
+
+    def _annotate_with_checkpoint(
+        self, input_vcf_file, output_vcf_file, template, regions=None, **kwargs
+    ):
+        arguments = {
+            "input_vcf_file": os.path.abspath(input_vcf_file),
+            "input_size": os.path.getsize(input_vcf_file),
+            "input_mtime": os.path.getmtime(input_vcf_file),
+            "template": os.path.abspath(template),
+            "ref_genome": self.ref_genome,
+            "get_parameters": self.get_parameters,
+        }
+        if regions:
+            arguments["regions"] = regions
+        journal = AnnotationCheckpoint("%s.checkpoint" % output_vcf_file, arguments)
+        state = journal.load()
+        if state is not None and not (
+            os.path.isfile(output_vcf_file)
+            and os.path.getsize(output_vcf_file) >= state["output_size"]
+        ):
+            self.logger.warning(
+                "Output %s does not match checkpoint %s, starting over"
+                % (output_vcf_file, journal.path)
+            )
+            state = None
+        if state is None:
+            state = {
+                "records": 0,
+                "output_size": None,
+                "total_variants": 0,
+                "filtered_out_variants": 0,
+                "variants_with_errors": 0,
+            }
+        else:
+            self.logger.info(
+                "Resuming from checkpoint after %s records and %s variants"
+                % (state["records"], state["total_variants"])
+            )
+        # counters of this run only, without the ones of earlier calls to annotate
+        base_filtered_out = self.filtered_out_variants
+        base_errors = self.variants_with_errors
+        self.total_variants += state["total_variants"]
+        self.filtered_out_variants += state["filtered_out_variants"]
+        self.variants_with_errors += state["variants_with_errors"]
+
+        def on_checkpoint(records, variants, output_size):
+            journal.write(
+                records=state["records"] + records,
+                output_size=output_size,
+                total_variants=state["total_variants"] + variants,
+                filtered_out_variants=self.filtered_out_variants - base_filtered_out,
+                variants_with_errors=self.variants_with_errors - base_errors,
+            )
+
+        cache = self.cache
+        if not isinstance(cache, SQLiteCache):
+            self.cache = SQLiteCache("%s.checkpoint.sqlite" % output_vcf_file)
+        try:
+            journal.start(state if state["records"] else None)
+            with self.open_records(
+                fsock=open_vcf_after(input_vcf_file, state["records"], regions),
+                strict_whitespace=kwargs.get("strict_whitespace", True),
+            ) as reader:
+                self.annotate_reader(
+                    reader,
+                    output_vcf_file,
+                    template,
+                    resume_from=state["output_size"],
+                    on_checkpoint=on_checkpoint,
+                    **kwargs,
+                )
+        finally:
+            journal.close()
+            if self.cache is not cache:
+                self.cache.close()
+                self.cache = cache
+        journal.remove()
+        if not isinstance(cache, SQLiteCache):
+            for suffix in ("", "-wal", "-shm"):
+                path = "%s.checkpoint.sqlite%s" % (output_vcf_file, suffix)
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def annotate_reader(
+        self,
+        reader,
+        output_vcf_file,
+        template,
+        resume_from=None,
+        on_checkpoint=None,
+        output_format="vcf",
+        index="tbi",
+        compression_threads=None,
+        **kwargs,
+    ):
+        """
+        Annotate the records of an open vcf reader
+        :param reader: vcf reader object
+        :param output_vcf_file: The file to write annotations to
+        :param template: vcf file to use for vcf file headers
+        :param resume_from: size in bytes of a partially written output_vcf_file to append to.
+        The output is truncated to that size and no header is written
+        :param on_checkpoint: optional callable called with the number of records and variants
+        written so far and the size of the output file once they are safely on disk
+        :param output_format: vcf, parquet or arrow
+        :param index: tbi or csi index written for bgzipped output, or None
+        :param compression_threads: threads compressing bgzipped output
+        :return:
+        """
+        if output_format != "vcf":
+            with ArrowSink(
+                output_vcf_file,
+                output_format,
+                row_group_size=self.max_variants_per_batch,
+            ) as sink:
+                self._annotate_records(reader, sink)
+            return
+        if self.vcf_backend == "cyvcf2" and template.endswith(".bcf"):
+            template_source = {"fsock": cyvcf2_header(template)}
+        else:
+            template_source = {"filename": template}
         with vcf_reader(
-            filename=input_vcf_file,
             strict_whitespace=kwargs.get("strict_whitespace", True),
-        ) as reader:
-            with vcf_reader(
-                filename=template,
-                strict_whitespace=kwargs.get("strict_whitespace", True),
-            ) as vcf_template:
-                self.add_vcf_header_info(vcf_template)
-                with vcf_writer(open(output_vcf_file, "w"), vcf_template) as writer:
-                    input_batch = OrderedDict()
-                    batch_limit = self.max_variants_per_batch * self.max_threads * 2
-                    for record in reader:
-                        reference_sequence = record.REF
-                        if reference_sequence is None or reference_sequence == ".":
-                            reference_sequence = ""
-                        for alt_seq in record.ALT:
-                            if alt_seq is None or alt_seq == ".":
-                                alt_seq = ""
-                            requested_variant = "%s:%s:%s:%s" % (
-                                record.CHROM,
-                                record.POS,
-                                reference_sequence,
-                                alt_seq,
-                            )
-                            input_batch[requested_variant] = record
-                            self.total_variants += 1
-                        if len(input_batch) < batch_limit:
-                            continue
-                        self._process_request(input_batch, writer)
-                        # reset input batch
-                        input_batch = OrderedDict()
-                        # we may have some variants remaining if input batch is less than batch size
-                    if len(input_batch) > 0:
-                        self._process_request(input_batch, writer)
+            **template_source,
+        ) as vcf_template:
+            infos = dict(vcf_template.infos)
+            self.add_vcf_header_info(vcf_template)
+            # per ALT fields added by the annotator are reset for every record
+            self._allele_fields = [
+                key
+                for key, info in vcf_template.infos.items()
+                if infos.get(key) is not info and info.num in ("A", -1)
+            ]
+            compressed = output_vcf_file.endswith(".gz")
+            if resume_from is None:
+                output = open(output_vcf_file, "wb" if compressed else "w")
+            else:
+                # a checkpoint flushes the bgzf writer, so the output ends with a complete block
+                output = open(output_vcf_file, "r+b" if compressed else "r+")
+                output.truncate(resume_from)
+                output.seek(0, os.SEEK_END)
+            stream = output
+            if compressed:
+                stream = BGZFWriter(output, compression_threads)
+            if resume_from is not None:
+                stream = HeaderlessStream(stream)
+            with vcf_writer(stream, vcf_template) as writer:
+                if resume_from is not None:
+                    stream.header_written = True
+
+                def checkpoint_output(records, variants):
+                    writer.flush()
+                    os.fsync(output.fileno())
+                    on_checkpoint(records, variants, os.fstat(output.fileno()).st_size)
+
+                self._annotate_records(
+                    reader,
+                    writer,
+                    checkpoint_output if on_checkpoint is not None else None,
+                )
+        if compressed and index:
+            self._index_output(output_vcf_file, index)
+
+    def _check_index(self, output_vcf_file, index):
+        if index not in (None, "tbi", "csi"):
+            raise ValueError("Unsupported index %s" % index)
+        if output_vcf_file.endswith(".gz") and index and pysam is None:
+            raise RuntimeError(
+                "pysam is required to index bgzipped output. "
+                "Install it with pip install varsome_api_client[tabix] or pass index=None"
+            )
+
+    def _index_output(self, output_vcf_file, index):
+        try:
+            index_vcf(output_vcf_file, index)
+        except (OSError, ValueError) as e:
+            # e.g. unsorted input, the annotated output is complete nevertheless
+            self.logger.error("Could not index %s: %s" % (output_vcf_file, e))
+
+    def annotate_parallel(
+        self,
+        input_vcf_file,
+        output_vcf_file=None,
+        template=None,
+        processes=None,
+        regions=None,
+        index="tbi",
+        compression_threads=None,
+        **kwargs,
+    ):
+        """
+        Annotate a vcf file using a pool of processes. The input is split by contig if it is
+        bgzipped and tabix indexed or in byte ranges if it is a plain vcf file. Each process
+        annotates its shard independently and the annotated shards are concatenated in input order.
+        Every process uses its own copy of this annotator, so max_threads and the rate limits apply
+        per process unless a shared rate limiter state file is used
+        :param input_vcf_file: The input vcf file to be annotated
+        :param output_vcf_file: The file to write annotations back if none input_vcf_file.annotated.vcf will be
+        generated instead
+        :param template: An alternate vcf file to use for vcf file headers. If none the input vcf file will
+        be used
+        :param processes: number of worker processes. Defaults to the number of cpus
+        :param regions: optional list of regions to restrict a tabix indexed input to, annotated
+        by one process each. See annotate
+        :param index: tbi or csi index written for bgzipped output, or None
+        :param compression_threads: threads compressing bgzipped output. Defaults to the number of cpus
+        :return:
+        """
+        annotations_start = time.time()
+        if not os.path.isfile(input_vcf_file):
+            raise FileNotFoundError("%s does not exist" % input_vcf_file)
+        if kwargs.get("output_format", "vcf") != "vcf":
+            raise ValueError("Only vcf output can be annotated in parallel")
+        for hook in self.hooks:
+            try:
+                pickle.dumps(hook)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                raise ValueError(
+                    "%s cannot be copied to the worker processes of annotate_parallel (%s). "
+                    "Use annotate or hooks that can be pickled"
+                    % (type(hook).__name__, e)
+                )
+        if output_vcf_file is None:
+            output_vcf_file = "%s.annotated.vcf" % input_vcf_file
+        self._check_index(output_vcf_file, index)
+        if template is None:
+            template = input_vcf_file
+        processes = processes or os.cpu_count() or 1
+        shards = vcf_shards(input_vcf_file, processes, regions)
+        compressed = output_vcf_file.endswith(".gz")
+        parts_dir = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(output_vcf_file))
+        )
+        try:
+            part_files = [
+                os.path.join(parts_dir, "%06d.vcf" % i) for i in range(len(shards))
+            ]
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        annotate_shard,
+                        self,
+                        input_vcf_file,
+                        shard,
+                        part_file,
+                        template,
+                        kwargs,
+                    )
+                    for shard, part_file in zip(shards, part_files)
+                ]
+                for future in futures:
+                    total, filtered_out, errors = future.result()
+                    self.total_variants += total
+                    self.filtered_out_variants += filtered_out
+                    self.variants_with_errors += errors
+            output = open(output_vcf_file, "wb" if compressed else "w")
+            if compressed:
+                output = BGZFWriter(output, compression_threads)
+            with output:
+                for i, part_file in enumerate(part_files):
+                    with open(part_file) as part:
+                        for line in part:
+                            # every part has the same header, keep only the first one
+                            if i == 0 or not line.startswith("#"):
+                                output.write(line)
+                                break
+                        shutil.copyfileobj(part, output)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        if compressed and index:
+            self._index_output(output_vcf_file, index)
+        self._log_summary(annotations_start)
+
+    def _log_summary(self, annotations_start):
         self.logger.info(
             "Annotating %s variants in %s. "
             "Filtered out %s. "
@@ -260,3 +1210,14 @@ class VCFAnnotator(VarSomeAPIClient):
                 self.variants_with_errors,
             )
         )
+        transfer = self.transfer_stats.stats
+        if transfer["responses"]:
+            self.logger.info(
+                "Sent %s bytes (%s uncompressed). Received %s bytes (%s decoded)"
+                % (
+                    transfer["bytes_sent"],
+                    transfer["body_bytes"],
+                    transfer["bytes_received"],
+                    transfer["bytes_decoded"],
+                )
+            )